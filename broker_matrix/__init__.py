@@ -3,6 +3,16 @@ from .connector import *
 from .connection_matrix import *
 from .orders import *
 from .contracts import *
+from .subscriptions import *
+from .quotes import *
+from .historical import *
+from .buffers import *
+from .aggregation import *
+from .depth import *
+from .portfolio import *
+from .throttle import *
+from .risk import *
+from .negative_cache import *
 from .requests import *
 from .ib_layer import *
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Bars built from reqMktData ticks
+time bars are closed by the timer, intervals without trades inside the session are filled with flat zero volume bars
+"""
+
+from datetime import datetime, timedelta
+from threading import Lock
+import pytz
+
+from .buffers import BarBuffer
+from .historical import SESSION_OPEN, SESSION_CLOSE
+
+EASTERN = pytz.timezone('US/Eastern')
+RTH_SESSION = (SESSION_OPEN.to_pytimedelta(), SESSION_CLOSE.to_pytimedelta()) # from midnight US/Eastern, Monday to Friday
+AGGREGATOR_CLOSE_DELAY = 1 # seconds the timer waits after a bar end for the ticks still on the way
+TRADE_PRICE_TICKS = ("LAST", "DELAYED_LAST")
+TRADE_SIZE_TICKS = ("LAST_SIZE", "DELAYED_LAST_SIZE")
+BAR_KINDS = ("time", "volume", "tick")
+
+def eastern_now():
+    return datetime.now().astimezone(EASTERN).replace(tzinfo=None)
+
+class TickBarAggregator():
+    # market data listener: aggregator(request, data_piece, data_type)
+    # kind "time": bars of bar_seconds, "volume": bars of threshold shares, "tick": bars of threshold trades
+    # session: (open, close) from midnight US/Eastern on weekdays, gaps outside it stay empty, None fills around the clock; holidays are not known
+    # a trade of an interval already closed by the timer goes to the open bar, the closed bars are never rewritten
+    def __init__(self, bar_seconds=5, kind="time", threshold=None, window=1000, on_bar=None, fill_gaps=True, session=RTH_SESSION):
+        if not kind in BAR_KINDS:
+            raise ValueError("unknown bar kind " + str(kind))
+        if kind != "time" and not threshold:
+            raise ValueError("threshold is required for " + kind + " bars")
+        self.bar_seconds = bar_seconds
+        self.kind = kind
+        self.threshold = threshold
+        self.fill_gaps = fill_gaps
+        self.session = session
+        self.on_bar = on_bar
+        self.bars = BarBuffer(window)
+        self.contract = None
+        self.current = None  # [start, open, high, low, close, volume, ticks]
+        self.next_start = None  # the start of the bar after the last closed one, time bars only
+        self.last_close = None
+        self.lock = Lock()
+
+    def __call__(self, request, data_piece, data_type):
+        tick_time, tick_type, value = data_piece
+        if data_type == "price" and tick_type in TRADE_PRICE_TICKS and value > 0:
+            self.on_trade_price(tick_time, value)
+        elif data_type == "size" and tick_type in TRADE_SIZE_TICKS:
+            self.on_trade_size(tick_time, value)
+
+    def bar_start(self, tick_time):
+        seconds = tick_time.hour * 3600 + tick_time.minute * 60 + tick_time.second
+        return tick_time.replace(microsecond=0) - timedelta(seconds=seconds % self.bar_seconds)
+
+    def on_trade_price(self, tick_time, price):
+        closed = []
+        with self.lock:
+            if self.kind == "time":
+                start = self.bar_start(tick_time)
+                if not self.next_start is None and start < self.next_start: # late, its interval is closed
+                    start = self.next_start if self.current is None else self.current[0]
+                if not self.current is None and start > self.current[0]:
+                    closed += self._close_until(start)
+                elif self.current is None and not self.next_start is None and start > self.next_start:
+                    closed += self._close_until(start)
+            else:
+                start = tick_time
+            if self.current is None:
+                self.current = [start, price, price, price, price, 0.0, 0]
+            else:
+                self.current[2] = max(self.current[2], price)
+                self.current[3] = min(self.current[3], price)
+                self.current[4] = price
+            self.current[6] += 1
+            if self.kind == "tick" and self.current[6] >= self.threshold:
+                closed.append(self._close_current())
+        self._notify(closed)
+
+    def on_trade_size(self, tick_time, size):
+        closed = []
+        with self.lock:
+            if self.current is None:
+                return
+            self.current[5] += float(size)
+            if self.kind == "volume" and self.current[5] >= self.threshold:
+                closed.append(self._close_current())
+        self._notify(closed)
+
+    def on_timer(self, now=None):
+        if self.kind != "time":
+            return
+        now = now or eastern_now()
+        with self.lock:
+            closed = self._close_until(self.bar_start(now - timedelta(seconds=AGGREGATOR_CLOSE_DELAY)))
+        self._notify(closed)
+
+    def _close_current(self):
+        start, open_price, high, low, close, volume, _ = self.current
+        self.bars.append(start, open_price, high, low, close, volume)
+        self.last_close = close
+        self.current = None
+        if self.kind == "time":
+            self.next_start = start + timedelta(seconds=self.bar_seconds)
+        return (start, open_price, high, low, close, volume)
+
+    def _close_until(self, start):
+        # closes the current bar and the empty intervals before start
+        closed = []
+        if not self.current is None and self.current[0] < start:
+            closed.append(self._close_current())
+        if self.fill_gaps and not self.last_close is None and not self.next_start is None:
+            while True:
+                self.next_start = self.session_start(self.next_start)
+                if self.next_start >= start or (not self.current is None and self.next_start >= self.current[0]):
+                    break
+                flat = (self.next_start, self.last_close, self.last_close, self.last_close, self.last_close, 0.0)
+                self.bars.append(*flat)
+                closed.append(flat)
+                self.next_start += timedelta(seconds=self.bar_seconds)
+        return closed
+
+    def session_start(self, bar_time):
+        # bar_time if it is inside the session, otherwise the next session open
+        if self.session is None:
+            return bar_time
+        session_open, session_close = self.session
+        day = datetime.combine(bar_time.date(), datetime.min.time())
+        if bar_time.weekday() < 5 and day + session_open <= bar_time < day + session_close:
+            return bar_time
+        if bar_time.weekday() >= 5 or bar_time >= day + session_close:
+            day += timedelta(days=1)
+        while day.weekday() >= 5:
+            day += timedelta(days=1)
+        return day + session_open
+
+    def _notify(self, closed):
+        if self.on_bar is None:
+            return
+        for bar in closed:
+            self.on_bar(self, bar)
+
+    def is_busy(self, request): # the line is released by detach_bar_aggregator, not by the timeout thread
+        return True
+
+    def to_frame(self):
+        return self.bars.to_frame()
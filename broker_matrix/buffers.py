@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Columnar numpy buffers for bars and ticks
+"""
+
+from threading import Lock
+import numpy as np
+import pandas as pd
+
+BAR_FIELDS = ("open", "high", "low", "close", "volume")
+TICK_FIRST_CHUNK_SIZE = 1024
+TICK_CHUNK_SIZE = 65536
+# "category" columns keep int16 codes of the strings
+TICK_SCHEMAS = {"market": (("time", "datetime64[ns]"), ("type", "category"), ("value", "float64")),
+                "Last": (("time", "datetime64[ns]"), ("price", "float64"), ("size", "float64"), ("exchange", "category")),
+                "AllLast": (("time", "datetime64[ns]"), ("price", "float64"), ("size", "float64"), ("exchange", "category")),
+                "BidAsk": (("time", "datetime64[ns]"), ("bid", "float64"), ("ask", "float64"), ("bid_size", "float64"), ("ask_size", "float64")),
+                "MidPoint": (("time", "datetime64[ns]"), ("mid", "float64"))}
+
+class BarBuffer():
+    # fixed size rolling window of bars, the oldest bars are overwritten
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype="datetime64[ns]")
+        self.values = np.zeros((capacity, len(BAR_FIELDS)))
+        self.count = 0  # bars appended since the start
+        self.lock = Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, bar_time, open_price, high, low, close, volume):
+        with self.lock:
+            position = self.count % self.capacity
+            self.times[position] = np.datetime64(bar_time, "ns")
+            self.values[position] = (open_price, high, low, close, volume)
+            self.count += 1
+
+    def update_last(self, open_price, high, low, close, volume):
+        with self.lock:
+            self.values[(self.count - 1) % self.capacity] = (open_price, high, low, close, volume)
+
+    def last_time(self):
+        if self.count == 0:
+            return None
+        return self.times[(self.count - 1) % self.capacity]
+
+    def last_bar(self):
+        if self.count == 0:
+            return None
+        position = (self.count - 1) % self.capacity
+        return (pd.Timestamp(self.times[position]).to_pydatetime(),) + tuple(self.values[position].tolist())
+
+    def _ordered(self):
+        with self.lock:
+            if self.count <= self.capacity:
+                return self.times[:self.count].copy(), self.values[:self.count].copy()
+            start = self.count % self.capacity
+            return np.concatenate((self.times[start:], self.times[:start])), np.concatenate((self.values[start:], self.values[:start]))
+
+    def records(self):
+        times, values = self._ordered()
+        return [(pd.Timestamp(bar_time).to_pydatetime(),) + tuple(bar) for bar_time, bar in zip(times, values.tolist())]
+
+    def to_frame(self):
+        times, values = self._ordered()
+        return pd.DataFrame(values, columns=list(BAR_FIELDS), index=pd.DatetimeIndex(times, name='date'))
+
+class TickBuffer():
+    # typed growable columns stored in numpy chunks (doubling up to chunk_size), appending never copies the collected ticks
+    def __init__(self, schema, chunk_size=TICK_CHUNK_SIZE):
+        self.schema = TICK_SCHEMAS[schema] if isinstance(schema, str) else tuple(schema)
+        self.names = [name for name, _ in self.schema]
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.capacity = 0  # rows of the last chunk
+        self.fill = 0      # filled rows of the last chunk
+        self.full_rows = 0 # rows of the other chunks
+        self.categories = {name: {} for name, dtype in self.schema if dtype == "category"}  # name -> {string: code}
+        self.complete = True      # False when a paged retrieval stopped before the requested end
+        self.incomplete_from = None # UTC time the missing part starts from
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.full_rows + self.fill
+
+    def _new_chunk(self):
+        self.full_rows += self.fill
+        self.capacity = min(max(TICK_FIRST_CHUNK_SIZE, self.capacity * 2), self.chunk_size)
+        self.chunks.append([np.zeros(self.capacity, dtype="int16" if dtype == "category" else dtype) for _, dtype in self.schema])
+        self.fill = 0
+
+    def _code(self, name, value):
+        codes = self.categories[name]
+        if not value in codes:
+            codes[value] = len(codes)
+        return codes[value]
+
+    def append(self, *values):
+        with self.lock:
+            if self.fill == self.capacity:
+                self._new_chunk()
+            chunk = self.chunks[-1]
+            for column, (name, dtype), value in zip(chunk, self.schema, values):
+                column[self.fill] = self._code(name, value) if dtype == "category" else value
+            self.fill += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(*row)
+
+    def last(self, name):
+        if len(self) == 0:
+            return None
+        position = self.names.index(name)
+        value = self.chunks[-1][position][self.fill - 1]
+        if name in self.categories:
+            return self.category_names(name)[value]
+        return value
+
+    def category_names(self, name):
+        names = [None] * len(self.categories[name])
+        for value, code in self.categories[name].items():
+            names[code] = value
+        return names
+
+    def columns(self, decode=True):
+        with self.lock:
+            chunks = [[column[:len(column) if number < len(self.chunks) - 1 else self.fill] for column in chunk] for number, chunk in enumerate(self.chunks)]
+        columns = {}
+        for position, (name, dtype) in enumerate(self.schema):
+            values = np.concatenate([chunk[position] for chunk in chunks]) if len(chunks) > 0 else np.zeros(0, dtype="int16" if dtype == "category" else dtype)
+            if dtype == "category" and decode:
+                values = pd.Categorical.from_codes(values, categories=self.category_names(name))
+            columns[name] = values
+        return columns
+
+    def records(self):
+        columns = self.columns()
+        times = [pd.Timestamp(value).to_pydatetime() for value in columns[self.names[0]]]
+        return list(zip(times, *[columns[name].tolist() if isinstance(columns[name], np.ndarray) else list(columns[name]) for name in self.names[1:]]))
+
+    def to_frame(self):
+        columns = self.columns()
+        index = pd.DatetimeIndex(columns.pop(self.names[0]), name=self.names[0])
+        return pd.DataFrame(columns, index=index)
+
+    def to_parquet(self, path):
+        self.to_frame().to_parquet(path)
+
+    def nbytes(self):
+        return sum(column.nbytes for chunk in self.chunks for column in chunk)
@@ -10,21 +10,43 @@ import time
 import random
 from threading import Thread, Lock
 from queue import Queue
+from collections import deque
+from itertools import count
 import pytz
 import pandas as pd
 from numpy import sqrt
 
 from .connector import Connector
-from .requests import Request, MarketDataStreamRequest, OrderRequest, MAX_REQUESTS, REQUEST_CALLS, REQUEST_CANCEL_CALLS
-from .errors import request_warnings
+from .requests import Request, RequestRegistry, MarketDataStreamRequest, MarketDepthRequest, HistoricalStreamRequest, TickByTickRequest, OrderRequest, ORDER_STATES, ORDER_TERMINAL_STATES, MAX_REQUESTS, REQUEST_CALLS, REQUEST_CANCEL_CALLS
+from .subscriptions import MarketDataSubscription
+from .aggregation import TickBarAggregator, RTH_SESSION
+from .buffers import TickBuffer
+from .orders import amended_order
+from .portfolio import PositionBook, AccountCache, ACCOUNT_SUMMARY_TAGS
+from .risk import RiskEngine
+from .negative_cache import NegativeCache
+from .contracts import contract_key, stocks_contract, option_contract
+from .errors import request_warnings, order_warnings, order_cancelled_errors, order_not_cancellable_errors
 
 EASTERN = pytz.timezone('US/Eastern'); JERUSALEM = pytz.timezone('Asia/Jerusalem'); UTC = pytz.UTC
 
 START_CLIENT_ID = 123001
+ORDER_ID_BLOCK = 100
+ORDER_AMEND_INTERVAL = 1.0 # min seconds between two amendments of the same order, changes in between are coalesced
 STANDARD_TIMEOUT = 20
 MARKET_REQUEST_TIMEOUT = 300
 POSITION_TIMEOUT = 60
 MANAGED_ACCTS_TIMEOUT = 30
+HISTORICAL_STREAM_WINDOW = 1000
+OPTION_MULTIPLIER = "100"
+
+def subscription_contract(kind, key):
+    if kind == "STK":
+        return stocks_contract(key)
+    if kind == "OPT": # (symbol, strike, right, expiration)
+        symbol, strike, right, expiration = key
+        return option_contract(symbol, strike, expiration, OPTION_MULTIPLIER, right)
+    return None
 
 class RequestRecord():
     def __init__(self):
@@ -39,18 +61,34 @@ class ConnectionMatrix():
             self.max_requests = max_requests
         else:
             self.max_requests = MAX_REQUESTS
+        self.verbose = False
         self.connectors = {}
         self.request_types = {}
-        self.global_requests = {}
+        self.global_requests = RequestRegistry()
         self.market_requests_by_symbol = {}
+        self.market_subscriptions = {}
+        self.subscriptions_lock = Lock()
+        self.desired_subscriptions = {}  # kind -> {"listener": listener, "contracts": {key: contract}}
         self.buy_orders_by_symbol = {}
         self.sell_orders_by_symbol = {}
         self.stop_orders_by_symbol = {}
+        self.orders_by_state = {order_state: set() for order_state in ORDER_STATES}
+        self.orders_lock = Lock()
+        self.position_book = PositionBook()
+        self.account_cache = AccountCache()
+        self.order_ids = {}  # connector id -> deque of reserved order ids, orders of the connector take them in order
+        self.order_ids_lock = Lock()
+        self.fast_order_connector = None
+        self.rejected_request_ids = count(-1, -1)  # ids of the requests failed by the negative cache
+        self.pending_amendments = set()
+        self.risk_engine = None
+        self.negative_cache = NegativeCache()
         if client_id:
             self.client_id = client_id
         else:
             self.client_id = START_CLIENT_ID
         self.request_counters = {request_type: RequestRecord() for request_type in self.max_requests}
+        self.periodic_handlers = []
         self._thread = None
         self.run_thread = True
 
@@ -70,11 +108,13 @@ class ConnectionMatrix():
                     with self.request_counters[request_type].lock:
                         while self.request_counters[request_type].count < self.max_requests[request_type] and self.request_counters[request_type].queue.qsize() > 0:
                             (connector_id, request_id) = self.request_counters[request_type].queue.get()
+                            if not self.global_requests[(connector_id, request_id)].is_unfinished(): # cancelled while queued
+                                continue
                             getattr(self, REQUEST_CALLS[request_type])(self.global_requests[(connector_id, request_id)])
                             self.request_counters[request_type].count += 1
                             self.request_counters[request_type].last = request_id
             now_time = datetime.now()
-            for request in self.global_requests.values():
+            for request in self.global_requests.requests_by_state("active"):
                 if request.request_type in self.max_requests:
                     if (request.is_active()
                         and (request.is_busy is None or not request.is_busy(request))
@@ -95,13 +135,20 @@ class ConnectionMatrix():
                         if not REQUEST_CANCEL_CALLS[request.request_type] is None:
                             cancel_call = getattr(self, REQUEST_CANCEL_CALLS[request.request_type])
                             cancel_call(request, "TimedOut")
+            for handler in list(self.periodic_handlers):
+                handler()
             time.sleep(1)
 
+    def add_periodic_handler(self, handler):
+        if not handler in self.periodic_handlers:
+            self.periodic_handlers.append(handler)
+
+    def remove_periodic_handler(self, handler):
+        if handler in self.periodic_handlers:
+            self.periodic_handlers.remove(handler)
+
     def check_request_in_the_queue(self, request_type, request_symbol):
-        for r in self.global_requests:
-            if self.global_requests[r].request_type == request_type and self.global_requests[r].request_id > self.request_counters[request_type].last and self.global_requests[r].request_symbol() == request_symbol:
-                return True
-        return False
+        return len(self.global_requests.requests_by_symbol(request_type, request_symbol, "queued")) > 0
 
     def create_connection(self, request_types, client_id=None, remote="aws_ib", host=None, port=None):
         # if remote is None:
@@ -110,7 +157,7 @@ class ConnectionMatrix():
             self.client_id = client_id
         else:
             client_id = self.client_id
-        self.connectors[client_id] = Connector(client_id=client_id, remote=remote, host=host, port=port)
+        self.connectors[client_id] = Connector(client_id=client_id, remote=remote, host=host, port=port, verbose=self.verbose)
         for request_type in request_types:
             if request_type in self.request_types:
                 self.request_types[request_type].append(client_id)
@@ -133,6 +180,9 @@ class ConnectionMatrix():
     def get_all_connection_statuses(self):
         return {client_id: self.connectors[client_id].broker_api.isConnected() for client_id in self.connectors}
 
+    def throttle_statistics(self):
+        return {client_id: connector.broker_api.throttle.statistics() for client_id, connector in self.connectors.items() if not connector.broker_api is None}
+
     def set_unspecified_commission_process(self, order_post_process):
         for connector in self.connectors.values():
             connector.set_unspecified_commission_process(order_post_process)
@@ -149,7 +199,7 @@ class ConnectionMatrix():
         return client_id, self.connectors[client_id]
 
     def active_requests(self):
-        for request in self.global_requests.values():
+        for request in self.global_requests.requests_by_state("active"):
             if request.is_active():
                 yield request
 
@@ -160,18 +210,123 @@ class ConnectionMatrix():
                     self.request_counters[request.request_type].count -= 1
         request.set_finished()
 
+    def request_set_loaded(self, request): # keepUpToDate request got the history, it keeps streaming without a slot
+        with self.request_counters[request.request_type].lock:
+            if not request.properties["Loaded"]:
+                self.request_counters[request.request_type].count -= 1
+        request.set_loaded()
+
     def request_set_cancelled_error(self, request, errorCode):
+        if request.request_type == "placeOrder":
+            self.order_set_error(request, errorCode)
+            return
         if request.request_type in self.max_requests:
             with self.request_counters[request.request_type].lock:
-                if not request.properties["TimedOut"]:
+                if not request.properties["TimedOut"] and not request.properties.get("Loaded"):
                     self.request_counters[request.request_type].count -= 1
         if errorCode in request_warnings():
             return
+        if len(request.errors) > 0:
+            self.negative_cache.add(request, errorCode, list(request.errors.values())[-1][1])
+        request.set_cancelled("Error")
+
+    def negative_cache_rejected(self, request_type, request_parameters, request_class=Request, **kwargs):
+        # a request known to fail is returned cancelled with the cached error, None otherwise
+        # it is looked up before any broker work: no connector is selected and no request id is used, the request gets a local negative id
+        error = self.negative_cache.lookup(request_type, request_parameters)
+        if error is None:
+            return None
+        request_id = next(self.rejected_request_ids)
+        request = request_class(request_id, None, request_type, request_parameters, **kwargs)
+        request.errors[datetime.now().astimezone(EASTERN)] = error
+        request.properties["NegativeCache"] = True
+        self.global_requests[(None, request_id)] = request
         request.set_cancelled("Error")
-        if request.request_type == "placeOrder" and not request.child_order_id is None and self.global_requests[(request.connector_id, request.child_order_id)].is_active():
-            self.req_cancel_order(self.global_requests[(request.connector_id, request.child_order_id)])
+        return request
+
+    def order_set_error(self, request, errorCode):
+        if errorCode in request_warnings() or errorCode in order_warnings():
+            return
+        if errorCode in order_not_cancellable_errors(): # already filled or being filled, the order status finishes it
+            request.too_late_to_cancel = True
+            return
+        if errorCode in order_cancelled_errors():
+            request.set_order_state("Cancelled")
+        elif request.amendment_pending() and request.is_open(): # the order lives on with the previous parameters
+            request.reject_amendment(errorCode)
+            return
+        else:
+            request.set_cancelled("Error")
+        if not request.child_order_id is None and (request.connector_id, request.child_order_id) in self.global_requests:
+            child_request = self.global_requests[(request.connector_id, request.child_order_id)]
+            if child_request.is_active():
+                self.req_cancel_order(child_request)
+
+    def order_state_changed(self, request, previous_state):
+        with self.orders_lock:
+            if previous_state in self.orders_by_state:
+                self.orders_by_state[previous_state].discard(request)
+            self.orders_by_state[request.order_status].add(request)
+            if request.order_status in ORDER_TERMINAL_STATES:
+                orders_by_symbol = self.order_side_index(request)
+                if not orders_by_symbol is None and request.request_symbol() in orders_by_symbol:
+                    orders_by_symbol[request.request_symbol()].discard(request)
+        if request.order_status in ORDER_TERMINAL_STATES and not self.risk_engine is None:
+            self.risk_engine.on_order_closed(request)
+
+    def order_filled(self, request, shares, price):
+        if not self.risk_engine is None:
+            self.risk_engine.on_fill(request, shares, price, position_tracked=self.position_book.tracks_executions)
+
+    def set_risk_limits(self, currency=None, **limits):
+        # the first call creates the engine, it follows the position book from its current records on
+        if self.risk_engine is None:
+            self.risk_engine = RiskEngine(account_cache=self.account_cache, currency=currency, **limits)
+            self.position_book.add_listener(self.risk_engine.set_position)
+        else:
+            if not currency is None:
+                self.risk_engine.currency = currency
+            self.risk_engine.set_limits(**limits)
+        return self.risk_engine
+
+    def risk_rejected(self, request):
+        # None if the order passes, otherwise the rejection reason; children of rejected parents are rejected too
+        order = request.request_parameters["order"]
+        if order.parentId:
+            parent_request = self.global_requests.get((request.connector_id, order.parentId))
+            if not parent_request is None and parent_request.properties.get("Reason") == "RiskRejected":
+                return "ParentRejected"
+        return self.risk_engine.check(request.request_parameters["contract"], order)
+
+    def reject_order(self, request, reason):
+        self.risk_engine.reject()
+        request.set_reason(reason)
+        self.global_requests[(request.connector_id, request.request_id)] = request
+        request.set_cancelled("RiskRejected")
+        return request
 
-    def req_historical_data(self, contract, duration_str, bar_size_setting, what_to_show, end_date_time='', use_rth=0, format_date=2, keep_up_to_date=False, chart_options=[], timeout_load_factor=1):
+    def order_side_index(self, request):
+        order = request.request_parameters["order"]
+        if order.orderType == "STP" or order.orderType == "TRAIL":
+            return self.stop_orders_by_symbol
+        if order.action == "BUY":
+            return self.buy_orders_by_symbol
+        if order.action == "SELL":
+            return self.sell_orders_by_symbol
+        return None
+
+    def open_orders(self, symbol=None):
+        with self.orders_lock:
+            requests = list(self.orders_by_state["Submitted"]) + list(self.orders_by_state["PartiallyFilled"])
+        if symbol is None:
+            return requests
+        return [request for request in requests if request.request_symbol() == symbol]
+
+    def orders_in_state(self, order_state):
+        with self.orders_lock:
+            return list(self.orders_by_state[order_state])
+
+    def req_historical_data(self, contract, duration_str, bar_size_setting, what_to_show, end_date_time='', use_rth=0, format_date=2, keep_up_to_date=False, chart_options=[], timeout_load_factor=1, fixed_timeout=None):
         request_parameters = {"contract": contract, "durationStr": duration_str, "barSizeSetting": bar_size_setting,
                               "whatToShow": what_to_show, "endDateTime": end_date_time, "useRTH": use_rth,
                               "formatDate": format_date, "keepUpToDate": keep_up_to_date, "chartOptions": chart_options}
@@ -187,15 +342,19 @@ class ConnectionMatrix():
             factor = 10
             timeout = 30
         timeout += max(points * factor * timeout_load_factor//10000, int(sqrt(factor * timeout_load_factor)))    # heuristics
+        if not fixed_timeout is None:
+            timeout = fixed_timeout
 
+        rejected = self.negative_cache_rejected("reqHistoricalData", request_parameters, timeout=timeout)
+        if not rejected is None:
+            return rejected
         connector_id, connector = self.broker_api_selector("reqHistoricalData")
         request_id = connector.next_req_id()
 
         request = Request(request_id, connector_id, "reqHistoricalData", request_parameters, timeout=timeout)
         request.set_handlers(on_finished=self.request_set_finished, on_error=self.request_set_cancelled_error)
-
-        self.request_counters["reqHistoricalData"].queue.put((connector_id, request_id))
         self.global_requests[(connector_id, request_id)] = request
+        self.request_counters["reqHistoricalData"].queue.put((connector_id, request_id))
         return request
 
     def _req_historical_data(self, request):
@@ -210,11 +369,31 @@ class ConnectionMatrix():
             connector = self.connectors[request.connector_id]
             request.set_cancelled(reason)
             connector.broker_api.cancelHistoricalData(request.request_id)
-            if not no_lock:
+            if not no_lock and not request.properties.get("Loaded"):
                 with self.request_counters[request.request_type].lock:
                     self.request_counters[request.request_type].count -= 1
 
+    def req_historical_stream(self, contract, duration_str, bar_size_setting, what_to_show='TRADES', on_bar_close=None, window=HISTORICAL_STREAM_WINDOW, use_rth=0):
+        # keepUpToDate bars, on_bar_close(request, bar) is called for every closed live bar
+        request_parameters = {"contract": contract, "durationStr": duration_str, "barSizeSetting": bar_size_setting,
+                              "whatToShow": what_to_show, "endDateTime": '', "useRTH": use_rth,
+                              "formatDate": 2, "keepUpToDate": True, "chartOptions": []}
+        connector_id, connector = self.broker_api_selector("reqHistoricalData")
+        request_id = connector.next_req_id()
+
+        request = HistoricalStreamRequest(request_id, connector_id, "reqHistoricalData", request_parameters, timeout=None, window=window)
+        request.set_handlers(on_finished=self.request_set_loaded, on_error=self.request_set_cancelled_error)
+        if not on_bar_close is None:
+            request.bar_listeners.append(on_bar_close)
+
+        self.global_requests[(connector_id, request_id)] = request
+        self.request_counters["reqHistoricalData"].queue.put((connector_id, request_id))
+        return request
+
     def req_contract_details(self, contract):
+        rejected = self.negative_cache_rejected("reqContractDetails", {"contract": contract}, timeout=STANDARD_TIMEOUT)
+        if not rejected is None:
+            return rejected
         connector_id, connector = self.broker_api_selector("reqContractDetails")
         request_id = connector.next_req_id()
         request = Request(request_id, connector_id, "reqContractDetails", {"contract": contract}, timeout=STANDARD_TIMEOUT)
@@ -241,22 +420,26 @@ class ConnectionMatrix():
         return request
 
     def req_market_data(self, on_add_market_data, contract, generic_tick_list=None, snapshot=False, regulatory_snapshot=False,
-                        market_data_options=None, is_busy=None):
+                        market_data_options=None, is_busy=None, timeout=MARKET_REQUEST_TIMEOUT):
 
         generic_tick_list = generic_tick_list or ''
         market_data_options = market_data_options or []
 
         request_parameters = {"contract": contract, "genericTickList": generic_tick_list, "snapshot": snapshot,
                               "regulatorySnapshot": regulatory_snapshot, "mktDataOptions": market_data_options}
+        rejected = self.negative_cache_rejected("reqMktData", request_parameters, MarketDataStreamRequest, timeout=timeout)
+        if not rejected is None:
+            return rejected
         connector_id, connector = self.broker_api_selector("reqMktData")
         request_id = connector.next_req_id()
 
-        request = MarketDataStreamRequest(request_id, connector_id, "reqMktData", request_parameters, timeout=MARKET_REQUEST_TIMEOUT)
+        request = MarketDataStreamRequest(request_id, connector_id, "reqMktData", request_parameters, timeout=timeout)
         request.set_handlers(on_finished=self.request_set_finished, on_error=self.request_set_cancelled_error, on_get_data_postprocess=on_add_market_data, is_busy=is_busy)
 
-        self.request_counters["reqMktData"].queue.put((connector_id, request_id))
         self.global_requests[(connector_id, request_id)] = request
-        self.market_requests_by_symbol[request.request_symbol()] = request
+        self.request_counters["reqMktData"].queue.put((connector_id, request_id))
+        if not snapshot and not regulatory_snapshot: # the streaming line of the symbol, snapshots must not shadow it
+            self.market_requests_by_symbol[request.request_symbol()] = request
         return request
 
     def _req_market_data(self, request):
@@ -274,6 +457,189 @@ class ConnectionMatrix():
                 with self.request_counters[request.request_type].lock:
                     self.request_counters[request.request_type].count -= 1
 
+    def subscribe_market_data(self, listener, contract, generic_tick_list=None, is_busy=None):
+        return self.subscribe_market_data_many(listener, [contract], generic_tick_list=generic_tick_list, is_busy=is_busy)[0]
+
+    def subscribe_market_data_many(self, listener, contracts, generic_tick_list=None, is_busy=None):
+        requests = []
+        with self.subscriptions_lock:
+            for contract in contracts:
+                key = contract_key(contract)
+                subscription = self.market_subscriptions.get(key)
+                if subscription is None or not subscription.is_line_alive():
+                    old_subscription = subscription
+                    subscription = MarketDataSubscription(key, contract)
+                    if not old_subscription is None: # the line was lost (timeout, error), listeners move to the new one
+                        for old_listener, (references, old_is_busy) in list(old_subscription.listeners.items()):
+                            for _ in range(references):
+                                subscription.add_listener(old_listener, old_is_busy)
+                    subscription.request = self.req_market_data(subscription.dispatch, contract, generic_tick_list=generic_tick_list, is_busy=subscription.is_busy)
+                    self.market_subscriptions[key] = subscription
+                subscription.add_listener(listener, is_busy)
+                requests.append(subscription.request)
+        return requests
+
+    def unsubscribe_market_data(self, listener, contract, reason="Unsubscribed"):
+        self.unsubscribe_market_data_many(listener, [contract], reason)
+
+    def unsubscribe_market_data_many(self, listener, contracts, reason="Unsubscribed"):
+        released = []
+        with self.subscriptions_lock:
+            for contract in contracts:
+                key = contract_key(contract)
+                subscription = self.market_subscriptions.get(key)
+                if subscription is None or subscription.remove_listener(listener) > 0:
+                    continue
+                del self.market_subscriptions[key]
+                released.append(subscription.request)
+        if len(released) == 0:
+            return
+        cancelled = 0
+        with self.request_counters["reqMktData"].lock:
+            for request in released:
+                if request.is_active():
+                    self.cancel_market_data(request, reason, no_lock=True)
+                    cancelled += 1
+                elif request.is_unfinished():
+                    request.set_cancelled(reason) # still in the queue, it will be skipped
+            self.request_counters["reqMktData"].count -= cancelled
+
+    def attach_bar_aggregator(self, contract, bar_seconds=5, kind="time", threshold=None, window=1000, on_bar=None, fill_gaps=True, session=RTH_SESSION):
+        aggregator = TickBarAggregator(bar_seconds=bar_seconds, kind=kind, threshold=threshold, window=window, on_bar=on_bar, fill_gaps=fill_gaps, session=session)
+        aggregator.contract = contract
+        self.subscribe_market_data(aggregator, contract, is_busy=aggregator.is_busy)
+        if kind == "time":
+            self.add_periodic_handler(aggregator.on_timer)
+        return aggregator
+
+    def detach_bar_aggregator(self, aggregator):
+        self.remove_periodic_handler(aggregator.on_timer)
+        self.unsubscribe_market_data(aggregator, aggregator.contract)
+
+    def set_desired_subscriptions(self, kind, keys, listener, contracts=None, is_busy=None, cancel_check=None):
+        # reconciles the kind ("STK", "OPT", ...) subscriptions with the keys set, only the difference is requested or cancelled
+        # contracts: dict or callable key -> contract, by default subscription_contract(kind, key)
+        # cancel_check: request -> bool, an unselected line is kept while it returns False
+        keys = keys if isinstance(keys, (set, frozenset)) else set(keys)
+        state = self.desired_subscriptions.setdefault(kind, {"listener": listener, "contracts": {}})
+        current = state["contracts"]
+        if state["listener"] != listener: # move the kept lines to the new listener, the lines stay open
+            kept = [current[key] for key in current if key in keys]
+            self.subscribe_market_data_many(listener, kept, is_busy=is_busy)
+            self.unsubscribe_market_data_many(state["listener"], kept)
+            state["listener"] = listener
+
+        lost = [key for key in current if not self.is_market_line_alive(current[key])]
+        if len(lost) > 0: # timed out or errored lines are requested again when still wanted
+            self.unsubscribe_market_data_many(listener, [current[key] for key in lost], "Lost")
+            for key in lost:
+                del current[key]
+
+        to_remove = []
+        for key in current.keys() - keys:
+            if not cancel_check is None:
+                subscription = self.market_subscriptions.get(contract_key(current[key]))
+                if not subscription is None and subscription.is_line_alive() and not cancel_check(subscription.request):
+                    continue
+            to_remove.append(key)
+        self.unsubscribe_market_data_many(listener, [current[key] for key in to_remove], "Unselected")
+        for key in to_remove:
+            del current[key]
+
+        to_add = keys - current.keys()
+        if len(to_add) > 0:
+            if contracts is None:
+                new_contracts = {key: subscription_contract(kind, key) for key in to_add}
+            elif callable(contracts):
+                new_contracts = {key: contracts(key) for key in to_add}
+            else:
+                new_contracts = {key: contracts[key] for key in to_add}
+            self.subscribe_market_data_many(listener, list(new_contracts.values()), is_busy=is_busy)
+            current.update(new_contracts)
+        return to_add, set(to_remove) | {key for key in lost if not key in keys}
+
+    def is_market_line_alive(self, contract):
+        subscription = self.market_subscriptions.get(contract_key(contract))
+        return not subscription is None and subscription.is_line_alive()
+
+    def market_subscription_listeners(self, contract):
+        subscription = self.market_subscriptions.get(contract_key(contract))
+        if subscription is None:
+            return 0
+        return subscription.listeners_count()
+
+    def req_market_depth(self, contract, num_rows=10, is_smart_depth=False, on_book_change=None, conflation=0.1):
+        # on_book_change(book) is conflated to one call per conflation seconds
+        request_parameters = {"contract": contract, "numRows": num_rows, "isSmartDepth": is_smart_depth, "mktDepthOptions": []}
+        connector_id, connector = self.broker_api_selector("reqMktDepth")
+        request_id = connector.next_req_id()
+        request = MarketDepthRequest(request_id, connector_id, "reqMktDepth", request_parameters, on_book_change=on_book_change, conflation=conflation)
+        request.set_handlers(on_finished=self.request_set_finished, on_error=self.request_set_cancelled_error)
+        self.global_requests[(connector_id, request_id)] = request
+        self.request_counters["reqMktDepth"].queue.put((connector_id, request_id))
+        if not on_book_change is None:
+            self.add_periodic_handler(request.book.flush)
+            request.add_done_callback(lambda request: self.remove_periodic_handler(request.book.flush)) # cancelled, errored or timed out
+        return request
+
+    def _req_market_depth(self, request):
+        connector = self.connectors[request.connector_id]
+        connector.add_request(request)
+        request.set_started()
+        connector.broker_api.reqMktDepth(request.request_id, **request.request_parameters)
+
+    def cancel_market_depth(self, request, reason=None, no_lock=False):
+        if request.is_active():
+            connector = self.connectors[request.connector_id]
+            request.set_cancelled(reason)
+            connector.broker_api.cancelMktDepth(request.request_id, request.request_parameters["isSmartDepth"])
+            if not no_lock:
+                with self.request_counters[request.request_type].lock:
+                    self.request_counters[request.request_type].count -= 1
+
+    def req_tick_by_tick_data(self, on_tick, contract, tick_type="Last", number_of_ticks=0, ignore_size=False):
+        # tick_type: "Last", "AllLast", "BidAsk", "MidPoint", on_tick(request, tick, tick_type) is optional
+        request_parameters = {"contract": contract, "tickType": tick_type, "numberOfTicks": number_of_ticks, "ignoreSize": ignore_size}
+        connector_id, connector = self.broker_api_selector("reqTickByTickData")
+        request_id = connector.next_req_id()
+        request = TickByTickRequest(request_id, connector_id, "reqTickByTickData", request_parameters)
+        request.set_handlers(on_finished=self.request_set_finished, on_error=self.request_set_cancelled_error, on_get_data_postprocess=on_tick)
+        self.global_requests[(connector_id, request_id)] = request
+        self.request_counters["reqTickByTickData"].queue.put((connector_id, request_id))
+        return request
+
+    def _req_tick_by_tick_data(self, request):
+        connector = self.connectors[request.connector_id]
+        connector.add_request(request)
+        request.set_started()
+        connector.broker_api.reqTickByTickData(request.request_id, **request.request_parameters)
+
+    def cancel_tick_by_tick_data(self, request, reason=None, no_lock=False):
+        if request.is_active():
+            connector = self.connectors[request.connector_id]
+            request.set_cancelled(reason)
+            connector.broker_api.cancelTickByTickData(request.request_id)
+            if not no_lock:
+                with self.request_counters[request.request_type].lock:
+                    self.request_counters[request.request_type].count -= 1
+
+    def req_historical_ticks(self, contract, start_date_time='', end_date_time='', what_to_show="TRADES", number_of_ticks=1000, use_rth=0, ignore_size=False, ticks=None):
+        # one page of up to 1000 ticks, ticks: TickBuffer shared by the pages
+        request_parameters = {"contract": contract, "startDateTime": start_date_time, "endDateTime": end_date_time,
+                              "numberOfTicks": number_of_ticks, "whatToShow": what_to_show, "useRth": use_rth,
+                              "ignoreSize": ignore_size, "miscOptions": []}
+        tick_type = {"TRADES": "Last", "BID_ASK": "BidAsk", "MIDPOINT": "MidPoint"}[what_to_show]
+        connector_id, connector = self.broker_api_selector("reqHistoricalTicks")
+        request_id = connector.next_req_id()
+        request = TickByTickRequest(request_id, connector_id, "reqHistoricalTicks", request_parameters, timeout=STANDARD_TIMEOUT,
+                                    ticks=ticks if not ticks is None else TickBuffer(tick_type))
+        request.set_handlers(on_finished=self.request_set_finished, on_error=self.request_set_cancelled_error)
+        connector.add_request(request)
+        self.global_requests[(connector_id, request_id)] = request
+        request.set_started()
+        connector.broker_api.reqHistoricalTicks(request_id, **request_parameters)
+        return request
+
     def req_positions(self): # one request per time only
         connector_id, connector = self.broker_api_selector("reqPositions")
         request = connector.get_special_request("reqPositions")
@@ -294,6 +660,36 @@ class ConnectionMatrix():
         request.set_cancelled(reason)
         connector.broker_api.cancelPositions(request.request_id)
 
+    def start_position_book(self):
+        # reqPositions stays subscribed after positionEnd, the position stream and the fills keep the book up to date
+        connector_id, connector = self.broker_api_selector("reqPositions")
+        request = connector.get_special_request("reqPositions")
+        if not request is None and request.on_get_data == self.position_book.on_position_data:
+            return request
+        if not request is None:
+            self.req_cancel_positions(request, "PositionBook")
+        self.position_book.clear()
+        request_id = connector.next_req_id()
+        request = Request(request_id, connector_id, "reqPositions", None)
+        request.set_handlers(on_get_data=self.position_book.on_position_data, on_finished=self.position_book.set_seeded, on_error=self.request_set_cancelled_error)
+        self.global_requests[(connector_id, request_id)] = request
+        for order_connector_id in self.request_types.get("placeOrder", []):
+            self.connectors[order_connector_id].add_execution_listener(self.position_book.on_execution)
+        self.position_book.tracks_executions = len(self.request_types.get("placeOrder", [])) > 0
+        connector.add_request(request)
+        request.set_started()
+        connector.set_special_request("reqPositions", request)
+        connector.broker_api.reqPositions()
+        return request
+
+    def stop_position_book(self):
+        for connector in self.connectors.values():
+            connector.remove_execution_listener(self.position_book.on_execution)
+        self.position_book.tracks_executions = False
+        for request in self.global_requests.requests_by_type("reqPositions", "active"):
+            if request.on_get_data == self.position_book.on_position_data:
+                self.req_cancel_positions(request, "Finish")
+
     def req_positions_multi(self, account): # one request per time only
         request_parameters = {"account": account}
         connector_id, connector = self.broker_api_selector("reqPositionsMulti")
@@ -328,53 +724,142 @@ class ConnectionMatrix():
         connector.broker_api.reqOpenOrders()
         return request
 
-    def req_place_order(self, order_post_process, contract, order, order_id=None):
+    def next_order_id(self, connector_id, connector):
+        # order ids must grow per connection, so once a block is reserved all the orders of the connector draw from it
+        order_ids = self.order_ids.get(connector_id)
+        if order_ids is None:
+            return connector.next_req_id()
+        try:
+            return order_ids.popleft()
+        except IndexError:
+            with self.order_ids_lock:
+                if len(order_ids) == 0:
+                    order_ids.extend(connector.reserve_req_ids(ORDER_ID_BLOCK))
+            return order_ids.popleft()
+
+    def reserve_order_ids(self, count=ORDER_ID_BLOCK):
         connector_id, connector = self.broker_api_selector("placeOrder")
-        order_id = order_id or connector.next_req_id()
+        with self.order_ids_lock:
+            if not connector_id in self.order_ids:
+                self.order_ids[connector_id] = deque()
+            if len(self.order_ids[connector_id]) < count:
+                self.order_ids[connector_id].extend(connector.reserve_req_ids(count - len(self.order_ids[connector_id])))
+        self.fast_order_connector = (connector_id, connector)
+
+    def req_place_order(self, order_post_process, contract, order, order_id=None, connector_id=None):
+        # connector_id pins the connection of order_id, e.g. a bracket child with its parent
+        if connector_id is None:
+            connector_id, connector = self.broker_api_selector("placeOrder")
+        else:
+            connector = self.connectors[connector_id]
+        order_id = order_id or self.next_order_id(connector_id, connector)
         request_parameters = {"order_id":order_id, "contract": contract, "order": order}
         request = OrderRequest(order_id, connector_id, "placeOrder", request_parameters)
         request.set_handlers(on_finished=self.request_set_finished, on_error=self.request_set_cancelled_error, on_get_data_postprocess=order_post_process)
-        # request.set_handlers(on_finished=self.request_set_finished, on_error=None, on_get_data_postprocess=order_post_process)
-#TODO check id cancel is OK
+        request.order_state_listener = self.order_state_changed
+        request.fill_listener = self.order_filled
+        if not self.risk_engine is None:
+            reason = self.risk_rejected(request)
+            if not reason is None:
+                return self.reject_order(request, reason)
+            self.risk_engine.on_order_placed(request)
         self.global_requests[(connector_id, order_id)] = request
         connector.add_request(request)
         request.set_started()
+        self.register_order(request)
+        request.send_time_ns = time.perf_counter_ns()
+        connector.broker_api.placeOrder(order_id, contract, order)
+        return request
 
-        request_symbol = request.request_symbol()
-        if order.orderType == "STP" or order.orderType == "TRAIL":
-            if not request_symbol in self.stop_orders_by_symbol:
-                self.stop_orders_by_symbol[request_symbol] = set()
-            self.stop_orders_by_symbol[request_symbol].add(request)
-        else:
-            if order.action == "BUY":
-                if not request_symbol in self.buy_orders_by_symbol:
-                    self.buy_orders_by_symbol[request_symbol] = set()
-                self.buy_orders_by_symbol[request_symbol].add(request)
-            elif order.action == "SELL":
-                if not request_symbol in self.sell_orders_by_symbol:
-                    self.sell_orders_by_symbol[request_symbol] = set()
-                self.sell_orders_by_symbol[request_symbol].add(request)
-
+    def place_order_fast(self, contract, order, order_post_process=None):
+        # contract is resolved (conId set) and order is ready, e.g. OrderTemplate.make()
+        # only the connector's request map is updated before placeOrder, so that the first callbacks find the order
+        if not contract.conId:
+            raise ValueError("place_order_fast needs a contract resolved to a conId")
+        if self.fast_order_connector is None:
+            self.reserve_order_ids()
+        connector_id, connector = self.fast_order_connector
+        order_id = self.next_order_id(connector_id, connector)
+        request = OrderRequest(order_id, connector_id, "placeOrder", {"order_id": order_id, "contract": contract, "order": order})
+        request.set_handlers(on_finished=self.request_set_finished, on_error=self.request_set_cancelled_error, on_get_data_postprocess=order_post_process)
+        request.order_state_listener = self.order_state_changed
+        request.fill_listener = self.order_filled
+        if not self.risk_engine is None:
+            reason = self.risk_rejected(request)
+            if not reason is None:
+                return self.reject_order(request, reason)
+            self.risk_engine.on_order_placed(request)
+        connector.broker_api.requests[order_id] = request
+        request.send_time_ns = time.perf_counter_ns()
         connector.broker_api.placeOrder(order_id, contract, order)
+        # deferred bookkeeping
+        request.set_started()
+        self.global_requests[(connector_id, order_id)] = request
+        self.register_order(request)
         return request
 
+    def register_order(self, request):
+        request_symbol = request.request_symbol()
+        with self.orders_lock:
+            orders_by_symbol = self.order_side_index(request)
+            if not orders_by_symbol is None and request.is_open():
+                if not request_symbol in orders_by_symbol:
+                    orders_by_symbol[request_symbol] = set()
+                orders_by_symbol[request_symbol].add(request)
+        request.set_order_state("Submitted")
+
     def req_cancel_order(self, request, reason=None):
-        if request.is_active():
+        # the request is cancelled once IB confirms it, a fill racing the cancel still finishes it as Filled
+        if request.is_active() and not request.cancel_requested:
             connector = self.connectors[request.connector_id]
-            request.set_cancelled(reason)
+            request.cancel_requested = True
+            if not reason is None:
+                request.properties["Reason"] = reason
             connector.broker_api.cancelOrder(request.request_id, "")
-            # order = request.request_parameters['order']
-            # request_symbol = request.request_symbol()
-            # if order.orderType == "STP" or order.orderType == "TRAIL":
-            #     if not request_symbol in self.stop_orders_by_symbol:
-            #         self.stop_orders_by_symbol[request_symbol].remove(request)
-            # else:
-            #     if order.action == "BUY":
-            #         if not request_symbol in self.buy_orders_by_symbol:
-            #             self.buy_orders_by_symbol[request_symbol].remove(request)
-            #     elif order.action == "SELL":
-            #         if not request_symbol in self.sell_orders_by_symbol:
-            #             self.sell_orders_by_symbol[request_symbol].remove(request)
+
+    def modify_order(self, request, **changes):
+        # cancel-replace in place: placeOrder again with the same order id keeps the queue priority and the bracket links
+        if not request.is_open() or request.cancel_requested:
+            return None
+        order = request.request_parameters["order"]
+        for name in changes:
+            if not hasattr(order, name):
+                raise ValueError(f"unknown order field {name}")
+        with self.orders_lock:
+            request.pending_changes.update(changes)
+            if request.last_amend_time is None or time.monotonic() - request.last_amend_time >= ORDER_AMEND_INTERVAL:
+                self.send_amendment(request)
+            else:
+                self.pending_amendments.add(request)
+                self.add_periodic_handler(self.flush_order_amendments)
+        return request
+
+    def send_amendment(self, request): # under orders_lock
+        changes = request.pending_changes
+        request.pending_changes = {}
+        self.pending_amendments.discard(request)
+        if len(changes) == 0 or not request.is_open():
+            return
+        order = amended_order(request.request_parameters["order"], changes)
+        if not self.risk_engine is None: # the open order exposure follows the amended quantity and price
+            reason = self.risk_engine.on_order_amended(request, order)
+            if not reason is None: # the order stays as it is
+                self.risk_engine.reject()
+                request.add_amendment(changes, error=reason)
+                return
+        request.request_parameters["order"] = order
+        request.last_amend_time = time.monotonic()
+        request.add_amendment(changes)
+        self.connectors[request.connector_id].broker_api.placeOrder(request.request_id, request.request_parameters["contract"], order)
+
+    def flush_order_amendments(self):
+        now = time.monotonic()
+        with self.orders_lock:
+            for request in list(self.pending_amendments):
+                if now - request.last_amend_time >= ORDER_AMEND_INTERVAL:
+                    self.send_amendment(request)
+            if len(self.pending_amendments) == 0:
+                self.remove_periodic_handler(self.flush_order_amendments)
 
     def req_account_summary(self, tags):
         connector_id, connector = self.broker_api_selector("reqAccountSummary")
@@ -398,6 +883,72 @@ class ConnectionMatrix():
         request.set_cancelled(reason)
         connector.broker_api.cancelAccountSummary(request.request_id)
 
+    def start_account_cache(self, tags=ACCOUNT_SUMMARY_TAGS):
+        # reqAccountSummary stays subscribed after accountSummaryEnd, IB pushes the changed values
+        connector_id, connector = self.broker_api_selector("reqAccountSummary")
+        request = self.account_cache_request()
+        if not request is None:
+            return request
+        self.account_cache.clear()
+        request_id = connector.next_req_id()
+        request = Request(request_id, connector_id, "reqAccountSummary", {"tags": tags})
+        request.set_handlers(on_get_data=self.account_cache.on_account_summary, on_finished=self.account_cache.set_seeded, on_error=self.request_set_cancelled_error)
+        self.global_requests[(connector_id, request_id)] = request
+        connector.add_request(request)
+        request.set_started()
+        connector.broker_api.reqAccountSummary(request_id, groupName="All", tags=tags)
+        return request
+
+    def account_cache_request(self):
+        for request in self.global_requests.requests_by_type("reqAccountSummary", "active"):
+            if request.on_get_data == self.account_cache.on_account_summary:
+                return request
+        return None
+
+    def stop_account_cache(self):
+        request = self.account_cache_request()
+        if not request is None:
+            self.req_cancel_account_summary(request, "Finish")
+        self.account_cache.seeded.clear()
+        for request in self.global_requests.requests_by_type("reqPnL", "active"):
+            self.cancel_pnl(request, "Finish")
+        for request in self.global_requests.requests_by_type("reqPnLSingle", "active"):
+            self.cancel_pnl_single(request, "Finish")
+
+    def req_pnl(self, account, model_code=""):
+        connector_id, connector = self.broker_api_selector("reqPnL")
+        request_id = connector.next_req_id()
+        request = Request(request_id, connector_id, "reqPnL", {"account": account, "modelCode": model_code})
+        request.set_handlers(on_get_data=lambda data_piece, data_type=None: self.account_cache.on_pnl(account, data_piece), on_error=self.request_set_cancelled_error)
+        self.global_requests[(connector_id, request_id)] = request
+        connector.add_request(request)
+        request.set_started()
+        connector.broker_api.reqPnL(request_id, account, model_code)
+        return request
+
+    def cancel_pnl(self, request, reason=None):
+        if request.is_active():
+            connector = self.connectors[request.connector_id]
+            request.set_cancelled(reason)
+            connector.broker_api.cancelPnL(request.request_id)
+
+    def req_pnl_single(self, account, con_id, model_code=""):
+        connector_id, connector = self.broker_api_selector("reqPnLSingle")
+        request_id = connector.next_req_id()
+        request = Request(request_id, connector_id, "reqPnLSingle", {"account": account, "modelCode": model_code, "conId": con_id})
+        request.set_handlers(on_get_data=lambda data_piece, data_type=None: self.account_cache.on_pnl_single(account, con_id, data_piece), on_error=self.request_set_cancelled_error)
+        self.global_requests[(connector_id, request_id)] = request
+        connector.add_request(request)
+        request.set_started()
+        connector.broker_api.reqPnLSingle(request_id, account, model_code, con_id)
+        return request
+
+    def cancel_pnl_single(self, request, reason=None):
+        if request.is_active():
+            connector = self.connectors[request.connector_id]
+            request.set_cancelled(reason)
+            connector.broker_api.cancelPnLSingle(request.request_id)
+
     def req_managed_accts(self, connector): # one request per time only
         connector_id = connector.client_id
         request = connector.get_special_request("reqManagedAccts")
@@ -16,6 +16,7 @@ from ibapi.ticktype import TickTypeEnum
 
 from lib2.remote import open_remote_port, close_remote_port
 from .errors import reconnect_errors
+from .throttle import MessageThrottle
 
 EASTERN = pytz.timezone('US/Eastern'); JERUSALEM = pytz.timezone('Asia/Jerusalem'); UTC = pytz.UTC
 DEFAULT_IP = "127.0.0.1"
@@ -28,12 +29,25 @@ def call_handlers_list(handlers, the_data):
     else:
         handlers(the_data)
 
+def bar_date_from_ib(date):
+    ts = int(date)
+    # IB Gateway bar.date for daily data is concatenation year+month+day
+    # for intraday data it is UNIX timestamp
+    # comparing with 1E9 works for dates after 2001-09-09 (IB Gateway provides data not older than 5y)
+    if ts < 1000000000:
+        return datetime(ts//10000, ts%10000//100, ts%100)
+    return datetime.fromtimestamp(ts)
+
+def tick_time_from_ib(time_stamp):
+    return datetime.fromtimestamp(int(time_stamp), tz=EASTERN).replace(tzinfo=None)
+
 def tick_type_to_str(tick_type):
     return TickTypeEnum.idx2name.get(tick_type, "NOTFOUND")
 
 class Connector:
-    def __init__(self, client_id, remote=None, local_ip=DEFAULT_IP, local_port=DEFAULT_PORT, host=None, port=None):
+    def __init__(self, client_id, remote=None, local_ip=DEFAULT_IP, local_port=DEFAULT_PORT, host=None, port=None, verbose=False):
         self.client_id = client_id
+        self.verbose = verbose
         self.remote = remote
         self.host = host
         self.port = port
@@ -50,9 +64,10 @@ class Connector:
             self.server, self.ib_port = open_remote_port(remote=self.remote, host=self.host, port=self.port)
 
         if self.broker_api is None:
-            self.broker_api = IBapi()
+            self.broker_api = IBapi(verbose=self.verbose)
         else:
-            self.broker_api = IBapi(self.broker_api.requests, self.broker_api.special_requests, self.broker_api.requests_executions, self.broker_api.order_post_process_unspecified_commission)
+            self.broker_api = IBapi(self.broker_api.requests, self.broker_api.special_requests, self.broker_api.requests_executions, self.broker_api.order_post_process_unspecified_commission,
+                                    self.broker_api.execution_listeners, self.broker_api.throttle, verbose=self.verbose)
         self.broker_api.connect(self.local_ip, self.ib_port, self.client_id)
         self._thread = Thread(target=self.broker_api.run)
         self._thread.start()
@@ -71,6 +86,7 @@ class Connector:
     def stop(self):
         if not self.broker_api is None:
             self.broker_api.disconnect()
+            self.broker_api.throttle.stop()
         if not self.remote is None:
             close_remote_port(self.server)
 
@@ -98,22 +114,49 @@ class Connector:
             self.req_id += 1
         return self.req_id
 
+    def reserve_req_ids(self, count):
+        with self.lock:
+            first_id = self.req_id + 1
+            self.req_id += count
+        return range(first_id, first_id + count)
+
     def set_unspecified_commission_process(self, order_post_process):
         self.broker_api.order_post_process_unspecified_commission = order_post_process
 
+    def add_execution_listener(self, listener): # listener(contract, execution) of every fill, kept on reconnect
+        if not listener in self.broker_api.execution_listeners:
+            self.broker_api.execution_listeners.append(listener)
+
+    def remove_execution_listener(self, listener):
+        if listener in self.broker_api.execution_listeners:
+            self.broker_api.execution_listeners.remove(listener)
+
 class IBapi(EWrapper, EClient):
-    def __init__(self, old_requests=None, special_requests=None, requests_executions=None, order_post_process_unspecified_commission=None):
+    def __init__(self, old_requests=None, special_requests=None, requests_executions=None, order_post_process_unspecified_commission=None, execution_listeners=None, throttle=None, verbose=False):
         EClient.__init__(self, self)
         EWrapper.__init__(self)
+        self.verbose = verbose  # print the order callbacks
         self.next_order_id = None
         self.requests = old_requests if not old_requests is None else {}
         self.special_requests = special_requests if not special_requests is None else {}
         self.requests_executions = requests_executions if not requests_executions is None else {}
         self.order_post_process_unspecified_commission = order_post_process_unspecified_commission
+        self.execution_listeners = execution_listeners if not execution_listeners is None else []
+        if throttle is None:
+            self.throttle = MessageThrottle(self.send_message)
+        else:
+            self.throttle = throttle
+            self.throttle.set_target(self.send_message)
         self.needs_reconnect = False
         self.last_data_time = datetime.now()
         self.connection_check = False
 
+    def sendMsg(self, *args): # every request goes through the throttle
+        self.throttle.submit(args)
+
+    def send_message(self, *args):
+        EClient.sendMsg(self, *args)
+
     def error(self, reqId: int, errorCode: int, errorString: str, advancedOrderRejectJson=""):
         if errorCode in reconnect_errors():
             self.needs_reconnect = True
@@ -144,20 +187,62 @@ class IBapi(EWrapper, EClient):
         self.requests[reqId].on_get_data((self.last_data_time.astimezone(EASTERN).replace(tzinfo=None),
                                           TickTypeEnum.to_str(tickType), size), "size")
 
-    def historicalData(self, reqId, bar):
+    def tickSnapshotEnd(self, reqId):
         self.last_data_time = datetime.now()
+        if not reqId in self.requests or self.requests[reqId].on_finished is None:
+            return
+        self.requests[reqId].on_finished(self.requests[reqId])
+
+    def updateMktDepth(self, reqId, position, operation, side, price, size):
         if not reqId in self.requests or self.requests[reqId].on_get_data is None:
             return
-        ts = int(bar.date)
-        # IB Gateway bar.date for daily data is concatenation year+month+day
-        # for intraday data it is UNIX timestamp
-        # comparing with 1E9 works for dates after 2001-09-09 (IB Gateway provides data not older than 5y)
-        if ts < 1000000000:
-            bar_date = datetime(ts//10000, ts%10000//100, ts%100)
-        else:
-            bar_date = datetime.fromtimestamp(int(bar.date))
+        self.requests[reqId].on_get_data((position, operation, side, price, size, ""), "depth")
+
+    def updateMktDepthL2(self, reqId, position, marketMaker, operation, side, price, size, isSmartDepth=False):
+        if not reqId in self.requests or self.requests[reqId].on_get_data is None:
+            return
+        self.requests[reqId].on_get_data((position, operation, side, price, size, marketMaker), "depth")
+
+    def tickByTickAllLast(self, reqId, tickType, time, price, size, tickAttribLast, exchange, specialConditions):
+        self.last_data_time = datetime.now()
+        if not reqId in self.requests or self.requests[reqId].on_get_data is None:
+            return
+        self.requests[reqId].on_get_data((tick_time_from_ib(time), price, size, exchange), "Last" if tickType == 1 else "AllLast")
+
+    def tickByTickBidAsk(self, reqId, time, bidPrice, askPrice, bidSize, askSize, tickAttribBidAsk):
+        self.last_data_time = datetime.now()
+        if not reqId in self.requests or self.requests[reqId].on_get_data is None:
+            return
+        self.requests[reqId].on_get_data((tick_time_from_ib(time), bidPrice, askPrice, bidSize, askSize), "BidAsk")
+
+    def tickByTickMidPoint(self, reqId, time, midPoint):
+        self.last_data_time = datetime.now()
+        if not reqId in self.requests or self.requests[reqId].on_get_data is None:
+            return
+        self.requests[reqId].on_get_data((tick_time_from_ib(time), midPoint), "MidPoint")
 
-        self.requests[reqId].on_get_data((bar_date,
+    def historicalTicks(self, reqId, ticks, done):
+        self.historical_ticks_page(reqId, [(tick_time_from_ib(tick.time), tick.price) for tick in ticks], done)
+
+    def historicalTicksBidAsk(self, reqId, ticks, done):
+        self.historical_ticks_page(reqId, [(tick_time_from_ib(tick.time), tick.priceBid, tick.priceAsk, tick.sizeBid, tick.sizeAsk) for tick in ticks], done)
+
+    def historicalTicksLast(self, reqId, ticks, done):
+        self.historical_ticks_page(reqId, [(tick_time_from_ib(tick.time), tick.price, tick.size, tick.exchange) for tick in ticks], done)
+
+    def historical_ticks_page(self, reqId, rows, done):
+        self.last_data_time = datetime.now()
+        if not reqId in self.requests or self.requests[reqId].on_get_data is None:
+            return
+        self.requests[reqId].on_get_data(rows, "page")
+        if done and not self.requests[reqId].on_finished is None:
+            self.requests[reqId].on_finished(self.requests[reqId])
+
+    def historicalData(self, reqId, bar):
+        self.last_data_time = datetime.now()
+        if not reqId in self.requests or self.requests[reqId].on_get_data is None:
+            return
+        self.requests[reqId].on_get_data((bar_date_from_ib(bar.date),
                                           bar.open,
                                           bar.high,
                                           bar.low,
@@ -170,8 +255,16 @@ class IBapi(EWrapper, EClient):
             return
         self.requests[reqId].on_finished(self.requests[reqId])
 
-    # def historicalDataUpdate(self, reqId, bar):
-    #     print("HistoricalDataUpdate. ReqId:", reqId, "BarData.", bar)
+    def historicalDataUpdate(self, reqId, bar):
+        self.last_data_time = datetime.now()
+        if not reqId in self.requests or self.requests[reqId].on_get_data is None:
+            return
+        self.requests[reqId].on_get_data((bar_date_from_ib(bar.date),
+                                          bar.open,
+                                          bar.high,
+                                          bar.low,
+                                          bar.close,
+                                          bar.volume), "update")
 
     def nextValidId(self, orderId: int):
         self.next_order_id = orderId
@@ -181,6 +274,11 @@ class IBapi(EWrapper, EClient):
         if not reqId in self.requests or self.requests[reqId].on_get_data is None:
             return
         self.requests[reqId].on_get_data(contractDetails)
+
+    def contractDetailsEnd(self, reqId):
+        self.last_data_time = datetime.now()
+        if not reqId in self.requests or self.requests[reqId].on_finished is None:
+            return
         self.requests[reqId].on_finished(self.requests[reqId])
 
     def securityDefinitionOptionParameter(self, reqId, exchange, underlyingConId, tradingClass, multiplier, expirations, strikes):
@@ -244,6 +342,8 @@ class IBapi(EWrapper, EClient):
     def openOrder(self, orderId, contract, order, orderState):
         self.last_data_time = datetime.now()
         # print("openOrder", orderId, orderState)
+        if orderId in self.requests and self.requests[orderId].request_type == "placeOrder" and not self.requests[orderId].on_get_data is None:
+            self.requests[orderId].on_get_data(orderState.status, "open_order")
         if "reqOpenOrders" not in self.special_requests:
             return
         request = self.special_requests["reqOpenOrders"]
@@ -262,7 +362,10 @@ class IBapi(EWrapper, EClient):
 
     def execDetails(self, reqId, contract, execution):
         self.last_data_time = datetime.now()
-        print("execDetails: ", execution)
+        if self.verbose:
+            print("execDetails: ", execution)
+        for listener in self.execution_listeners:
+            listener(contract, execution)
         orderId = execution.orderId
         if not orderId in self.requests or self.requests[orderId].on_get_data is None:
             return
@@ -271,7 +374,8 @@ class IBapi(EWrapper, EClient):
 
     def commissionReport(self, commissionReport):
         self.last_data_time = datetime.now()
-        print("commissionReport: ", type(commissionReport), " ", commissionReport)
+        if self.verbose:
+            print("commissionReport: ", type(commissionReport), " ", commissionReport)
         if not commissionReport.execId in self.requests_executions:
             self.order_post_process_unspecified_commission(None, commissionReport, "commission")
             return
@@ -282,12 +386,12 @@ class IBapi(EWrapper, EClient):
 
     def orderStatus(self, orderId, status, filled, remaining, avgFillPrice, permId, parentId, lastFillPrice, clientId, whyHeld, mktCapPrice):
         self.last_data_time = datetime.now()
-        print("orderStatus: ", orderId, status, filled, remaining, avgFillPrice, permId, parentId, lastFillPrice, clientId, whyHeld, mktCapPrice)
+        if self.verbose:
+            print("orderStatus: ", orderId, status, filled, remaining, avgFillPrice, permId, parentId, lastFillPrice, clientId, whyHeld, mktCapPrice)
         if not orderId in self.requests or self.requests[orderId].on_get_data is None:
             return
         self.requests[orderId].on_get_data((self.last_data_time.astimezone(EASTERN).replace(tzinfo=None),
                                             status, filled, remaining, avgFillPrice, permId, parentId, lastFillPrice, clientId, whyHeld, mktCapPrice), "order_status")
-# TODO set order finished
 
     def accountSummary(self, reqId, account, tag, value, currency):
         self.last_data_time = datetime.now()
@@ -298,6 +402,18 @@ class IBapi(EWrapper, EClient):
                                           value,
                                           currency))
 
+    def pnl(self, reqId, dailyPnL, unrealizedPnL, realizedPnL):
+        self.last_data_time = datetime.now()
+        if not reqId in self.requests or self.requests[reqId].on_get_data is None:
+            return
+        self.requests[reqId].on_get_data((dailyPnL, unrealizedPnL, realizedPnL), "pnl")
+
+    def pnlSingle(self, reqId, pos, dailyPnL, unrealizedPnL, realizedPnL, value):
+        self.last_data_time = datetime.now()
+        if not reqId in self.requests or self.requests[reqId].on_get_data is None:
+            return
+        self.requests[reqId].on_get_data((pos, dailyPnL, unrealizedPnL, realizedPnL, value), "pnl_single")
+
     def accountSummaryEnd(self, reqId):
         self.last_data_time = datetime.now()
         if not reqId in self.requests or self.requests[reqId].on_finished is None:
@@ -27,3 +27,10 @@ def option_contract(symbol, strike, expiration_str, multiplier, direction="C"):
     opt_contract.right = direction
     opt_contract.multiplier = multiplier
     return opt_contract
+
+def contract_key(contract):
+    if contract.conId and not contract.symbol:
+        return contract.conId
+    strike = float(contract.strike) if contract.strike not in (None, "") else 0.0
+    return (contract.symbol, contract.secType, contract.lastTradeDateOrContractMonth, strike, contract.right,
+            contract.exchange, contract.currency)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Level-2 order book of reqMktDepth
+IB addresses the levels by position: update is O(1), insert and delete shift at most num_rows levels
+"""
+
+import time
+from threading import Lock
+import numpy as np
+import pandas as pd
+
+DEPTH_INSERT = 0; DEPTH_UPDATE = 1; DEPTH_DELETE = 2
+DEPTH_ASK = 0; DEPTH_BID = 1
+
+class OrderBookSide():
+    def __init__(self, rows):
+        self.prices = np.full(rows, np.nan)
+        self.sizes = np.zeros(rows)
+        self.market_makers = np.full(rows, "", dtype=object)
+        self.count = 0
+
+    def apply(self, position, operation, price, size, market_maker):
+        rows = len(self.prices)
+        if position >= rows:
+            return
+        if operation == DEPTH_INSERT:
+            last = min(self.count, rows - 1)
+            for column in (self.prices, self.sizes, self.market_makers):
+                column[position + 1:last + 1] = column[position:last]
+            self.count = min(self.count + 1, rows)
+        elif operation == DEPTH_DELETE:
+            if position >= self.count:
+                return
+            for column in (self.prices, self.sizes, self.market_makers):
+                column[position:self.count - 1] = column[position + 1:self.count]
+            self.count -= 1
+            self.prices[self.count] = np.nan; self.sizes[self.count] = 0; self.market_makers[self.count] = ""
+            return
+        elif position >= self.count: # update of a level which is not inserted yet
+            self.count = position + 1
+        self.prices[position] = price
+        self.sizes[position] = size
+        self.market_makers[position] = market_maker
+
+    def clear(self):
+        self.prices[:] = np.nan
+        self.sizes[:] = 0
+        self.market_makers[:] = ""
+        self.count = 0
+
+class OrderBook():
+    # on_change(book) is called at most once per conflation seconds, the pending change is flushed by flush()
+    def __init__(self, rows, on_change=None, conflation=0.1):
+        self.rows = rows
+        self.bids = OrderBookSide(rows)
+        self.asks = OrderBookSide(rows)
+        self.on_change = on_change
+        self.conflation = conflation
+        self.updates = 0
+        self.notified_updates = 0
+        self.last_notify = 0.0
+        self.lock = Lock()
+
+    def apply(self, position, operation, side, price, size, market_maker=""):
+        with self.lock:
+            (self.bids if side == DEPTH_BID else self.asks).apply(position, operation, price, size, market_maker)
+            self.updates += 1
+        if not self.on_change is None and time.monotonic() - self.last_notify >= self.conflation:
+            self._notify()
+
+    def flush(self):
+        if not self.on_change is None and self.updates != self.notified_updates:
+            self._notify()
+
+    def _notify(self):
+        self.last_notify = time.monotonic()
+        self.notified_updates = self.updates
+        self.on_change(self)
+
+    def best_bid(self):
+        return (self.bids.prices[0], self.bids.sizes[0]) if self.bids.count > 0 else (None, None)
+
+    def best_ask(self):
+        return (self.asks.prices[0], self.asks.sizes[0]) if self.asks.count > 0 else (None, None)
+
+    def top(self, levels=None, copy=True):
+        # (bid prices, bid sizes, ask prices, ask sizes) of the top levels, views of the book arrays unless copy
+        with self.lock:
+            bid_levels = self.bids.count if levels is None else min(levels, self.bids.count)
+            ask_levels = self.asks.count if levels is None else min(levels, self.asks.count)
+            view = (self.bids.prices[:bid_levels], self.bids.sizes[:bid_levels], self.asks.prices[:ask_levels], self.asks.sizes[:ask_levels])
+            return tuple(column.copy() for column in view) if copy else view
+
+    def to_frame(self, levels=None):
+        bid_prices, bid_sizes, ask_prices, ask_sizes = self.top(levels)
+        depth = max(len(bid_prices), len(ask_prices))
+        frame = pd.DataFrame(index=pd.RangeIndex(depth, name="level"), columns=["bid_size", "bid", "ask", "ask_size"], dtype=float)
+        frame.iloc[:len(bid_prices), 0] = bid_sizes; frame.iloc[:len(bid_prices), 1] = bid_prices
+        frame.iloc[:len(ask_prices), 2] = ask_prices; frame.iloc[:len(ask_prices), 3] = ask_sizes
+        return frame
+
+    def clear(self):
+        with self.lock:
+            self.bids.clear()
+            self.asks.clear()
@@ -13,3 +13,16 @@ def reconnect_errors():
     
 def request_warnings():
     return [2100, 2101, 2102, 2103, 2104, 2158, 2105, 2106, 2107, 2108, 2109, 2110, 2137]
+
+def order_warnings():
+    return [399, 404]
+
+def order_cancelled_errors():
+    return [202]
+
+def order_not_cancellable_errors():
+    return [161, 10148]
+
+def negative_cache_ttls():
+    # error code -> seconds the same request fails locally, 200 (no security definition) applies to every request type of the contract
+    return {200: 3600, 162: 600, 354: 600}
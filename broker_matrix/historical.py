@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Historical bars helpers
+splitting of long reqHistoricalData requests into legal chunks and stitching of the results
+"""
+
+import os
+import re
+from datetime import datetime, timedelta
+import pytz
+import pandas as pd
+
+EASTERN = pytz.timezone('US/Eastern'); UTC = pytz.UTC
+
+DURATION_SECONDS = {"S": 1, "D": 86400, "W": 7 * 86400, "M": 30 * 86400, "Y": 365 * 86400}
+# the longest duration IB returns in one request for the bar size
+MAX_CHUNK_SECONDS = {"1 secs": 1800, "5 secs": 3600, "10 secs": 14400, "15 secs": 14400, "30 secs": 28800,
+                     "1 min": 86400, "2 mins": 2 * 86400, "3 mins": 7 * 86400, "5 mins": 7 * 86400,
+                     "10 mins": 7 * 86400, "15 mins": 7 * 86400, "20 mins": 7 * 86400, "30 mins": 30 * 86400,
+                     "1 hour": 30 * 86400, "2 hours": 30 * 86400, "3 hours": 30 * 86400, "4 hours": 30 * 86400,
+                     "8 hours": 30 * 86400, "1 day": 365 * 86400, "1 week": 365 * 86400, "1 month": 365 * 86400}
+DAILY_BAR_SIZES = ("1 day", "1 week", "1 month")
+BAR_SIZE_SECONDS = {"1 secs": 1, "5 secs": 5, "10 secs": 10, "15 secs": 15, "30 secs": 30,
+                    "1 min": 60, "2 mins": 120, "3 mins": 180, "5 mins": 300, "10 mins": 600, "15 mins": 900,
+                    "20 mins": 1200, "30 mins": 1800, "1 hour": 3600, "2 hours": 7200, "3 hours": 10800,
+                    "4 hours": 14400, "8 hours": 28800, "1 day": 86400, "1 week": 7 * 86400, "1 month": 30 * 86400}
+DAILY_RESAMPLE_RULES = {"1 day": "D", "1 week": "W-MON", "1 month": "MS"}
+SESSION_OPEN = pd.Timedelta(hours=9, minutes=30)
+SESSION_CLOSE = pd.Timedelta(hours=16)
+PANEL_FIELDS = ("open", "high", "low", "close", "volume")
+PANEL_FILL_POLICIES = (None, "ffill", "flat", "zero")
+BAR_AGGREGATION = {"open": "first", "high": "max", "low": "min", "close": "last", "volume": "sum"}
+BAR_COLUMNS = ['date', 'open', 'high', 'low', 'close', 'volume']
+
+def duration_to_seconds(duration_str):
+    points, unit = duration_str.split(" ")
+    return int(points) * DURATION_SECONDS[unit]
+
+def seconds_to_duration(seconds, days=False):
+    if seconds < 86400 and not days:
+        return str(max(int(seconds), 60)) + " S"
+    return str(-(-int(seconds) // 86400)) + " D"
+
+def format_end_date_time(end_time):
+    # naive datetimes are UTC
+    if end_time.tzinfo is None:
+        end_time = UTC.localize(end_time)
+    return end_time.astimezone(UTC).strftime("%Y%m%d-%H:%M:%S")
+
+def plan_historical_chunks(duration_str, bar_size_setting, end_date_time=None):
+    # list of (endDateTime, durationStr) covering the duration backwards from end_date_time (default now), latest first
+    total_seconds = duration_to_seconds(duration_str)
+    chunk_seconds = MAX_CHUNK_SECONDS.get(bar_size_setting, total_seconds)
+    if total_seconds <= chunk_seconds:
+        return [(format_end_date_time(end_date_time) if end_date_time else '', duration_str)]
+    end_time = end_date_time if end_date_time else datetime.now(tz=UTC)
+    chunks = []
+    covered = 0
+    while covered < total_seconds:
+        seconds = min(chunk_seconds, total_seconds - covered)
+        chunks.append((format_end_date_time(end_time - timedelta(seconds=covered)), seconds_to_duration(seconds)))
+        covered += seconds
+    return chunks
+
+def stitch_bars(frames):
+    frames = [frame for frame in frames if not frame is None and len(frame) > 0]
+    if len(frames) == 0:
+        return None
+    stitched = pd.concat(frames).sort_index(kind="stable")
+    return stitched[~stitched.index.duplicated(keep="last")]
+
+def parse_end_date_time(end_date_time):
+    # '' is now, otherwise the UTC format of format_end_date_time, None for other formats
+    if end_date_time == '':
+        return datetime.now(tz=UTC)
+    try:
+        return UTC.localize(datetime.strptime(end_date_time, "%Y%m%d-%H:%M:%S"))
+    except ValueError:
+        return None
+
+def remaining_duration(bars, end_date_time, duration_str, bar_size_setting, local_timezone):
+    # durationStr of the part of the window after the last received bar (bars are in the local naive time)
+    # None if the window is already covered
+    if bars is None or len(bars) == 0:
+        return duration_str
+    end_time = parse_end_date_time(end_date_time)
+    if end_time is None:
+        return duration_str
+    last_bar_time = local_timezone.localize(pd.Timestamp(bars.index[-1]).to_pydatetime()).astimezone(UTC)
+    seconds = (end_time - last_bar_time).total_seconds()
+    daily = bar_size_setting in DAILY_BAR_SIZES
+    if seconds <= 0 or (daily and seconds < 86400):
+        return None
+    return seconds_to_duration(min(seconds, duration_to_seconds(duration_str)), days=daily)
+
+def missing_window_start(bars, end_date_time, duration_str, local_timezone):
+    # UTC time the part of the window not covered by the bars starts from, None if the window end is unknown
+    if not bars is None and len(bars) > 0:
+        return local_timezone.localize(pd.Timestamp(bars.index[-1]).to_pydatetime()).astimezone(UTC)
+    end_time = parse_end_date_time(end_date_time)
+    if end_time is None:
+        return None
+    return end_time - timedelta(seconds=duration_to_seconds(duration_str))
+
+def trim_to_window(bars, end_date_time, duration_str, local_timezone):
+    end_time = parse_end_date_time(end_date_time)
+    if bars is None or end_time is None:
+        return bars
+    window_start = (end_time - timedelta(seconds=duration_to_seconds(duration_str))).astimezone(local_timezone).replace(tzinfo=None)
+    return bars[bars.index >= window_start]
+
+def symbol_file_name(symbol):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", symbol if isinstance(symbol, str) else "_".join(str(part) for part in symbol))
+
+class ParquetSink():
+    # one parquet file per symbol, requires pyarrow or fastparquet
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, symbol, historical_data):
+        historical_data.to_parquet(os.path.join(self.directory, symbol_file_name(symbol) + ".parquet"))
+
+class HDF5Sink():
+    # one key per symbol in the HDF5 file, requires pytables
+    def __init__(self, path, complevel=5):
+        self.path = path
+        self.complevel = complevel
+
+    def __call__(self, symbol, historical_data):
+        historical_data.to_hdf(self.path, key="/" + symbol_file_name(symbol), complevel=self.complevel)
+
+def finest_bar_size(bar_sizes):
+    return min(bar_sizes, key=lambda bar_size: BAR_SIZE_SECONDS[bar_size])
+
+def resample_bars(bars, bar_size_setting, rth_only=False):
+    # OHLCV bars of a coarser bar size, the index is US/Eastern (tz-aware or naive wall time)
+    # intraday bars are aligned to the clock and cut at the session open and close like IB bars, e.g. the first hour bar is 9:30-10:00
+    if bars is None or len(bars) == 0:
+        return bars
+    wall_time = bars.index if bars.index.tz is None else bars.index.tz_convert(EASTERN).tz_localize(None)
+    day_start = wall_time.normalize()
+    time_of_day = wall_time - day_start
+    if rth_only:
+        in_session = (time_of_day >= SESSION_OPEN) & (time_of_day < SESSION_CLOSE)
+        bars, day_start, time_of_day = bars[in_session], day_start[in_session], time_of_day[in_session]
+    if bar_size_setting in DAILY_RESAMPLE_RULES:
+        labels = day_start
+    else:
+        freq = pd.Timedelta(seconds=BAR_SIZE_SECONDS[bar_size_setting])
+        offsets = time_of_day - time_of_day % freq
+        for boundary in (SESSION_OPEN, SESSION_CLOSE):
+            offsets = offsets.where(~((time_of_day >= boundary) & (offsets < boundary)), boundary)
+        labels = day_start + offsets
+    resampled = bars.groupby(labels).agg(BAR_AGGREGATION)
+    if bar_size_setting in ("1 week", "1 month"):
+        resampled = resampled.resample(DAILY_RESAMPLE_RULES[bar_size_setting], label="left", closed="left").agg(BAR_AGGREGATION).dropna(subset=["open"])
+    if not bars.index.tz is None:
+        resampled.index = resampled.index.tz_localize(EASTERN, ambiguous=False, nonexistent="shift_forward")
+    resampled.index.name = bars.index.name
+    return resampled
+
+def historical_panel(collected_data, fields=PANEL_FIELDS, fill=None, as_array=False):
+    # one frame on the union calendar of all symbols with (symbol, field) columns
+    # fill: None - NaN, "ffill" - previous values, "flat" - prices from the previous close and zero volume, "zero" - zeros
+    # as_array: (symbols, calendar, symbol x time x field array)
+    if not fill in PANEL_FILL_POLICIES:
+        raise ValueError("unknown fill policy " + str(fill))
+    fields = list(fields)
+    frames = {symbol: frame[fields] for symbol, frame in collected_data.items() if not frame is None and len(frame) > 0}
+    if len(frames) == 0:
+        return None
+    panel = pd.concat(frames, axis=1).sort_index()
+    if fill == "ffill":
+        panel = panel.ffill()
+    elif fill == "zero":
+        panel = panel.fillna(0)
+    elif fill == "flat":
+        last_close = panel.xs("close", axis=1, level=1).ffill()
+        for field in fields:
+            values = panel.xs(field, axis=1, level=1)
+            filler = last_close if field != "volume" else 0
+            panel.loc[:, pd.IndexSlice[:, field]] = values.fillna(filler).to_numpy()
+    if not as_array:
+        return panel
+    symbols = list(frames)
+    array = panel.to_numpy().reshape(len(panel.index), len(symbols), len(fields)).transpose(1, 0, 2)
+    return symbols, panel.index, array
@@ -6,25 +6,66 @@ Common brocker level for IB
 
 """
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from threading import Event
+from queue import Queue, Empty
 import pytz
 from tzlocal import get_localzone_name
 import pandas as pd
 
 from ibapi.contract import Contract
 from ibapi.order import Order
-from .connection_matrix import ConnectionMatrix
+from .connection_matrix import ConnectionMatrix, POSITION_TIMEOUT
+from .requests import OrderBatch
 from .orders import market_order, limit_order, stop_order, stop_trailing_order
-from .contracts import stocks_contract, option_contract
+from .contracts import stocks_contract, option_contract, contract_key
+from .buffers import TickBuffer
+from .historical import format_end_date_time, plan_historical_chunks, stitch_bars, remaining_duration, missing_window_start, trim_to_window, finest_bar_size, resample_bars, historical_panel
 
 EASTERN = pytz.timezone('US/Eastern'); JERUSALEM = pytz.timezone('Asia/Jerusalem'); UTC = pytz.UTC
 LOCAL_TIMEZONE = pytz.timezone(get_localzone_name())
 REF_EXCHANGE = 'CBOE'
 
 CONTRACT_DETAILS_CHECK_TIMEOUT = 20
-CONTRACT_DETAILS_CHECK_SLEEP = 0.01
 CHAIN_TIMEOUT = 120
 CHAIN_SLEEP = 0.1
+QUALIFY_IN_FLIGHT_PER_CONNECTOR = 50
+HISTORICAL_CHUNK_TIMEOUT = 180
+HISTORICAL_CHUNK_RETRIES = 2
+HISTORICAL_CHUNK_BACKOFF = 15 # seconds before the first retry of a chunk, doubled on every next one
+HISTORICAL_PACING_BACKOFF = 60 # seconds before retrying a chunk rejected by a pacing violation
+HISTORICAL_STREAM_IN_MEMORY = 20
+HISTORICAL_TICKS_PAGE = 1000
+HISTORICAL_TICKS_TIMEOUT = 60 # seconds per page
+HISTORICAL_TICKS_TYPES = {"TRADES": "Last", "BID_ASK": "BidAsk", "MIDPOINT": "MidPoint"}
+LATTICE_STRIKE_BAND = 0.1
+LATTICE_MAX_DAYS = 60
+
+def wait_request(request, timeout):
+    done = Event()
+    request.add_done_callback(lambda request: done.set())
+    return done.wait(timeout)
+
+def contract_details_status(request):
+    if request.is_finished():
+        if len(request.get_data()) == 0:
+            return "not found"
+        return "ok" if len(request.get_data()) == 1 else "ambiguous"
+    if request.properties['Cancelled'] and request.properties.get('Reason') != "TimedOut":
+        if any(error_code == 200 for error_code, _ in request.errors.values()):
+            return "not found"
+        return "error"
+    return "timeout"
+
+def is_no_data_error(request):
+    return any(error_code == 162 and "no data" in error_string for error_code, error_string in request.errors.values())
+
+def is_pacing_error(request):
+    return any(error_code == 162 and "pacing violation" in error_string.lower() for error_code, error_string in request.errors.values())
+
+def localize_historical_data(historical_data):
+    historical_data.index = historical_data.apply(lambda row: pd.Timestamp(LOCAL_TIMEZONE.localize(row.name).astimezone(EASTERN)), axis=1)
+    return historical_data
 
 def count_unfinished_requests(requests):
     count = 0
@@ -34,14 +75,16 @@ def count_unfinished_requests(requests):
     return count
 
 class IBLayer(ConnectionMatrix):
-    def __init__(self, account=None, currency=None, client_id=None, remote=None, host=None, port=None, request_type_groups=None):
+    def __init__(self, account=None, currency=None, client_id=None, remote=None, host=None, port=None, request_type_groups=None, verbose=False):
         super().__init__(client_id=client_id)
         self.account = account
         self.currency = currency
+        self.verbose = verbose
         self.host = host
         self.port = port
         self.remote = remote
         self.request_type_groups = request_type_groups if not request_type_groups is None else ['Historical']
+        self.historical_partials = {}  # (contract key, bar size, what to show, end date time) -> bars received before a timeout or an error
 
     def start(self):
         super().start()
@@ -53,9 +96,16 @@ class IBLayer(ConnectionMatrix):
                                                   "reqPositionsMulti",
                                                   "reqOpenOrders",
                                                   "reqAccountSummary",
+                                                  "reqPnL",
+                                                  "reqPnLSingle",
+                                                  "reqHistoricalTicks",
                                                   "placeOrder"], remote=self.remote, host=self.host, port=self.port)
+            self.start_position_book()
+            self.start_account_cache()
+            if not self.account is None:
+                self.req_pnl(self.account)
         if "Market" in self.request_type_groups:
-            self.create_connection(request_types=["reqMktData"], remote=self.remote, host=self.host, port=self.port)
+            self.create_connection(request_types=["reqMktData", "reqTickByTickData", "reqMktDepth"], remote=self.remote, host=self.host, port=self.port)
         # if "Order" in self.request_type_groups:
         #     self.create_connection(request_types=["createOrder"], host=self.host, port=self.port)
 
@@ -74,7 +124,8 @@ class IBLayer(ConnectionMatrix):
             return None
         return pd.DataFrame.from_records(request.get_data(), columns=['date', 'open', 'high', 'low', 'close', 'volume'], index='date')
 
-    def retrieve_ib_historical_data(self, symbols, duration_str, bar_size_setting, what_to_show='TRADES', localize=True):
+    def retrieve_ib_historical_data(self, symbols, duration_str, bar_size_setting, what_to_show='TRADES', localize=True, panel=None, fill=None):
+        # panel: None - dict of frames, "frame" or "array" - aligned output of historical_panel with the fill policy
         requests = {}; collected_data = {}
         for symbol in symbols:
             requests[symbol] = self.req_historical_data(stocks_contract(symbol),
@@ -97,37 +148,66 @@ class IBLayer(ConnectionMatrix):
             historical_data.index.name = 'Date'
             collected_data[symbol] = historical_data
 
+        if not panel is None:
+            return historical_panel(collected_data, fill=fill, as_array=(panel == "array"))
         return collected_data
 
     def retrieve_ib_volatility(self, symbols, duration, bar_size_setting):
         vol = self.retrieve_ib_historical_data(symbols, duration, bar_size_setting, what_to_show='HISTORICAL_VOLATILITY')
         return {symbol: vol[symbol]['close'][-1] for symbol in vol if (not vol[symbol] is None and not vol[symbol]['close'] is None and len(vol[symbol]['close']) > 0)}
 
-    def retrieve_ib_historical_data_general(self, symbol_requests, duration_str_suffix, bar_size_setting, what_to_show='TRADES', localize=True, options=False, end_date_time=''):
+    def salvage_historical_data(self, salvage_key, request):
+        partial = self.get_historical_data(request.connector_id, request.request_id, incomplete=True)
+        if len(partial) > 0:
+            self.historical_partials[salvage_key] = stitch_bars([self.historical_partials.get(salvage_key), partial])
+
+    def retrieve_ib_historical_data_general(self, symbol_requests, duration_str_suffix, bar_size_setting, what_to_show='TRADES', localize=True, options=False, end_date_time='', resume_attempts=0):
+        # bars of timed out or failed requests are kept, the next request for the symbol (in this call
+        # with resume_attempts > 0 or in the next call) fetches only the window after them
         if options:
             column = 1
         else:
             column = 0
-        requests = {}; collected_data = {}
-        for symbol in symbol_requests:
-            contract = symbol_requests[symbol][column + 1]
-            duration_str = str(symbol_requests[symbol][column]) + duration_str_suffix
-            requests[symbol] = self.req_historical_data(contract=contract,
-                                                        duration_str=duration_str,
-                                                        bar_size_setting=bar_size_setting,
-                                                        what_to_show=what_to_show,
-                                                        end_date_time=end_date_time)
-
-        while count_unfinished_requests(requests):
-            #TODO check if the connection is dead or stalled, go out, process available and return result code
-            time.sleep(1)
-
-        for symbol in requests:
-            if not requests[symbol].properties['Finished']:
-                collected_data[symbol] = None
-                continue
-            historical_data = self.get_historical_data(requests[symbol].connector_id, requests[symbol].request_id)
+        windows = {symbol: (symbol_requests[symbol][column + 1], str(symbol_requests[symbol][column]) + duration_str_suffix) for symbol in symbol_requests}
+        raw_data = {}; collected_data = {}
+        pending = list(windows)
+        for _ in range(resume_attempts + 1):
+            requests = {}
+            for symbol in pending:
+                contract, duration_str = windows[symbol]
+                salvage_key = (contract_key(contract), bar_size_setting, what_to_show, end_date_time)
+                resume_duration_str = remaining_duration(self.historical_partials.get(salvage_key), end_date_time, duration_str, bar_size_setting, LOCAL_TIMEZONE)
+                if resume_duration_str is None:
+                    raw_data[symbol] = self.historical_partials.pop(salvage_key)
+                    continue
+                requests[symbol] = self.req_historical_data(contract=contract,
+                                                            duration_str=resume_duration_str,
+                                                            bar_size_setting=bar_size_setting,
+                                                            what_to_show=what_to_show,
+                                                            end_date_time=end_date_time)
+
+            while count_unfinished_requests(requests):
+                #TODO check if the connection is dead or stalled, go out, process available and return result code
+                time.sleep(1)
+
+            for symbol in requests:
+                contract, duration_str = windows[symbol]
+                salvage_key = (contract_key(contract), bar_size_setting, what_to_show, end_date_time)
+                if not requests[symbol].properties['Finished']:
+                    self.salvage_historical_data(salvage_key, requests[symbol])
+                    continue
+                historical_data = self.get_historical_data(requests[symbol].connector_id, requests[symbol].request_id)
+                if salvage_key in self.historical_partials:
+                    historical_data = stitch_bars([self.historical_partials.pop(salvage_key), historical_data])
+                    historical_data = trim_to_window(historical_data, end_date_time, duration_str, LOCAL_TIMEZONE)
+                raw_data[symbol] = historical_data
+
+            pending = [symbol for symbol in requests if not symbol in raw_data]
+            if len(pending) == 0:
+                break
 
+        for symbol in windows:
+            historical_data = raw_data.get(symbol)
             if historical_data is None or len(historical_data) == 0:
                 collected_data[symbol] = None
                 continue
@@ -139,29 +219,230 @@ class IBLayer(ConnectionMatrix):
 
         return collected_data
 
+    def retrieve_ib_historical_data_multi(self, symbols, duration_str, bar_sizes, what_to_show='TRADES', end_date_time=None, rth_only=False):
+        # {bar size: {symbol: DataFrame}}, only the finest bar size is requested, the others are resampled locally in US/Eastern
+        base_bar_size = finest_bar_size(bar_sizes)
+        base_data = self.retrieve_ib_historical_data_chunked(symbols, duration_str, base_bar_size, what_to_show=what_to_show, end_date_time=end_date_time)
+        collected_data = {}
+        for bar_size in bar_sizes:
+            if bar_size == base_bar_size:
+                collected_data[bar_size] = base_data
+            else:
+                collected_data[bar_size] = {symbol: resample_bars(base_data[symbol], bar_size, rth_only=rth_only) for symbol in base_data}
+        return collected_data
+
+    def cancel_overdue_historical_data(self, requests):
+        # the queue thread cancels timed out requests only when the slots are exhausted
+        now = datetime.now()
+        for request in requests:
+            if request.is_active() and not request.timeout_time is None and request.timeout_time < now:
+                self.cancel_historical_data(request, "TimedOut")
+
+    def retrieve_ib_historical_data_chunked(self, symbols, duration_str, bar_size_setting, what_to_show='TRADES', end_date_time=None, localize=True, retries=HISTORICAL_CHUNK_RETRIES,
+                                            panel=None, fill=None):
+        # symbols: list of stock symbols or dict symbol -> contract
+        # the duration is split into chunks IB accepts for the bar size, chunks are requested in parallel and retried separately
+        # the bars of a chunk out of retries are kept, the frame of the symbol has attrs["complete"] False and attrs["incomplete_from"] the earliest UTC gap start
+        contracts = symbols if isinstance(symbols, dict) else {symbol: stocks_contract(symbol) for symbol in symbols}
+        chunks = plan_historical_chunks(duration_str, bar_size_setting, end_date_time)
+        done = Queue()
+        pending = {}  # (connector_id, request_id) -> (request, symbol, chunk, attempt)
+        delayed = []  # (retry time, symbol, chunk, attempt), failed chunks wait out the pacing window before the retry
+        frames = {symbol: [] for symbol in contracts}
+        incomplete_from = {}  # symbol -> UTC start of the earliest missing part, None if unknown
+
+        def submit(symbol, chunk, attempt):
+            chunk_end_date_time, chunk_duration_str = chunk
+            request = self.req_historical_data(contracts[symbol],
+                                               duration_str=chunk_duration_str,
+                                               bar_size_setting=bar_size_setting,
+                                               what_to_show=what_to_show,
+                                               end_date_time=chunk_end_date_time,
+                                               fixed_timeout=HISTORICAL_CHUNK_TIMEOUT)
+            pending[(request.connector_id, request.request_id)] = (request, symbol, chunk, attempt)
+            request.add_done_callback(done.put)
+
+        for symbol in contracts:
+            for chunk in chunks:
+                submit(symbol, chunk, 0)
+
+        while len(pending) > 0 or len(delayed) > 0:
+            now = time.monotonic()
+            for retry in [retry for retry in delayed if retry[0] <= now]:
+                delayed.remove(retry)
+                submit(*retry[1:])
+            try:
+                request = done.get(timeout=1)
+            except Empty:
+                self.cancel_overdue_historical_data([request for request, _, _, _ in pending.values()])
+                continue
+            key = (request.connector_id, request.request_id)
+            if not key in pending:
+                continue
+            _, symbol, chunk, attempt = pending.pop(key)
+            if request.is_finished():
+                frames[symbol].append(self.get_historical_data(request.connector_id, request.request_id))
+            elif not is_no_data_error(request):
+                partial = self.get_historical_data(request.connector_id, request.request_id, incomplete=True)
+                frames[symbol].append(partial)
+                chunk_end_date_time, chunk_duration_str = chunk
+                resume_duration_str = remaining_duration(partial, chunk_end_date_time, chunk_duration_str, bar_size_setting, LOCAL_TIMEZONE)
+                if resume_duration_str is None:
+                    continue
+                if attempt < retries:
+                    backoff = HISTORICAL_PACING_BACKOFF if is_pacing_error(request) else HISTORICAL_CHUNK_BACKOFF * 2 ** attempt
+                    delayed.append((time.monotonic() + backoff, symbol, (chunk_end_date_time, resume_duration_str), attempt + 1))
+                else:
+                    gap_start = missing_window_start(partial, chunk_end_date_time, chunk_duration_str, LOCAL_TIMEZONE)
+                    previous_gap_start = incomplete_from.get(symbol, gap_start)
+                    incomplete_from[symbol] = gap_start if previous_gap_start is None or gap_start is None else min(gap_start, previous_gap_start)
+
+        collected_data = {}
+        for symbol in contracts:
+            historical_data = stitch_bars(frames[symbol])
+            if not historical_data is None and localize:
+                historical_data = localize_historical_data(historical_data)
+            if not historical_data is None:
+                historical_data.index.name = 'Date'
+                historical_data.attrs["complete"] = not symbol in incomplete_from
+                historical_data.attrs["incomplete_from"] = incomplete_from.get(symbol)
+            collected_data[symbol] = historical_data
+        if not panel is None:
+            return historical_panel(collected_data, fill=fill, as_array=(panel == "array"))
+        return collected_data
+
+    def iter_ib_historical_data(self, symbols, duration_str, bar_size_setting, what_to_show='TRADES', end_date_time='', localize=True,
+                                deadline=None, max_in_memory=HISTORICAL_STREAM_IN_MEMORY, sink=None):
+        # generator of (symbol, DataFrame or None) in the order of completion
+        # symbols: list of stock symbols or dict symbol -> contract
+        # deadline: seconds for the whole retrieval, unfinished requests are cancelled and yielded as None
+        # max_in_memory: max number of requests in flight or waiting to be consumed
+        # sink: callable (symbol, DataFrame), e.g. ParquetSink, HDF5Sink, called before the frame is yielded
+        contracts = symbols if isinstance(symbols, dict) else {symbol: stocks_contract(symbol) for symbol in symbols}
+        waiting = list(contracts)
+        deadline_time = None if deadline is None else time.monotonic() + deadline
+        done = Queue()
+        in_flight = {}  # (connector_id, request_id) -> (request, symbol)
+        while len(waiting) > 0 or len(in_flight) > 0:
+            while len(waiting) > 0 and len(in_flight) < max_in_memory:
+                symbol = waiting.pop(0)
+                request = self.req_historical_data(contracts[symbol],
+                                                   duration_str=duration_str,
+                                                   bar_size_setting=bar_size_setting,
+                                                   what_to_show=what_to_show,
+                                                   end_date_time=end_date_time,
+                                                   timeout_load_factor=min(len(contracts), max_in_memory))
+                in_flight[(request.connector_id, request.request_id)] = (request, symbol)
+                request.add_done_callback(done.put)
+
+            if not deadline_time is None and time.monotonic() >= deadline_time:
+                for request, symbol in list(in_flight.values()):
+                    self.cancel_historical_data(request, "Deadline")
+                    if request.is_unfinished():
+                        request.set_cancelled("Deadline")
+                    yield symbol, None
+                for symbol in waiting:
+                    yield symbol, None
+                return
+
+            wait = 1 if deadline_time is None else min(max(deadline_time - time.monotonic(), 0), 1)
+            try:
+                request = done.get(timeout=wait)
+            except Empty:
+                self.cancel_overdue_historical_data([request for request, _ in in_flight.values()])
+                continue
+            key = (request.connector_id, request.request_id)
+            if not key in in_flight:
+                continue
+            _, symbol = in_flight.pop(key)
+
+            historical_data = self.get_historical_data(request.connector_id, request.request_id)
+            request.collected_data = [] # the frame is the only copy from now on
+            if historical_data is None or len(historical_data) == 0:
+                yield symbol, None
+                continue
+            if localize:
+                historical_data = localize_historical_data(historical_data)
+            historical_data.index.name = 'Date'
+            if not sink is None:
+                sink(symbol, historical_data)
+            yield symbol, historical_data
+
+    def retrieve_historical_ticks(self, contract, start_time, end_time=None, what_to_show="TRADES", use_rth=0, timeout=HISTORICAL_TICKS_TIMEOUT):
+        # TickBuffer of the ticks between start_time and end_time (naive times are UTC, default end is now)
+        # pages of 1000 ticks are requested one after another, the ticks repeated on the pages boundary are skipped
+        # a page which timed out or failed stops the retrieval: ticks.complete is False and ticks.incomplete_from is where the gap starts
+        start_time = start_time if not start_time.tzinfo is None else UTC.localize(start_time)
+        end_time = datetime.now(tz=UTC) if end_time is None else (end_time if not end_time.tzinfo is None else UTC.localize(end_time))
+        end_eastern = end_time.astimezone(EASTERN).replace(tzinfo=None)
+        ticks = TickBuffer(HISTORICAL_TICKS_TYPES[what_to_show])
+        cursor = start_time
+        last_tick_time, ticks_at_last_time = None, 0
+        while cursor < end_time:
+            request = self.req_historical_ticks(contract, start_date_time=format_end_date_time(cursor), what_to_show=what_to_show,
+                                                number_of_ticks=HISTORICAL_TICKS_PAGE, use_rth=use_rth)
+            if not wait_request(request, timeout) or not request.is_finished():
+                ticks.complete = False
+                ticks.incomplete_from = cursor
+                break
+            page = request.get_data()
+            skip = 0
+            while skip < len(page) and skip < ticks_at_last_time and page[skip][0] == last_tick_time:
+                skip += 1
+            new_ticks = [tick for tick in page[skip:] if tick[0] <= end_eastern]
+            ticks.extend(new_ticks)
+            if len(new_ticks) == 0 or len(page) < HISTORICAL_TICKS_PAGE or page[-1][0] > end_eastern:
+                if len(page) >= HISTORICAL_TICKS_PAGE and len(new_ticks) == 0: # the whole page is in one second
+                    cursor += timedelta(seconds=1)
+                    last_tick_time, ticks_at_last_time = None, 0
+                    continue
+                break
+            page_last_time = new_ticks[-1][0]
+            ticks_at_last_time = sum(1 for tick in new_ticks if tick[0] == page_last_time) + (ticks_at_last_time if page_last_time == last_tick_time else 0)
+            last_tick_time = page_last_time
+            cursor = EASTERN.localize(page_last_time).astimezone(UTC)
+        return ticks
+
     def retrieve_contract_details(self, contract):
         request = self.req_contract_details(contract)
-        count = CONTRACT_DETAILS_CHECK_TIMEOUT
-        while count > 0:
-            if request.properties['Finished']:
-                return request.get_data()[0]
-            if request.properties['Cancelled']:
-                return None
-            time.sleep(CONTRACT_DETAILS_CHECK_SLEEP)
-            count -= CONTRACT_DETAILS_CHECK_SLEEP
+        wait_request(request, CONTRACT_DETAILS_CHECK_TIMEOUT)
+        if request.properties['Finished'] and len(request.get_data()) > 0:
+            return request.get_data()[0]
         return None
 
     def contract_details_check(self, contract):
         request = self.req_contract_details(contract)
-        count = CONTRACT_DETAILS_CHECK_TIMEOUT
-        while count > 0:
-            if request.properties['Finished']:
-                return True
-            if request.properties['Cancelled']:
-                return False
-            time.sleep(CONTRACT_DETAILS_CHECK_SLEEP)
-            count -= CONTRACT_DETAILS_CHECK_SLEEP
-        return False
+        wait_request(request, CONTRACT_DETAILS_CHECK_TIMEOUT)
+        return request.properties['Finished'] and len(request.get_data()) > 0
+
+    def qualify_contracts(self, contracts, max_in_flight=None, timeout=CONTRACT_DETAILS_CHECK_TIMEOUT):
+        # generator of (position, status, contract details list) in the order of completion
+        # status: "ok", "ambiguous", "not found", "error", "timeout" (per contract timeout)
+        contracts = list(contracts)
+        if max_in_flight is None:
+            max_in_flight = QUALIFY_IN_FLIGHT_PER_CONNECTOR * max(len(self.request_types.get("reqContractDetails", [])), 1)
+        done = Queue()
+        in_flight = {}  # (connector_id, request_id) -> (request, position, deadline), in the order of sending
+        next_position = 0
+        while next_position < len(contracts) or len(in_flight) > 0:
+            while next_position < len(contracts) and len(in_flight) < max_in_flight:
+                request = self.req_contract_details(contracts[next_position])
+                in_flight[(request.connector_id, request.request_id)] = (request, next_position, time.monotonic() + timeout)
+                request.add_done_callback(done.put)
+                next_position += 1
+
+            _, _, oldest_deadline = next(iter(in_flight.values()))
+            try:
+                request = done.get(timeout=max(oldest_deadline - time.monotonic(), 0))
+            except Empty:
+                request, _, _ = next(iter(in_flight.values()))
+                request.set_cancelled("TimedOut")
+                continue
+            key = (request.connector_id, request.request_id)
+            if not key in in_flight:
+                continue
+            _, position, _ = in_flight.pop(key)
+            yield position, contract_details_status(request), request.get_data()
 
     def retrieve_option_parameters(self, symbol):
         option_symbol = {}
@@ -217,6 +498,48 @@ class IBLayer(ConnectionMatrix):
 
         return option_symbol
 
+    def retrieve_underlying_price(self, symbol):
+        prices = self.get_current_price(symbol)
+        if not prices is None:
+            last = prices.loc[prices.type.isin(["LAST", "DELAYED_LAST"]), "price"]
+            if len(last) > 0:
+                return float(last.iloc[-1])
+        daily = self.retrieve_ib_historical_data([symbol], "2 D", "1 day", localize=False)[symbol]
+        if daily is None:
+            return None
+        return float(daily["close"].iloc[-1])
+
+    def build_option_lattice(self, symbol, option_symbol=None, min_days=0, max_days=LATTICE_MAX_DAYS, strike_band=LATTICE_STRIKE_BAND,
+                             rights=("C", "P"), underlying_price=None):
+        # qualifies the expirations x strikes around ATM x rights lattice and fills option_symbol['contracts']
+        # with resolved contracts keyed by (strike, right, expiration), non-existing strikes are dropped
+        if option_symbol is None:
+            option_symbol = self.retrieve_option_parameters(symbol)
+            if option_symbol is None:
+                return None
+        if underlying_price is None:
+            underlying_price = self.retrieve_underlying_price(symbol)
+            if underlying_price is None:
+                return None
+
+        today = datetime.now(tz=JERUSALEM).astimezone(EASTERN).date()
+        first_date, last_date = today + timedelta(days=min_days), today + timedelta(days=max_days)
+        expirations = [e for e in option_symbol['expirations'] if first_date <= datetime.strptime(e, "%Y%m%d").date() <= last_date]
+        low, high = underlying_price * (1 - strike_band), underlying_price * (1 + strike_band)
+        strikes = [strike for strike in option_symbol['all_strikes'] if low <= strike <= high]
+
+        lattice_keys = [(strike, right, expiration) for expiration in expirations for strike in strikes for right in rights]
+        lattice_contracts = [option_contract(symbol, strike, expiration, str(option_symbol['multiplier']), right) for strike, right, expiration in lattice_keys]
+        contracts = {}
+        for position, status, contract_details in self.qualify_contracts(lattice_contracts):
+            if status == "ok":
+                contracts[lattice_keys[position]] = contract_details[0].contract
+        option_symbol['contracts'] = contracts
+        option_symbol['strikes'] = sorted({strike for strike, _, _ in contracts})
+        option_symbol['lattice_expirations'] = sorted({expiration for _, _, expiration in contracts})
+        option_symbol['underlying_price'] = underlying_price
+        return option_symbol
+
     # def request_option_contract_market_data(self, contract):
     #     request = self.ib_client.req_market_data(some_listener_for_options, contract)
     #     return request
@@ -225,20 +548,7 @@ class IBLayer(ConnectionMatrix):
         return True
 
     def request_assets(self, assets_to_request, listener_for_assets):
-        already_requested = []
-        for request in self.active_requests():
-            if request.request_type != "reqMktData" or request.request_sec_type() != "STK":
-                continue
-            request_symbol = request.request_symbol()
-            if not request_symbol in assets_to_request:
-                self.cancel_market_data(request, "Unselected")
-            else:
-                already_requested.append(request_symbol)
-
-        for symbol in assets_to_request:
-            if not symbol in already_requested:
-                asset_contract = stocks_contract(symbol)
-                self.req_market_data(listener_for_assets, asset_contract, is_busy=self.is_request_busy_dumb)
+        self.set_desired_subscriptions("STK", assets_to_request, listener_for_assets, is_busy=self.is_request_busy_dumb)
 
     def is_it_worth_to_cancel_request(self, request):
         return ((request.is_busy is None or not request.is_busy(request))
@@ -246,44 +556,40 @@ class IBLayer(ConnectionMatrix):
                      or self.request_counters[request.request_type].queue.qsize() > 0))
 
     def request_options(self, options_to_request, all_options, listener_for_options, is_busy):
-        # print(options_to_request)
-        already_requested = []
-        for request in self.active_requests():
-            if request.request_type != "reqMktData" or request.request_sec_type() != "OPT":
-                continue
-            request_symbol = request.request_symbol()
-            # print(request_symbol)
-            if not request_symbol in options_to_request:
-                if self.is_it_worth_to_cancel_request(request):
-                    self.cancel_market_data(request, "Unselected")
-            else:
-                already_requested.append(request_symbol)
-
-        for symbol, strike in options_to_request:
-            if (symbol, strike) not in already_requested and not self.check_request_in_the_queue("reqMktData", (symbol, strike)):
-                contract = all_options[symbol]["contracts"][strike]
-                self.req_market_data(listener_for_options, contract, is_busy=is_busy)
+        # options_to_request: (symbol, strike, right, expiration) keys, contracts are taken from the build_option_lattice
+        # all_options[symbol]["contracts"][(strike, right, expiration)]
+        self.set_desired_subscriptions("OPT", options_to_request, listener_for_options,
+                                       contracts=lambda key: all_options[key[0]]["contracts"][key[1:]],
+                                       is_busy=is_busy, cancel_check=self.is_it_worth_to_cancel_request)
 
     def cancel_all_requests(self):
-        for request in self.global_requests.values():
-            if not request.is_active():
-                continue
-            if request.request_type == "reqHistoricalData":
-                self.cancel_historical_data(request, "Finish")
-            elif request.request_type == "reqMktData":
-                self.cancel_market_data(request, "Finish")
+        for request in self.global_requests.requests_by_type("reqHistoricalData", "active"):
+            self.cancel_historical_data(request, "Finish")
+        for request in self.global_requests.requests_by_type("reqMktData", "active"):
+            self.cancel_market_data(request, "Finish")
+        for request in self.global_requests.requests_by_type("reqMktDepth", "active"):
+            self.cancel_market_depth(request, "Finish")
+        for request in self.global_requests.requests_by_type("reqTickByTickData", "active"):
+            self.cancel_tick_by_tick_data(request, "Finish")
 
     def get_current_price(self, symbol):
         if not symbol in self.market_requests_by_symbol:
             return None
         request = self.market_requests_by_symbol[symbol]
-        return pd.DataFrame.from_records(request.get_data(), columns=['datetime', 'type', 'price'], index='datetime')
+        prices = request.tick_prices.to_frame().rename(columns={'value': 'price'})
+        prices.index.name = 'datetime'
+        prices['type'] = prices['type'].astype(object) # plain tick type names as before the tick buffers
+        return prices
 
     def get_option_current_price(self, symbol):
         return self.get_current_price(symbol)
 
     def retrieve_positions(self):
+        if self.position_book.is_seeded():
+            return self.position_book.to_frame()
         request = self.req_positions()
+        if request.on_get_data == self.position_book.on_position_data: # the book is being seeded
+            return self.position_book.to_frame() if self.position_book.wait_seeded(POSITION_TIMEOUT) else None
         while request.is_unfinished():
             time.sleep(1)
         if request.properties['Finished']:
@@ -294,6 +600,9 @@ class IBLayer(ConnectionMatrix):
     def retrieve_positions_multi(self, account=None):
         if account is None:
             account = self.account
+        if self.position_book.is_seeded():
+            positions = self.position_book.to_frame()
+            return positions.loc[positions.account == account].assign(modelCode="").reset_index(drop=True)
         request = self.req_positions_multi(account)
         while request.is_unfinished():
             time.sleep(1)
@@ -328,7 +637,8 @@ class IBLayer(ConnectionMatrix):
         request_stop = self.req_place_order(order_post_process, contract, stop_loss_order)
         request_parent.set_child_order_id(request_stop)
 
-        print("Buy with trailing stop", request_parent.request_id, (symbol, strike), quantity, (price, limit_price, trail_stop_price))
+        if self.verbose:
+            print("Buy with trailing stop", request_parent.request_id, (symbol, strike), quantity, (price, limit_price, trail_stop_price))
         return request_parent, request_stop
 
     def buy_call_with_stop(self, order_post_process, symbol, strike, contract, price, quantity, limit_price, stop_loss):
@@ -346,9 +656,48 @@ class IBLayer(ConnectionMatrix):
         request_stop = self.req_place_order(order_post_process, contract, stop_loss_order)
         request_parent.set_child_order_id(request_stop)
 
-        print("Buy with hard stop", request_parent.request_id, (symbol, strike), quantity, (price, limit_price, price * (1 - stop_loss)))
+        if self.verbose:
+            print("Buy with hard stop", request_parent.request_id, (symbol, strike), quantity, (price, limit_price, price * (1 - stop_loss)))
         return request_parent, request_stop
 
+    def bracket_orders(self, quantity, price, limit_price=None, stop_loss=None, stop_loss_initial=None, parent_order_id=None):
+        # parent waits (transmit=False) for its child, the child transmits the bracket; trailing stop when stop_loss_initial is given
+        if limit_price is None:
+            parent_order = market_order(action="BUY", account=self.account, total_quantity=quantity, transmit=False)
+        else:
+            parent_order = limit_order(action="BUY", account=self.account, lmt_price=limit_price, total_quantity=quantity, transmit=False)
+        if stop_loss_initial is None:
+            stop_loss_order = stop_order(action="SELL", account=self.account,
+                                         aux_price=round(price * (1 - stop_loss) + 0.005, 2),
+                                         total_quantity=quantity, parent_order_id=parent_order_id)
+        else:
+            stop_loss_order = stop_trailing_order(action="SELL", account=self.account,
+                                                  trail_stop_price=round(price * (1 - stop_loss_initial) - 0.005, 2),
+                                                  trailing_amount=round(price * stop_loss - 0.005, 2),
+                                                  total_quantity=quantity, parent_order_id=parent_order_id)
+        return parent_order, stop_loss_order
+
+    def place_bracket_batch(self, order_post_process, brackets):
+        # brackets: [(contract, quantity, {"price", "limit_price", "stop_loss", "stop_loss_initial"})]
+        # all the orders are built with their ids first, then sent parent before child, the connection throttle paces them in order
+        connector_id, connector = self.broker_api_selector("placeOrder")
+        prepared = []
+        for contract, quantity, price_parameters in brackets:
+            parent_order_id = self.next_order_id(connector_id, connector)
+            child_order_id = self.next_order_id(connector_id, connector)
+            parent_order, child_order = self.bracket_orders(quantity, parent_order_id=parent_order_id, **price_parameters)
+            prepared.append((contract, parent_order_id, parent_order, child_order_id, child_order))
+
+        batch = OrderBatch()
+        for contract, parent_order_id, parent_order, child_order_id, child_order in prepared:
+            request_parent = self.req_place_order(order_post_process, contract, parent_order, order_id=parent_order_id, connector_id=connector_id)
+            request_child = self.req_place_order(order_post_process, contract, child_order, order_id=child_order_id, connector_id=connector_id)
+            request_parent.set_child_order_id(request_child)
+            batch.add(request_parent, request_child)
+        if self.verbose:
+            print("Bracket batch", [request_parent.request_id for request_parent in batch.parents()], len(batch.brackets))
+        return batch
+
     def buy_call_limit(self, order_post_process, symbol, strike, contract, price, quantity, limit_price=None):
         if limit_price is None:
             order = market_order(action="BUY", account=self.account,
@@ -359,32 +708,34 @@ class IBLayer(ConnectionMatrix):
                                 total_quantity=quantity)
         request_order = self.req_place_order(order_post_process, contract, order)
 
-        print("Buy with limit no stops", request_order.request_id, (symbol, strike), quantity, (price, limit_price))
+        if self.verbose:
+            print("Buy with limit no stops", request_order.request_id, (symbol, strike), quantity, (price, limit_price))
         return request_order
 
     def sell_call_contract(self, order_post_process, contract, quantity):
         order = market_order(action="SELL", account=self.account, total_quantity=quantity)
         request = self.req_place_order(order_post_process, contract, order)
-        print("Sell", request.request_id, request.request_symbol(), quantity)
+        if self.verbose:
+            print("Sell", request.request_id, request.request_symbol(), quantity)
         return request
 
     def buy_call_contract(self, order_post_process, contract, quantity):
         order = market_order(action="BUY", account=self.account, total_quantity=quantity)
         request = self.req_place_order(order_post_process, contract, order)
-        print("Buy", request.request_id, request.request_symbol(), quantity)
+        if self.verbose:
+            print("Buy", request.request_id, request.request_symbol(), quantity)
         return request
 
     def cancel_all_orders(self):
-        for request in self.global_requests.values():
-            if request.request_type == "placeOrder":
-                if not request.is_active():
-                    continue
-                self.req_cancel_order(request, "Finish")
+        for request in self.open_orders():
+            self.req_cancel_order(request, "Finish")
 
 # req = ib.buy_call_contract(renew_mill.order_post_process, my_context["options"]['AAPL']["contracts"][150], 1)
 # ib.req_cancel_order(req)
 
     def retrieve_accounts_summary(self):
+        if self.account_cache.is_seeded() or (not self.account_cache_request() is None and self.account_cache.wait_seeded(POSITION_TIMEOUT)):
+            return self.account_cache.to_frame()
         request = self.req_account_summary(tags="TotalCashValue, SettledCash, AccruedCash, BuyingPower, EquityWithLoanValue, PreviousEquityWithLoanValue, GrossPositionValue")
         while request.is_unfinished():
             time.sleep(1)
@@ -394,7 +745,15 @@ class IBLayer(ConnectionMatrix):
             return pd.DataFrame.from_records(request.get_data(), columns=columns)
         return None
 
+    def set_risk_limits(self, currency=None, **limits):
+        # the min_cash limit reads the cash in the layer currency by default
+        return super().set_risk_limits(currency=currency or self.currency, **limits)
+
     def get_account_cash_total_value(self):
+        if self.account_cache.is_seeded() or (not self.account_cache_request() is None and self.account_cache.wait_seeded(POSITION_TIMEOUT)):
+            value = self.account_cache.get(self.account, "TotalCashValue", self.currency)
+            if not value is None:
+                return value
         accounts_summary = self.retrieve_accounts_summary()
         return float(accounts_summary.loc[(accounts_summary.account == self.account)
                                           & (accounts_summary.currency == self.currency)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Negative cache of failed requests
+Requests which are known to fail (invalid contract, no data, no subscription) fail locally until the error expires
+"""
+
+import time
+from threading import Lock
+from .contracts import contract_key
+from .errors import negative_cache_ttls
+
+def negative_cache_detail(request_type, parameters):
+    # historical "no data" depends on the query, not only on the contract
+    if request_type == "reqHistoricalData":
+        return (parameters["whatToShow"], parameters["barSizeSetting"], parameters["durationStr"], parameters["endDateTime"], parameters["useRTH"])
+    return None
+
+def is_cacheable_error(error_code, error_string):
+    if error_code == 162: # pacing violations and cancelled queries come with 162 too
+        return "no data" in error_string
+    return error_code in negative_cache_ttls()
+
+class NegativeCache():
+    # (request type, contract key, detail) -> (expiry time, error code, error string), request type None matches every type
+    # keyed on the request type and parameters, so a request can be looked up before a connector and an id are taken for it
+    def __init__(self, ttls=None):
+        self.ttls = ttls if not ttls is None else negative_cache_ttls()
+        self.entries = {}
+        self.hits = {}  # (request type, error code) -> count
+        self.misses = 0
+        self.stored = 0
+        self.lock = Lock()
+
+    def request_keys(self, request_type, request_parameters):
+        if request_parameters is None or not "contract" in request_parameters:
+            return None
+        key = contract_key(request_parameters["contract"])
+        return (None, key, None), (request_type, key, negative_cache_detail(request_type, request_parameters))
+
+    def add(self, request, error_code, error_string=""):
+        if not error_code in self.ttls or not is_cacheable_error(error_code, error_string):
+            return
+        keys = self.request_keys(request.request_type, request.request_parameters)
+        if keys is None:
+            return
+        with self.lock:
+            self.entries[keys[0] if error_code == 200 else keys[1]] = (time.monotonic() + self.ttls[error_code], error_code, error_string)
+            self.stored += 1
+
+    def lookup(self, request_type, request_parameters):
+        # (error code, error string) of a known failure or None
+        keys = self.request_keys(request_type, request_parameters)
+        if keys is None:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] < now:
+                    del self.entries[key]
+                    continue
+                hit_key = (request_type, entry[1])
+                self.hits[hit_key] = self.hits.get(hit_key, 0) + 1
+                return entry[1], entry[2]
+            self.misses += 1
+        return None
+
+    def invalidate(self, contract=None):
+        with self.lock:
+            if contract is None:
+                self.entries.clear()
+                return
+            key = contract_key(contract)
+            for entry_key in [entry_key for entry_key in self.entries if entry_key[1] == key]:
+                del self.entries[entry_key]
+
+    def statistics(self):
+        with self.lock:
+            return {"entries": len(self.entries), "stored": self.stored, "misses": self.misses,
+                    "hits": sum(self.hits.values()), "hits_by_type": dict(self.hits)}
@@ -5,6 +5,7 @@ Orders collection
 
 """
 
+from copy import copy, deepcopy
 from ibapi.order import Order
 
 def market_order(action, account, total_quantity, transmit=True):
@@ -66,3 +67,32 @@ def stop_trailing_order(action, account, trailing_percent=None, trail_stop_price
     order.transmit = transmit
     order.parentId = parent_order_id
     return order
+
+class OrderTemplate():
+    # prebuilt order, make() copies it and sets the per-order fields only
+    # the list fields (algoParams, orderComboLegs, conditions, ...) are copied too, so the orders don't share them
+    def __init__(self, order):
+        self.order = order
+        self.list_fields = [name for name, value in vars(order).items() if isinstance(value, (list, dict))]
+
+    def make(self, total_quantity=None, lmt_price=None, aux_price=None, **fields):
+        order = copy(self.order)
+        for name in self.list_fields:
+            setattr(order, name, deepcopy(getattr(self.order, name)))
+        if not total_quantity is None:
+            order.totalQuantity = total_quantity
+        if not lmt_price is None:
+            order.lmtPrice = lmt_price
+        if not aux_price is None:
+            order.auxPrice = aux_price
+        for name, value in fields.items():
+            setattr(order, name, value)
+        return order
+
+def amended_order(order, changes):
+    # the amendment is transmitted even if the original order waited for its child to transmit the bracket
+    order = copy(order)
+    for name, value in changes.items():
+        setattr(order, name, value)
+    order.transmit = True
+    return order
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Live position book and account cache
+Seeded from reqPositions, kept up to date by the position stream and execDetails fills
+Account summary and PnL are kept by always-on reqAccountSummary / reqPnL / reqPnLSingle subscriptions
+"""
+
+from datetime import datetime
+from threading import Lock, Event
+import pytz
+from tzlocal import get_localzone_name
+import pandas as pd
+
+ACCOUNT_SUMMARY_TAGS = "TotalCashValue,SettledCash,AccruedCash,BuyingPower,EquityWithLoanValue,PreviousEquityWithLoanValue,GrossPositionValue,NetLiquidation,AvailableFunds,ExcessLiquidity"
+PNL_TAGS = ("DailyPnL", "UnrealizedPnL", "RealizedPnL")
+PNL_SINGLE_TAGS = ("Position", "DailyPnL", "UnrealizedPnL", "RealizedPnL", "Value")
+UNSET_DOUBLE = 1.7976931348623157e308 # IB sends the max double for the values which are not available
+POSITION_COLUMNS = ['account', 'symbol', 'strike', 'secType', 'lastTradeDateOrContractMonth', 'position', 'avgCost', 'contract']
+LOCAL_TIMEZONE = pytz.timezone(get_localzone_name()) # of the execution times without a time zone, TWS runs on this machine
+
+def position_key(account, contract):
+    return (account, contract.conId)
+
+def execution_time(time_str):
+    # UTC time of Execution.time: "20240102  10:15:30" (TWS time zone), "20240102 10:15:30 US/Eastern" or "20240102-15:15:30" (UTC), None if unknown
+    parts = time_str.split()
+    if len(parts) == 0:
+        return None
+    try:
+        if len(parts) == 1:
+            return pytz.UTC.localize(datetime.strptime(parts[0], "%Y%m%d-%H:%M:%S"))
+        timezone = pytz.timezone(parts[2]) if len(parts) > 2 else LOCAL_TIMEZONE
+        return timezone.localize(datetime.strptime(parts[0] + " " + parts[1], "%Y%m%d %H:%M:%S")).astimezone(pytz.UTC)
+    except (ValueError, pytz.UnknownTimeZoneError):
+        return None
+
+def contract_multiplier(contract):
+    try:
+        return float(contract.multiplier) if contract.multiplier else 1.0
+    except ValueError:
+        return 1.0
+
+class PositionBook():
+    # (account, conId) -> [position, avgCost, contract], avgCost includes the multiplier as IB reports it
+    # listeners get (account, contract, position, avgCost) for the current records when added and on every change
+    def __init__(self):
+        self.positions = {}
+        self.lock = Lock()
+        self.seeded = Event()
+        self.exec_ids = set()
+        self.position_times = {}  # (account, conId) -> UTC time of the last position callback
+        self.listeners = []
+        self.tracks_executions = False  # execDetails reach on_execution
+        self.version = 0
+        self._frame = None
+        self._frame_version = -1
+
+    def add_listener(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                return
+            self.listeners.append(listener)
+            for (account, _), (position, avg_cost, contract) in self.positions.items():
+                listener(account, contract, position, avg_cost)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def notify(self, account, contract, position, avg_cost): # under lock, the listeners see the changes in order
+        for listener in self.listeners:
+            listener(account, contract, position, avg_cost)
+
+    def on_position(self, account, contract, position, avg_cost): # the position stream is authoritative
+        with self.lock:
+            self.positions[position_key(account, contract)] = [float(position), avg_cost, contract]
+            self.position_times[position_key(account, contract)] = datetime.now(tz=pytz.UTC)
+            self.version += 1
+            self.notify(account, contract, float(position), avg_cost)
+
+    def on_position_data(self, data_piece, data_type=None): # on_get_data of the reqPositions request
+        account, _, _, _, _, position, avg_cost, contract = data_piece
+        self.on_position(account, contract, position, avg_cost)
+
+    def on_execution(self, contract, execution):
+        # optimistic update until the next position callback, replayed executions are skipped
+        # IB may send the position which already includes a fill before its execDetails, so executions
+        # not newer than the last position of the contract are skipped, IB sends a position update after each fill anyway
+        if execution.execId in self.exec_ids:
+            return
+        shares = float(execution.shares) if execution.side == "BOT" else -float(execution.shares)
+        cost = execution.price * contract_multiplier(contract)
+        fill_time = execution_time(execution.time)
+        with self.lock:
+            self.exec_ids.add(execution.execId)
+            key = position_key(execution.acctNumber, contract)
+            position_time = self.position_times.get(key)
+            if not fill_time is None and not position_time is None and fill_time <= position_time:
+                return
+            position, avg_cost, known_contract = self.positions.get(key, [0.0, 0.0, contract])
+            new_position = position + shares
+            if new_position == 0:
+                avg_cost = 0.0
+            elif position == 0 or (position > 0) != (new_position > 0): # opened or flipped
+                avg_cost = cost
+            elif abs(new_position) > abs(position): # added to the position
+                avg_cost = (avg_cost * position + cost * shares) / new_position
+            self.positions[key] = [new_position, avg_cost, known_contract]
+            self.version += 1
+            self.notify(execution.acctNumber, known_contract, new_position, avg_cost)
+
+    def set_seeded(self, request=None):
+        self.seeded.set()
+
+    def is_seeded(self):
+        return self.seeded.is_set()
+
+    def wait_seeded(self, timeout=None):
+        return self.seeded.wait(timeout)
+
+    def get(self, account, con_id):
+        with self.lock:
+            record = self.positions.get((account, con_id))
+        return None if record is None else (record[0], record[1])
+
+    def position(self, account, contract):
+        record = self.get(account, contract.conId)
+        return 0.0 if record is None else record[0]
+
+    def to_frame(self):
+        # rebuilt only when the book changed since the last call, the returned frame is shared and must not be modified
+        with self.lock:
+            if self._frame_version == self.version:
+                return self._frame
+            records = [(account, contract.symbol, contract.strike, contract.secType, contract.lastTradeDateOrContractMonth, position, avg_cost, contract)
+                       for (account, _), (position, avg_cost, contract) in self.positions.items()]
+            version = self.version
+        frame = pd.DataFrame.from_records(records, columns=POSITION_COLUMNS)
+        with self.lock:
+            self._frame = frame
+            self._frame_version = version
+        return frame
+
+    def clear(self):
+        with self.lock:
+            for (account, _), (_, _, contract) in self.positions.items():
+                self.notify(account, contract, 0.0, 0.0)
+            self.positions.clear()
+            self.position_times.clear()
+            self.version += 1
+        self.seeded.clear()
+
+def account_value(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return value
+    return float("nan") if value == UNSET_DOUBLE else value
+
+class AccountCache():
+    # (account, tag, currency) -> value, PnL goes under the PNL_TAGS with the empty currency
+    # (account, conId) -> {tag: value} for reqPnLSingle, listeners get (key, value) on every change
+    def __init__(self):
+        self.values = {}
+        self.pnl_single = {}
+        self.listeners = []
+        self.seeded = Event()
+        self.version = 0
+
+    def add_listener(self, listener):
+        if not listener in self.listeners:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def set_value(self, key, value):
+        value = account_value(value)
+        previous_value = self.values.get(key)
+        self.values[key] = value
+        if previous_value != value and not (previous_value != previous_value and value != value): # nan is unchanged
+            self.version += 1
+            for listener in list(self.listeners):
+                listener(key, value)
+
+    def on_account_summary(self, data_piece, data_type=None): # on_get_data of the reqAccountSummary request
+        account, tag, value, currency = data_piece
+        self.set_value((account, tag, currency), value)
+
+    def on_pnl(self, account, data_piece):
+        for tag, value in zip(PNL_TAGS, data_piece):
+            self.set_value((account, tag, ""), value)
+
+    def on_pnl_single(self, account, con_id, data_piece):
+        self.pnl_single[(account, con_id)] = dict(zip(PNL_SINGLE_TAGS, (account_value(value) for value in data_piece)))
+        self.version += 1
+        for listener in list(self.listeners):
+            listener((account, con_id), self.pnl_single[(account, con_id)])
+
+    def set_seeded(self, request=None):
+        self.seeded.set()
+
+    def is_seeded(self):
+        return self.seeded.is_set()
+
+    def wait_seeded(self, timeout=None):
+        return self.seeded.wait(timeout)
+
+    def get(self, account, tag, currency="", default=None):
+        return self.values.get((account, tag, currency), default)
+
+    def get_pnl_single(self, account, con_id):
+        return self.pnl_single.get((account, con_id))
+
+    def to_frame(self):
+        return pd.DataFrame.from_records([(account, tag, value, currency) for (account, tag, currency), value in list(self.values.items())],
+                                         columns=['account', 'tag', 'value', 'currency'])
+
+    def clear(self):
+        self.values.clear()
+        self.pnl_single.clear()
+        self.version += 1
+        self.seeded.clear()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Rotating snapshot quotes for contract lists larger than the reqMktData lines budget
+"""
+
+import time
+from threading import Lock
+import numpy as np
+import pandas as pd
+
+from .contracts import contract_key
+
+SNAPSHOT_TIMEOUT = 15
+DEFAULT_MAX_STALENESS = 60
+SNAPSHOT_LINES_SHARE = 0.25 # default share of the reqMktData lines, the rest is left for the streaming subscriptions
+QUOTE_FIELDS = ("bid", "ask", "last", "close", "bid_size", "ask_size", "last_size", "volume")
+TICK_FIELDS = {"BID": "bid", "ASK": "ask", "LAST": "last", "CLOSE": "close",
+               "BID_SIZE": "bid_size", "ASK_SIZE": "ask_size", "LAST_SIZE": "last_size", "VOLUME": "volume",
+               "DELAYED_BID": "bid", "DELAYED_ASK": "ask", "DELAYED_LAST": "last", "DELAYED_CLOSE": "close",
+               "DELAYED_BID_SIZE": "bid_size", "DELAYED_ASK_SIZE": "ask_size", "DELAYED_LAST_SIZE": "last_size", "DELAYED_VOLUME": "volume"}
+
+class SnapshotQuoteEngine():
+    def __init__(self, matrix, contracts, max_staleness=DEFAULT_MAX_STALENESS, budget=None, generic_tick_list=None, continuous=True):
+        self.matrix = matrix
+        self.contracts = list(contracts)
+        self.keys = [contract_key(contract) for contract in self.contracts]
+        self.positions = {key: position for position, key in enumerate(self.keys)}
+        self.budget = budget if budget else max(int(matrix.max_requests["reqMktData"] * SNAPSHOT_LINES_SHARE), 1)
+        self.generic_tick_list = generic_tick_list
+        self.continuous = continuous  # False: request only contracts which are due by staleness
+        size = len(self.contracts)
+        self.quotes = {field: np.full(size, np.nan) for field in QUOTE_FIELDS}
+        self.updated = np.zeros(size)  # epoch time of the last completed snapshot, 0 - never
+        self.max_staleness = np.full(size, float(max_staleness))
+        self.in_flight = {}  # (connector_id, request_id) -> (request, position), request ids are per connector
+        self.is_in_flight = np.zeros(size, dtype=bool)
+        self.refreshed_in_cycle = np.zeros(size, dtype=bool)
+        self.cycle_start = None
+        self.cycle_latencies = []
+        self.counters = {"requested": 0, "completed": 0, "timed_out": 0, "failed": 0}
+        self.lock = Lock()
+
+    def set_max_staleness(self, contract, seconds):
+        self.max_staleness[self.positions[contract_key(contract)]] = seconds
+
+    def start(self):
+        self.cycle_start = time.time()
+        self.matrix.add_periodic_handler(self.pump)
+        self.pump()
+
+    def stop(self):
+        self.matrix.remove_periodic_handler(self.pump)
+        with self.lock:
+            for request, _ in list(self.in_flight.values()):
+                if request.is_active():
+                    self.matrix.cancel_market_data(request, "Finish")
+                elif request.is_unfinished():
+                    request.set_cancelled("Finish")
+            self.in_flight.clear()
+            self.is_in_flight[:] = False
+
+    def pump(self):
+        now = time.time()
+        with self.lock:
+            for key, (request, position) in list(self.in_flight.items()):
+                if not request.is_unfinished():
+                    if not request.is_finished():
+                        self.counters["failed"] += 1
+                    self._release(key, position)
+                elif request.is_active() and (request.start_time.timestamp() + SNAPSHOT_TIMEOUT < now):
+                    self.matrix.cancel_market_data(request, "TimedOut")
+                    self.counters["timed_out"] += 1
+                    self._release(key, position)
+
+            free = self.budget - len(self.in_flight)
+            if free <= 0:
+                return
+            overdue = now - self.updated - self.max_staleness
+            overdue[self.is_in_flight] = -np.inf
+            candidates = np.argsort(-overdue, kind="stable")[:free]
+            for position in candidates:
+                if overdue[position] == -np.inf or (not self.continuous and overdue[position] < 0):
+                    break
+                self._request(int(position))
+
+    def _request(self, position):
+        request = self.matrix.req_market_data(self.on_tick, self.contracts[position], generic_tick_list=self.generic_tick_list,
+                                              snapshot=True, timeout=SNAPSHOT_TIMEOUT)
+        request.on_finished = self.on_snapshot_end
+        self.in_flight[(request.connector_id, request.request_id)] = (request, position)
+        self.is_in_flight[position] = True
+        self.counters["requested"] += 1
+
+    def _release(self, key, position):
+        del self.in_flight[key]
+        self.is_in_flight[position] = False
+
+    def on_tick(self, request, data_piece, data_type):
+        field = TICK_FIELDS.get(data_piece[1])
+        in_flight = self.in_flight.get((request.connector_id, request.request_id))
+        if field is None or in_flight is None:
+            return
+        self.quotes[field][in_flight[1]] = data_piece[2]
+
+    def on_snapshot_end(self, request):
+        self.matrix.request_set_finished(request)
+        now = time.time()
+        with self.lock:
+            key = (request.connector_id, request.request_id)
+            in_flight = self.in_flight.get(key)
+            if in_flight is None:
+                return
+            position = in_flight[1]
+            self._release(key, position)
+            self.updated[position] = now
+            self.counters["completed"] += 1
+            self.refreshed_in_cycle[position] = True
+            if self.refreshed_in_cycle.all():
+                self.cycle_latencies.append(now - self.cycle_start)
+                self.cycle_start = now
+                self.refreshed_in_cycle[:] = False
+
+    def staleness(self):
+        age = time.time() - self.updated
+        age[self.updated == 0] = np.inf
+        return age
+
+    def statistics(self):
+        statistics = dict(self.counters)
+        statistics["in_flight"] = len(self.in_flight)
+        statistics["utilization"] = len(self.in_flight) / self.budget
+        statistics["cycles"] = len(self.cycle_latencies)
+        statistics["last_cycle_latency"] = self.cycle_latencies[-1] if self.cycle_latencies else None
+        statistics["mean_cycle_latency"] = float(np.mean(self.cycle_latencies)) if self.cycle_latencies else None
+        statistics["over_staleness"] = int((self.staleness() > self.max_staleness).sum())
+        return statistics
+
+    def quote_table(self):
+        table = pd.DataFrame({field: values.copy() for field, values in self.quotes.items()}, index=pd.Index(self.keys, tupleize_cols=False))
+        table["age"] = self.staleness()
+        return table
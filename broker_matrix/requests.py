@@ -7,6 +7,9 @@ reqHistoricalData
 reqContractDetails
 reqSecDefOptParams
 reqMktData
+reqMktDepth
+reqTickByTickData
+reqHistoricalTicks
 reqPositions
 reqPositionsMulti
 reqOpenOrders
@@ -15,13 +18,26 @@ reqAccountSummary
 reqManagedAccts
 """
 from datetime import datetime, timedelta
+from threading import Lock
+from time import perf_counter_ns
+import numpy as np
 
-MAX_REQUESTS = {"reqHistoricalData": 20, "reqMktData": 70}
-REQUEST_CALLS = {"reqHistoricalData": "_req_historical_data", "reqMktData": "_req_market_data"}
-REQUEST_CANCEL_CALLS = {"reqHistoricalData": "cancel_historical_data", "reqMktData": "cancel_market_data",
+from .buffers import BarBuffer, TickBuffer
+from .depth import OrderBook
+
+MAX_REQUESTS = {"reqHistoricalData": 20, "reqMktData": 70, "reqTickByTickData": 3, "reqMktDepth": 3}
+REQUEST_CALLS = {"reqHistoricalData": "_req_historical_data", "reqMktData": "_req_market_data", "reqTickByTickData": "_req_tick_by_tick_data",
+                 "reqMktDepth": "_req_market_depth"}
+REQUEST_CANCEL_CALLS = {"reqHistoricalData": "cancel_historical_data", "reqMktData": "cancel_market_data", "reqMktDepth": "cancel_market_depth",
+                        "reqTickByTickData": "cancel_tick_by_tick_data", "reqHistoricalTicks": None,
                         "reqContractDetails": None, "reqSecDefOptParams": None, "reqPositions": "req_cancel_positions",
                         "reqPositionsMulti": "req_cancel_positions_multi", "reqOpenOrders": None,
-                        "reqAccountSummary": "req_cancel_account_summary", "reqManagedAccts": None}
+                        "reqAccountSummary": "req_cancel_account_summary", "reqPnL": "cancel_pnl", "reqPnLSingle": "cancel_pnl_single", "reqManagedAccts": None}
+REQUEST_STATES = ("queued", "active", "finished")
+ORDER_STATES = ("Submitted", "PartiallyFilled", "Filled", "Cancelled", "Inactive")
+ORDER_TERMINAL_STATES = ("Filled", "Cancelled", "Inactive")
+ORDER_STATUS_STATES = {"ApiPending": "Submitted", "PendingSubmit": "Submitted", "PreSubmitted": "Submitted", "Submitted": "Submitted",
+                       "PendingCancel": "Submitted", "ApiCancelled": "Cancelled", "Cancelled": "Cancelled", "Filled": "Filled", "Inactive": "Inactive"}
 
 class Request():
     def __init__(self, request_id, connector_id, request_type, request_parameters, timeout=None):
@@ -42,6 +58,9 @@ class Request():
         self.on_error = None
         self.on_get_data_postprocess = None
         self.is_busy = None
+        self.state_listener = None
+        self.registry_state = None
+        self.done_callbacks = []
 
     def set_handlers(self, on_get_data=None, on_finished=None, on_timeout=None, on_error=None, on_get_data_postprocess=None, is_busy=None):
         if on_get_data:
@@ -68,10 +87,34 @@ class Request():
         else:
             self.timeout_time = None
         self.properties["Started"] = True
+        self.notify_state()
 
     def is_active(self):
         return self.properties["Started"] and not (self.properties["TimedOut"] or self.properties["Finished"] or self.properties["Cancelled"])
 
+    def state(self):
+        if not self.properties["Started"]:
+            return "queued" if self.is_unfinished() else "finished"
+        return "active" if self.is_active() else "finished"
+
+    def notify_state(self):
+        if not self.state_listener is None:
+            self.state_listener(self)
+
+    def add_done_callback(self, callback): # called once the request is finished or cancelled
+        self.done_callbacks.append(callback)
+        if not self.is_unfinished() and callback in self.done_callbacks:
+            self.done_callbacks.remove(callback)
+            callback(self)
+
+    def notify_done(self):
+        while len(self.done_callbacks) > 0:
+            try:
+                callback = self.done_callbacks.pop(0)
+            except IndexError: # taken by another thread
+                break
+            callback(self)
+
     def is_unfinished(self):
         return not self.properties['Finished'] and not self.properties['Cancelled']
 
@@ -84,12 +127,16 @@ class Request():
     def set_finished(self):
         self.end_time = datetime.now()
         self.properties["Finished"] = True
+        self.notify_state()
+        self.notify_done()
 
     def set_cancelled(self, reason=None):
         self.end_time = datetime.now()
         if not reason is None:
             self.properties["Reason"] = reason
         self.properties["Cancelled"] = True
+        self.notify_state()
+        self.notify_done()
 
     def is_finished(self):
         return self.properties["Finished"]
@@ -104,29 +151,182 @@ class Request():
         return self.request_parameters["contract"].secType
 
     def request_symbol(self):
-        if not "contract" in self.request_parameters:
+        if self.request_parameters is None or not "contract" in self.request_parameters:
             return None
         if self.request_parameters["contract"].secType == "OPT":
             return (self.request_parameters["contract"].symbol, self.request_parameters["contract"].strike)
         return self.request_parameters["contract"].symbol
 
+class RequestRegistry(dict):
+    # (connector_id, request_id) -> request, with indexes by type, by state and by (type, symbol)
+    # index values are dicts used as insertion-ordered sets
+    def __init__(self):
+        super().__init__()
+        self.lock = Lock()
+        self.by_type = {}
+        self.by_state = {state: {} for state in REQUEST_STATES}
+        self.by_type_symbol = {}
+
+    def __setitem__(self, key, request):
+        with self.lock:
+            if key in self:
+                self._unindex(key, self[key])
+            super().__setitem__(key, request)
+            self.by_type.setdefault(request.request_type, {})[key] = request
+            self.by_type_symbol.setdefault((request.request_type, request.request_symbol()), {})[key] = request
+            request.registry_state = request.state()
+            self.by_state[request.registry_state][key] = request
+            request.state_listener = self.update_state
+
+    def __delitem__(self, key):
+        with self.lock:
+            self._unindex(key, self[key])
+            super().__delitem__(key)
+
+    def _unindex(self, key, request):
+        self.by_type.get(request.request_type, {}).pop(key, None)
+        self.by_type_symbol.get((request.request_type, request.request_symbol()), {}).pop(key, None)
+        self.by_state[request.registry_state].pop(key, None)
+        request.state_listener = None
+
+    def update_state(self, request):
+        key = (request.connector_id, request.request_id)
+        with self.lock:
+            if self.get(key) is not request:
+                return
+            state = request.state()
+            if state == request.registry_state:
+                return
+            self.by_state[request.registry_state].pop(key, None)
+            self.by_state[state][key] = request
+            request.registry_state = state
+
+    def requests_by_state(self, state):
+        with self.lock:
+            return list(self.by_state[state].values())
+
+    def requests_by_type(self, request_type, state=None):
+        with self.lock:
+            requests = self.by_type.get(request_type, {})
+            if state is None:
+                return list(requests.values())
+            if len(requests) <= len(self.by_state[state]):
+                return [request for request in requests.values() if request.registry_state == state]
+            return [request for request in self.by_state[state].values() if request.request_type == request_type]
+
+    def requests_by_symbol(self, request_type, request_symbol, state=None):
+        with self.lock:
+            requests = self.by_type_symbol.get((request_type, request_symbol), {})
+            return [request for request in requests.values() if state is None or request.registry_state == state]
+
 class MarketDataStreamRequest(Request):
+    # the ticks are kept in TickBuffers, collected_data and collected_tick_sizes build the (time, type, value) lists from them
     def __init__(self, request_id, connector_id, request_type, request_parameters, timeout=None):
         super().__init__(request_id, connector_id, request_type, request_parameters, timeout)
         self.collected_tick_sizes = []
 
+    @property
+    def collected_data(self):
+        return self.tick_prices.records()
+
+    @collected_data.setter
+    def collected_data(self, ticks): # Request.__init__ sets the empty list
+        self.tick_prices = TickBuffer("market")
+        self.tick_prices.extend(ticks)
+
+    @property
+    def collected_tick_sizes(self):
+        return self.tick_sizes.records()
+
+    @collected_tick_sizes.setter
+    def collected_tick_sizes(self, ticks):
+        self.tick_sizes = TickBuffer("market")
+        self.tick_sizes.extend(ticks)
+
     def add_data(self, data_piece, data_type=None):
         if not self.is_active():
             # print("got data for inactive request", data_piece, self.request_id, self.request_symbol(), self.properties)
             return
         if data_type == "price":
-            self.collected_data.append(data_piece)
+            self.tick_prices.append(*data_piece)
             self.on_get_data_postprocess(self, data_piece, data_type)
         elif data_type == "size":
-            self.collected_tick_sizes.append(data_piece)
+            self.tick_sizes.append(*data_piece)
             self.on_get_data_postprocess(self, data_piece, data_type)
 
+    def get_data(self):
+        return self.tick_prices.records()
+
+    def get_tick_sizes(self):
+        return self.tick_sizes.records()
+
+class MarketDepthRequest(MarketDataStreamRequest):
+    def __init__(self, request_id, connector_id, request_type, request_parameters, timeout=None, on_book_change=None, conflation=0.1):
+        super().__init__(request_id, connector_id, request_type, request_parameters, timeout)
+        self.book = OrderBook(request_parameters["numRows"], on_change=on_book_change, conflation=conflation)
+
+    def add_data(self, data_piece, data_type=None):
+        if not self.is_active() or data_type != "depth":
+            return
+        self.book.apply(*data_piece)
+
+    def get_data(self):
+        return self.book.to_frame()
+
+class TickByTickRequest(Request):
+    # reqTickByTickData stream and reqHistoricalTicks pages, the ticks of the tick type schema go to a TickBuffer
+    def __init__(self, request_id, connector_id, request_type, request_parameters, timeout=None, ticks=None):
+        super().__init__(request_id, connector_id, request_type, request_parameters, timeout)
+        self.ticks = ticks if not ticks is None else TickBuffer(request_parameters["tickType"])
+        self.page_size = 0
+
+    def add_data(self, data_piece, data_type=None):
+        if not self.is_active():
+            return
+        if data_type == "page": # historical ticks
+            self.ticks.extend(data_piece)
+            self.page_size += len(data_piece)
+            return
+        self.ticks.append(*data_piece)
+        if not self.on_get_data_postprocess is None:
+            self.on_get_data_postprocess(self, data_piece, data_type)
+
+    def get_data(self):
+        return self.ticks.records()
+
+class HistoricalStreamRequest(Request):
+    # reqHistoricalData with keepUpToDate, the bars are kept in a rolling window
+    def __init__(self, request_id, connector_id, request_type, request_parameters, timeout=None, window=1000):
+        super().__init__(request_id, connector_id, request_type, request_parameters, timeout)
+        self.properties["Loaded"] = False  # the initial history is received and the slot is released
+        self.bars = BarBuffer(window)
+        self.bar_listeners = []
+
+    def add_data(self, data_piece, data_type=None):
+        if not self.is_active():
+            return
+        if data_type != "update":
+            self.bars.append(*data_piece)
+            return
+        bar_time = np.datetime64(data_piece[0], "ns")
+        last_time = self.bars.last_time()
+        if not last_time is None and bar_time == last_time:
+            self.bars.update_last(*data_piece[1:])
+        elif last_time is None or bar_time > last_time:
+            closed_bar = self.bars.last_bar()
+            self.bars.append(*data_piece)
+            if not closed_bar is None and self.properties["Loaded"]:
+                for listener in list(self.bar_listeners):
+                    listener(self, closed_bar)
+
+    def set_loaded(self):
+        self.properties["Loaded"] = True
+
+    def get_data(self):
+        return self.bars.records()
+
 class OrderRequest(Request):
+    # order_status runs Submitted -> PartiallyFilled -> Filled / Cancelled / Inactive, a terminal state finishes the request
     def __init__(self, request_id, connector_id, request_type, request_parameters, timeout=None):
         super().__init__(request_id, connector_id, request_type, request_parameters, timeout)
         self.order_statuses = []
@@ -134,20 +334,164 @@ class OrderRequest(Request):
         self.commissions = []
         self.order_status = ""
         self.too_late_to_cancel = False
+        self.cancel_requested = False
         self.child_order_id = None
         self.reason = ""
+        self.filled_quantity = 0.0
+        self.average_fill_price = 0.0
+        self.remaining_quantity = float(request_parameters["order"].totalQuantity) if not request_parameters is None and "order" in request_parameters else None
+        self.exec_ids = set()
+        self.order_state_listener = None
+        self.fill_listener = None
+        self.send_time_ns = None
+        self.ack_time_ns = None
+        self.fill_time_ns = None
+        self.amendments = []  # {"changes", "send_time", "status": Sent / Acknowledged / Rejected, "ack_time"}
+        self.pending_changes = {}
+        self.last_amend_time = None
 
     def add_data(self, data_piece, data_type=None):
+        if data_type in ("order_status", "open_order"):
+            if self.ack_time_ns is None:
+                self.ack_time_ns = perf_counter_ns()
+            if data_type == "open_order":
+                self.acknowledge_amendment()
         if data_type == "order_status":
             self.order_statuses.append(data_piece)
+            self.on_order_status(data_piece[1], data_piece[2], data_piece[3])
         elif data_type == "execution_details":
+            if data_piece.execId in self.exec_ids: # replayed after reconnect or by reqExecutions
+                return
+            self.exec_ids.add(data_piece.execId)
+            if self.fill_time_ns is None:
+                self.fill_time_ns = perf_counter_ns()
             self.execution_details.append(data_piece)
+            self.add_fill(float(data_piece.shares), data_piece.price)
+        elif data_type == "open_order":
+            self.on_order_status(data_piece, None, None)
+            return
         elif data_type == "commission":
             self.commissions.append(data_piece)
-        self.on_get_data_postprocess(self, data_piece, data_type)
+        if not self.on_get_data_postprocess is None:
+            self.on_get_data_postprocess(self, data_piece, data_type)
+
+    def add_fill(self, shares, price):
+        filled_quantity = self.filled_quantity + shares
+        self.average_fill_price = (self.average_fill_price * self.filled_quantity + price * shares) / filled_quantity
+        self.filled_quantity = filled_quantity
+        if not self.fill_listener is None:
+            self.fill_listener(self, shares, price)
+        if not self.remaining_quantity is None:
+            self.remaining_quantity = max(self.remaining_quantity - shares, 0.0)
+        if self.remaining_quantity == 0.0:
+            self.set_order_state("Filled")
+        elif self.order_status in ("", "Submitted"):
+            self.set_order_state("PartiallyFilled")
+
+    def on_order_status(self, status, filled, remaining):
+        order_state = ORDER_STATUS_STATES.get(status)
+        if order_state is None:
+            return
+        if not remaining is None:
+            self.remaining_quantity = float(remaining)
+        if order_state == "Submitted" and not filled is None and filled > 0:
+            order_state = "PartiallyFilled"
+        if order_state == "Submitted" and self.order_status == "PartiallyFilled":
+            return
+        self.set_order_state(order_state)
+
+    def set_order_state(self, order_state):
+        if self.order_status in ORDER_TERMINAL_STATES or self.order_status == order_state:
+            return
+        previous_state = self.order_status
+        self.order_status = order_state
+        if not self.order_state_listener is None:
+            self.order_state_listener(self, previous_state)
+        if order_state == "Filled" and not self.properties["Finished"]:
+            if not self.on_finished is None:
+                self.on_finished(self)
+            else:
+                self.set_finished()
+        elif order_state in ("Cancelled", "Inactive") and self.is_unfinished():
+            super().set_cancelled(self.properties.get("Reason", order_state))
+
+    def set_cancelled(self, reason=None):
+        super().set_cancelled(reason)
+        self.set_order_state("Cancelled")
+
+    def is_open(self):
+        return self.order_status in ("", "Submitted", "PartiallyFilled")
+
+    def add_amendment(self, changes, error=None): # an error rejects it before it is sent
+        if error is None:
+            self.amendments.append({"changes": changes, "send_time": datetime.now(), "status": "Sent", "ack_time": None})
+        else:
+            self.amendments.append({"changes": changes, "send_time": None, "status": "Rejected", "ack_time": datetime.now(), "error": error})
+
+    def pending_amendment(self): # the oldest amendment which was not answered yet
+        for amendment in self.amendments:
+            if amendment["status"] == "Sent":
+                return amendment
+        return None
+
+    def amendment_pending(self):
+        return not self.pending_amendment() is None
+
+    def acknowledge_amendment(self): # openOrder echoes the order after every amended placeOrder
+        amendment = self.pending_amendment()
+        if not amendment is None:
+            amendment["status"] = "Acknowledged"
+            amendment["ack_time"] = datetime.now()
+
+    def reject_amendment(self, error_code):
+        amendment = self.pending_amendment()
+        if not amendment is None:
+            amendment["status"] = "Rejected"
+            amendment["ack_time"] = datetime.now()
+            amendment["error"] = error_code
+
+    def latency_us(self):
+        # send-to-ack and send-to-first-fill in microseconds, None until it happens
+        if self.send_time_ns is None:
+            return None, None
+        send_to_ack = None if self.ack_time_ns is None else (self.ack_time_ns - self.send_time_ns) / 1000
+        send_to_fill = None if self.fill_time_ns is None else (self.fill_time_ns - self.send_time_ns) / 1000
+        return send_to_ack, send_to_fill
 
     def set_child_order_id(self, child_request):
         self.child_order_id = child_request.request_id
         
     def set_reason(self, reason):
         self.reason = reason
+
+class OrderBatch():
+    # parent and child orders of a batch of brackets, fill status aggregated over the parents
+    def __init__(self, brackets=None):
+        self.brackets = brackets if not brackets is None else []  # [(parent request, child request)]
+
+    def add(self, request_parent, request_child):
+        self.brackets.append((request_parent, request_child))
+
+    def parents(self):
+        return [request_parent for request_parent, _ in self.brackets]
+
+    def children(self):
+        return [request_child for _, request_child in self.brackets]
+
+    def filled_quantity(self):
+        return sum(request_parent.filled_quantity for request_parent in self.parents())
+
+    def total_quantity(self):
+        return sum(float(request_parent.request_parameters["order"].totalQuantity) for request_parent in self.parents())
+
+    def order_statuses(self):
+        statuses = {}
+        for request_parent in self.parents():
+            statuses[request_parent.order_status] = statuses.get(request_parent.order_status, 0) + 1
+        return statuses
+
+    def is_filled(self):
+        return all(request_parent.order_status == "Filled" for request_parent in self.parents())
+
+    def is_done(self):
+        return all(not request_parent.is_open() for request_parent in self.parents())
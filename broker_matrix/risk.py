@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Pre-trade risk checks
+Signed notional exposure per symbol, underlying and account, kept incrementally from open orders, fills and the position book
+"""
+
+from copy import copy
+from threading import RLock
+from .contracts import contract_key
+from .portfolio import contract_multiplier, position_key
+
+RISK_LIMITS = ("max_order_notional", "max_symbol_exposure", "max_underlying_exposure", "max_account_exposure", "max_position", "min_cash")
+
+def order_side(order):
+    return 1 if order.action == "BUY" else -1
+
+def exposure_keys(contract, account):
+    symbol = (contract.symbol, contract.strike) if contract.secType == "OPT" else contract.symbol
+    return (("symbol", symbol), ("underlying", contract.symbol), ("account", account))
+
+class RiskEngine():
+    # exposure[key] = [filled notional, open orders notional], positions[symbol key] = [filled quantity, open orders quantity]
+    # limits left None are not checked, check() returns the rejection reason or None
+    def __init__(self, account_cache=None, currency=None, **limits):
+        self.limits = dict.fromkeys(RISK_LIMITS)
+        self.set_limits(**limits)
+        self.account_cache = account_cache
+        self.currency = currency
+        self.prices = {}  # contract key -> reference price of the orders without a limit price
+        self.exposure = {}
+        self.positions = {}
+        self.holdings = {}  # (account, conId) -> [contract, filled quantity, filled notional], the filled part of exposure and positions
+        self.orders = {}  # request -> (keys, notional per unit, remaining signed quantity)
+        self.open_buy_notional = {}  # account -> notional of the open buy orders, reserved from the cash
+        self.filled_buy_notional = {}  # account -> notional bought since the cached cash value last changed
+        self.rejected = 0
+        self.lock = RLock()
+        if not account_cache is None:
+            account_cache.add_listener(self.account_value_changed)
+
+    def set_limits(self, **limits):
+        for name, value in limits.items():
+            if not name in self.limits:
+                raise ValueError(f"unknown risk limit {name}")
+            self.limits[name] = value
+
+    def account_value_changed(self, key, value):
+        # the cash value from IB includes the fills so far
+        if len(key) == 3 and key[1] == "TotalCashValue" and (self.currency is None or key[2] == self.currency):
+            with self.lock:
+                self.filled_buy_notional.pop(key[0], None)
+
+    def cash(self, account):
+        # TotalCashValue in the engine currency, without one in the currency the account summary reports it in
+        if not self.currency is None:
+            return self.account_cache.get(account, "TotalCashValue", self.currency)
+        for (value_account, tag, _), value in list(self.account_cache.values.items()):
+            if value_account == account and tag == "TotalCashValue":
+                return value
+        return None
+
+    def set_price(self, contract, price):
+        self.prices[contract_key(contract)] = price
+
+    def order_price(self, contract, order):
+        if order.orderType in ("LMT", "STP LMT") and order.lmtPrice:
+            return order.lmtPrice
+        price = self.prices.get(contract_key(contract))
+        if price is None and order.orderType == "STP" and order.auxPrice:
+            return order.auxPrice
+        return price
+
+    def seed_positions(self, positions):
+        # positions: frame of PositionBook.to_frame(), avgCost already includes the multiplier
+        with self.lock:
+            for key, (contract, _, _) in list(self.holdings.items()):
+                self.replace_holding(key[0], contract, 0.0, 0.0)
+            for account, contract, position, avg_cost in zip(positions.account, positions.contract, positions.position, positions.avgCost):
+                self.set_position(account, contract, position, avg_cost)
+
+    def set_position(self, account, contract, position, avg_cost):
+        # PositionBook listener, the book is authoritative for the filled part of the contract
+        self.replace_holding(account, contract, float(position), float(position) * avg_cost)
+
+    def replace_holding(self, account, contract, quantity, notional):
+        with self.lock:
+            key = position_key(account, contract)
+            previous = self.holdings.pop(key, None)
+            if not previous is None:
+                contract_keys = exposure_keys(previous[0], account)
+                for exposure_key in contract_keys:
+                    self.exposure[exposure_key][0] -= previous[2]
+                self.positions[contract_keys[0]][0] -= previous[1]
+            if quantity != 0:
+                self.holdings[key] = [contract, quantity, notional]
+                contract_keys = exposure_keys(contract, account)
+                for exposure_key in contract_keys:
+                    self.exposure.setdefault(exposure_key, [0.0, 0.0])[0] += notional
+                self.positions.setdefault(contract_keys[0], [0.0, 0.0])[0] += quantity
+
+    def check(self, contract, order):
+        if order.parentId and order_side(order) == -1: # protective exit of a bracket, it only reduces the exposure
+            return None
+        limits = self.limits
+        quantity = order_side(order) * float(order.totalQuantity)
+        price = self.order_price(contract, order)
+        keys = exposure_keys(contract, order.account)
+        with self.lock:
+            if not limits["max_position"] is None:
+                filled, pending = self.positions.get(keys[0], (0.0, 0.0))
+                if abs(filled + pending + quantity) > limits["max_position"]:
+                    return "MaxPosition"
+            if price is None:
+                if any(not limits[name] is None for name in RISK_LIMITS if name != "max_position"):
+                    return "NoPrice"
+                return None
+            notional = quantity * price * contract_multiplier(contract)
+            if not limits["max_order_notional"] is None and abs(notional) > limits["max_order_notional"]:
+                return "MaxOrderNotional"
+            for key in keys:
+                level = key[0]
+                limit = limits[f"max_{level}_exposure"]
+                if not limit is None:
+                    filled, pending = self.exposure.get(key, (0.0, 0.0))
+                    if abs(filled + pending + notional) > limit:
+                        return f"Max{level.capitalize()}Exposure"
+            if not limits["min_cash"] is None and notional > 0 and not self.account_cache is None:
+                cash = self.cash(order.account)
+                if cash is None or cash - self.filled_buy_notional.get(order.account, 0.0) - self.open_buy_notional.get(order.account, 0.0) - notional < limits["min_cash"]:
+                    return "Cash"
+        return None
+
+    def reject(self):
+        self.rejected += 1
+
+    def on_order_placed(self, request):
+        self.track_order(request, request.request_parameters["order"])
+
+    def track_order(self, request, order):
+        # only the part not filled yet is open
+        contract = request.request_parameters["contract"]
+        price = self.order_price(contract, order)
+        if price is None or (order.parentId and order_side(order) == -1): # untracked until it fills
+            return
+        keys = exposure_keys(contract, order.account)
+        remaining = float(order.totalQuantity) - request.filled_quantity
+        if remaining <= 0:
+            return
+        quantity = order_side(order) * remaining
+        unit_notional = price * contract_multiplier(contract)
+        with self.lock:
+            self.orders[request] = (keys, unit_notional, quantity)
+            self.add_pending(keys, unit_notional, quantity, quantity > 0)
+
+    def on_order_amended(self, request, order):
+        # the open part of the amended order replaces the current one if it passes the checks, else the current one stays
+        with self.lock:
+            previous = self.orders.pop(request, None)
+            if not previous is None:
+                self.add_pending(previous[0], previous[1], -previous[2], previous[2] > 0)
+            open_order = copy(order)
+            open_order.totalQuantity = max(float(order.totalQuantity) - request.filled_quantity, 0.0)
+            reason = self.check(request.request_parameters["contract"], open_order)
+            if reason is None:
+                self.track_order(request, order)
+            elif not previous is None:
+                self.orders[request] = previous
+                self.add_pending(previous[0], previous[1], previous[2], previous[2] > 0)
+        return reason
+
+    def add_pending(self, keys, unit_notional, quantity, buy): # under lock, a negative quantity of a buy order releases the reserved cash
+        for key in keys:
+            self.exposure.setdefault(key, [0.0, 0.0])[1] += quantity * unit_notional
+        self.positions.setdefault(keys[0], [0.0, 0.0])[1] += quantity
+        if buy:
+            account = keys[2][1]
+            self.open_buy_notional[account] = self.open_buy_notional.get(account, 0.0) + quantity * unit_notional
+
+    def on_fill(self, request, shares, price, position_tracked=False):
+        # position_tracked: the fill reaches the position book, which updates the filled part through set_position
+        contract = request.request_parameters["contract"]
+        order = request.request_parameters["order"]
+        quantity = order_side(order) * shares
+        notional = quantity * price * contract_multiplier(contract)
+        with self.lock:
+            if not position_tracked:
+                _, filled, filled_notional = self.holdings.get(position_key(order.account, contract), (None, 0.0, 0.0))
+                self.replace_holding(order.account, contract, filled + quantity, filled_notional + notional)
+            if quantity > 0:
+                self.filled_buy_notional[order.account] = self.filled_buy_notional.get(order.account, 0.0) + notional
+            if request in self.orders: # the filled part is not open any more
+                keys, unit_notional, remaining = self.orders[request]
+                released = quantity if abs(quantity) < abs(remaining) else remaining
+                self.add_pending(keys, unit_notional, -released, remaining > 0)
+                self.orders[request] = (keys, unit_notional, remaining - released)
+
+    def on_order_closed(self, request):
+        with self.lock:
+            if request in self.orders:
+                keys, unit_notional, remaining = self.orders.pop(request)
+                self.add_pending(keys, unit_notional, -remaining, remaining > 0)
+
+    def exposure_of(self, level, value):
+        filled, pending = self.exposure.get((level, value), (0.0, 0.0))
+        return filled + pending
+
+    def statistics(self):
+        return {"open_orders": len(self.orders), "rejected": self.rejected, "keys": len(self.exposure)}
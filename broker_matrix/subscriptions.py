@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Shared market data lines
+one reqMktData line per contract, ticks are fanned out to all registered listeners
+LineAllocator keeps the most important subscriptions inside the reqMktData lines budget
+"""
+
+from datetime import datetime
+from threading import Lock
+
+from .contracts import contract_key
+
+ALLOCATOR_MIN_DWELL = 30
+ALLOCATOR_PREEMPT_MARGIN = 1
+
+class MarketDataSubscription():
+    def __init__(self, key, contract):
+        self.key = key
+        self.contract = contract
+        self.request = None
+        self.listeners = {}  # listener -> [reference count, is_busy]
+        self.targets = ()    # listeners snapshot for the ticks thread
+        self.lock = Lock()
+
+    def add_listener(self, listener, is_busy=None):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners[listener][0] += 1
+                if not is_busy is None:
+                    self.listeners[listener][1] = is_busy
+            else:
+                self.listeners[listener] = [1, is_busy]
+            self.targets = tuple(self.listeners)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            if not listener in self.listeners:
+                return len(self.listeners)
+            self.listeners[listener][0] -= 1
+            if self.listeners[listener][0] <= 0:
+                del self.listeners[listener]
+            self.targets = tuple(self.listeners)
+            return len(self.listeners)
+
+    def listeners_count(self):
+        return len(self.listeners)
+
+    def is_line_alive(self):
+        return not self.request is None and self.request.is_unfinished()
+
+    def dispatch(self, request, data_piece, data_type):
+        for listener in self.targets:
+            listener(request, data_piece, data_type)
+
+    def is_busy(self, request):
+        for _, is_busy in list(self.listeners.values()):
+            if not is_busy is None and is_busy(request):
+                return True
+        return False
+
+class DesiredLine():
+    def __init__(self, key, contract, listener, priority, min_dwell, is_busy):
+        self.key = key
+        self.contract = contract
+        self.listener = listener
+        self.priority = priority
+        self.min_dwell = min_dwell
+        self.is_busy = is_busy
+        self.request = None
+        self.allocated_time = None
+
+    def is_dwelling(self, now):
+        return (now - self.allocated_time).total_seconds() < self.min_dwell
+
+class LineAllocator():
+    def __init__(self, matrix, budget=None, preempt_margin=ALLOCATOR_PREEMPT_MARGIN):
+        self.matrix = matrix
+        self.budget = budget if budget else matrix.max_requests["reqMktData"]
+        self.preempt_margin = preempt_margin
+        self.desired = {}    # contract key -> DesiredLine
+        self.allocated = {}  # contract key -> DesiredLine, subset of desired
+        self.lock = Lock()
+        self.start_time = datetime.now()
+        self.counters = {"allocations": 0, "releases": 0, "preemptions": 0, "lost": 0, "rebalances": 0}
+        matrix.add_periodic_handler(self.rebalance)
+
+    def want(self, contract, listener, priority=0, min_dwell=ALLOCATOR_MIN_DWELL, is_busy=None):
+        key = contract_key(contract)
+        with self.lock:
+            line = self.desired.get(key)
+            if line is None:
+                self.desired[key] = DesiredLine(key, contract, listener, priority, min_dwell, is_busy)
+            else:
+                line.priority = priority
+                line.min_dwell = min_dwell
+                line.is_busy = is_busy
+        self.rebalance()
+
+    def drop(self, contract, reason="Unselected"):
+        key = contract_key(contract)
+        with self.lock:
+            if not key in self.desired:
+                return
+            del self.desired[key]
+            if key in self.allocated:
+                self._release(self.allocated[key], reason)
+        self.rebalance()
+
+    def rebalance(self):
+        now = datetime.now()
+        with self.lock:
+            self.counters["rebalances"] += 1
+            for line in list(self.allocated.values()):
+                if line.request is None or not line.request.is_unfinished(): # timed out or cancelled by error
+                    # leave the dead line first, otherwise its listener moves to the new line and is added once more
+                    self.matrix.unsubscribe_market_data(line.listener, line.contract, "Lost")
+                    del self.allocated[line.key]
+                    line.request = None
+                    self.counters["lost"] += 1
+            if len(self.allocated) == len(self.desired):
+                return
+            waiting = sorted((line for key, line in self.desired.items() if not key in self.allocated), key=lambda line: -line.priority)
+            for line in waiting:
+                if len(self.allocated) < self.budget:
+                    self._allocate(line, now)
+                    continue
+                victim = self._find_victim(line.priority, now)
+                if victim is None: # the rest of the waiting lines have lower priority
+                    break
+                self._release(victim, "Preempted")
+                self.counters["preemptions"] += 1
+                self._allocate(line, now)
+
+    def _find_victim(self, priority, now):
+        victim = None
+        for line in self.allocated.values():
+            if line.priority + self.preempt_margin > priority or line.is_dwelling(now):
+                continue
+            if not line.is_busy is None and line.is_busy(line.request):
+                continue
+            if victim is None or line.priority < victim.priority:
+                victim = line
+        return victim
+
+    def _allocate(self, line, now):
+        line.request = self.matrix.subscribe_market_data(line.listener, line.contract, is_busy=self.is_line_held)
+        line.allocated_time = now
+        self.allocated[line.key] = line
+        self.counters["allocations"] += 1
+
+    def _release(self, line, reason):
+        self.matrix.unsubscribe_market_data(line.listener, line.contract, reason)
+        del self.allocated[line.key]
+        line.request = None
+        line.allocated_time = None
+        self.counters["releases"] += 1
+
+    def is_line_held(self, request): # allocated lines are released by the allocator, not by the timeout thread
+        if request.request_parameters is None or not "contract" in request.request_parameters:
+            return False
+        line = self.allocated.get(contract_key(request.request_parameters["contract"]))
+        return not line is None and line.request is request
+
+    def is_allocated(self, contract):
+        return contract_key(contract) in self.allocated
+
+    def statistics(self):
+        minutes = max((datetime.now() - self.start_time).total_seconds() / 60, 1 / 60)
+        statistics = dict(self.counters)
+        statistics["budget"] = self.budget
+        statistics["allocated"] = len(self.allocated)
+        statistics["waiting"] = len(self.desired) - len(self.allocated)
+        statistics["utilization"] = len(self.allocated) / self.budget
+        statistics["churn_per_minute"] = (self.counters["preemptions"] + self.counters["lost"]) / minutes
+        return statistics
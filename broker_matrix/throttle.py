@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Outbound message throttle of a connection
+Token bucket below the IB limit of 50 messages per second, orders and cancels go before data requests
+"""
+
+import time
+from threading import Thread, Condition
+from collections import deque
+from ibapi.message import OUT
+
+THROTTLE_RATE = 40 # messages per second
+THROTTLE_BURST = 8 # rate + burst = 48 messages at most in any second, below the limit of 50
+PRIORITY_MESSAGES = {OUT.PLACE_ORDER, OUT.CANCEL_ORDER, OUT.REQ_GLOBAL_CANCEL, OUT.CANCEL_MKT_DATA, OUT.CANCEL_MKT_DEPTH,
+                     OUT.CANCEL_HISTORICAL_DATA, OUT.CANCEL_TICK_BY_TICK_DATA, OUT.CANCEL_ACCOUNT_SUMMARY, OUT.CANCEL_POSITIONS,
+                     OUT.CANCEL_POSITIONS_MULTI, OUT.CANCEL_PNL, OUT.CANCEL_PNL_SINGLE, OUT.CANCEL_REAL_TIME_BARS,
+                     OUT.CANCEL_SCANNER_SUBSCRIPTION, OUT.CANCEL_HEAD_TIMESTAMP, OUT.CANCEL_HISTOGRAM_DATA}
+# cancel id: (request id, field of the request id in the request, in the cancel), a cancel drops its still queued request
+# every priority cancel of a data request is listed, otherwise it could overtake the request; reqPositions has no request id (None)
+CANCELLED_REQUESTS = {OUT.CANCEL_MKT_DATA: (OUT.REQ_MKT_DATA, 2, 2), OUT.CANCEL_MKT_DEPTH: (OUT.REQ_MKT_DEPTH, 2, 2),
+                      OUT.CANCEL_HISTORICAL_DATA: (OUT.REQ_HISTORICAL_DATA, 1, 2), OUT.CANCEL_TICK_BY_TICK_DATA: (OUT.REQ_TICK_BY_TICK_DATA, 1, 1),
+                      OUT.CANCEL_ACCOUNT_SUMMARY: (OUT.REQ_ACCOUNT_SUMMARY, 2, 2), OUT.CANCEL_PNL: (OUT.REQ_PNL, 1, 1),
+                      OUT.CANCEL_PNL_SINGLE: (OUT.REQ_PNL_SINGLE, 1, 1), OUT.CANCEL_POSITIONS: (OUT.REQ_POSITIONS, None, None),
+                      OUT.CANCEL_POSITIONS_MULTI: (OUT.REQ_POSITIONS_MULTI, 2, 2), OUT.CANCEL_REAL_TIME_BARS: (OUT.REQ_REAL_TIME_BARS, 2, 2),
+                      OUT.CANCEL_SCANNER_SUBSCRIPTION: (OUT.REQ_SCANNER_SUBSCRIPTION, 1, 2), OUT.CANCEL_HEAD_TIMESTAMP: (OUT.REQ_HEAD_TIMESTAMP, 1, 1),
+                      OUT.CANCEL_HISTOGRAM_DATA: (OUT.REQ_HISTOGRAM_DATA, 1, 1)}
+
+def message_id(args):
+    # sendMsg(msg) with the id as the first field (9.81) or sendMsg(msgId, msg) in the later API versions
+    if len(args) > 1:
+        return int(args[0])
+    msg = args[0]
+    if isinstance(msg, bytes):
+        msg = msg.decode(errors="ignore")
+    try:
+        return int(msg.split("\0", 1)[0])
+    except ValueError:
+        return None
+
+def message_field(args, index):
+    # field of the message counted with the id as field 0, None when missing
+    if index is None:
+        return None
+    fields = args[-1]
+    if isinstance(fields, bytes):
+        fields = fields.decode(errors="ignore")
+    fields = fields.split("\0")
+    if len(args) > 1:
+        index -= 1
+    return fields[index] if 0 <= index < len(fields) else None
+
+def cancelled_request(msg_id, args):
+    # (request message id, its request id field, request id) of a cancel, None for other messages
+    if not msg_id in CANCELLED_REQUESTS:
+        return None
+    request_msg_id, request_field, cancel_field = CANCELLED_REQUESTS[msg_id]
+    return (request_msg_id, request_field, message_field(args, cancel_field))
+
+class MessageThrottle():
+    # submit() sends at once while tokens are left and nothing of the same or higher priority waits, the rest is sent by the sender thread in FIFO order per priority
+    # a cancel of a request still waiting in the queue removes the request and is not sent itself
+    def __init__(self, send, rate=THROTTLE_RATE, burst=THROTTLE_BURST):
+        self.send = send
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.queues = (deque(), deque())  # priority, data
+        self.condition = Condition()
+        self.sent_direct = 0
+        self.sent_queued = 0
+        self.throttled = [0, 0]
+        self.dropped = 0
+        self.coalesced = 0  # requests cancelled while still queued, neither is sent
+        self.max_queue_length = 0
+        self.total_wait = 0.0
+        self.sending = False  # a queued message is being sent, a direct send would overtake it
+        self.run_thread = True
+        self.thread_running = False  # cleared by the sender thread under condition when it exits
+        self.start()
+
+    def start(self): # under condition or before the thread runs, restarts the sender thread after stop()
+        self.run_thread = True
+        if not self.thread_running:
+            self.thread_running = True
+            Thread(target=self.sender_thread, daemon=True).start()
+
+    def refill(self): # under condition
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def remove_queued_request(self, cancelled): # under condition
+        request_msg_id, request_field, req_id = cancelled
+        for entry in self.queues[1]:
+            if message_id(entry[1]) == request_msg_id and message_field(entry[1], request_field) == req_id:
+                self.queues[1].remove(entry)
+                return True
+        return False
+
+    def submit(self, args):
+        msg_id = message_id(args)
+        priority = 0 if msg_id in PRIORITY_MESSAGES else 1
+        cancelled = cancelled_request(msg_id, args)
+        with self.condition:
+            if not cancelled is None and self.remove_queued_request(cancelled):
+                self.coalesced += 1
+                return
+            self.refill()
+            if self.tokens >= 1 and not self.sending and len(self.queues[0]) == 0 and (priority == 0 or len(self.queues[1]) == 0):
+                self.tokens -= 1
+                self.sent_direct += 1
+                direct = True
+            else:
+                self.queues[priority].append((time.monotonic(), args))
+                self.throttled[priority] += 1
+                self.max_queue_length = max(self.max_queue_length, len(self.queues[0]) + len(self.queues[1]))
+                self.condition.notify()
+                direct = False
+        if direct:
+            self.send(*args)
+
+    def sender_thread(self):
+        while True:
+            with self.condition:
+                while self.run_thread and len(self.queues[0]) == 0 and len(self.queues[1]) == 0:
+                    self.condition.wait()
+                if not self.run_thread:
+                    self.thread_running = False
+                    break
+                self.refill()
+                if self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                    continue
+                queue = self.queues[0] if len(self.queues[0]) > 0 else self.queues[1]
+                queued_time, args = queue.popleft()
+                self.tokens -= 1
+                self.sent_queued += 1
+                self.total_wait += time.monotonic() - queued_time
+                self.sending = True
+                send = self.send
+            try:
+                send(*args)
+            except (AttributeError, OSError): # disconnected meanwhile
+                self.dropped += 1
+            with self.condition:
+                self.sending = False
+
+    def set_target(self, send): # new connection, the messages queued for the old one are dropped
+        with self.condition:
+            self.dropped += len(self.queues[0]) + len(self.queues[1])
+            self.queues[0].clear()
+            self.queues[1].clear()
+            self.send = send
+            self.start()
+
+    def stop(self):
+        with self.condition:
+            self.run_thread = False
+            self.condition.notify()
+
+    def queue_length(self):
+        return len(self.queues[0]) + len(self.queues[1])
+
+    def statistics(self):
+        return {"sent_direct": self.sent_direct, "sent_queued": self.sent_queued, "throttled_priority": self.throttled[0],
+                "throttled_data": self.throttled[1], "dropped": self.dropped, "coalesced": self.coalesced, "queue_length": self.queue_length(),
+                "max_queue_length": self.max_queue_length,
+                "mean_wait": self.total_wait / self.sent_queued if self.sent_queued > 0 else 0.0}
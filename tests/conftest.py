@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Offline connections for the tests, the broker API calls are recorded instead of sent
+"""
+
+import pytest
+
+from broker_matrix import IBLayer
+
+class RecordingApi():
+    def __init__(self):
+        self.calls = []
+        self.requests = {}
+        self.special_requests = {}
+        self.execution_listeners = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return call
+
+class OfflineConnector():
+    def __init__(self, client_id=1):
+        self.client_id = client_id
+        self.req_id = 0
+        self.broker_api = RecordingApi()
+
+    def next_req_id(self):
+        self.req_id += 1
+        return self.req_id
+
+    def reserve_req_ids(self, count):
+        first_id = self.req_id + 1
+        self.req_id += count
+        return range(first_id, first_id + count)
+
+    def add_request(self, request):
+        self.broker_api.requests[request.request_id] = request
+
+    def get_special_request(self, request_type):
+        return None
+
+    def set_special_request(self, request_type, request):
+        self.broker_api.special_requests[request_type] = request
+
+    def add_execution_listener(self, listener):
+        self.broker_api.execution_listeners.append(listener)
+
+    def remove_execution_listener(self, listener):
+        if listener in self.broker_api.execution_listeners:
+            self.broker_api.execution_listeners.remove(listener)
+
+def attach_offline_connector(matrix, request_types, client_id=1):
+    connector = OfflineConnector(client_id)
+    matrix.connectors[client_id] = connector
+    for request_type in request_types:
+        matrix.request_types.setdefault(request_type, []).append(client_id)
+    return connector
+
+@pytest.fixture
+def layer():
+    ib_layer = IBLayer(account="U1", currency="USD", verbose=False)
+    yield ib_layer
+    ib_layer.run_thread = False
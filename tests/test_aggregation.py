@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Tick to bar aggregation
+"""
+
+from datetime import datetime
+
+from broker_matrix import TickBarAggregator
+
+def trade(aggregator, tick_time, price, size=100):
+    aggregator(None, (tick_time, "LAST", price), "price")
+    aggregator(None, (tick_time, "LAST_SIZE", size), "size")
+
+def test_gaps_are_filled_only_inside_the_session():
+    aggregator = TickBarAggregator(bar_seconds=60)
+    trade(aggregator, datetime(2024, 1, 5, 15, 58, 10), 10.0) # Friday
+    trade(aggregator, datetime(2024, 1, 8, 9, 32, 30), 11.0) # Monday
+    aggregator.on_timer(datetime(2024, 1, 8, 9, 33, 5))
+    bars = aggregator.to_frame()
+    assert [str(start) for start in bars.index] == ["2024-01-05 15:58:00", "2024-01-05 15:59:00", "2024-01-08 09:30:00", "2024-01-08 09:31:00", "2024-01-08 09:32:00"]
+    assert list(bars.volume) == [100.0, 0.0, 0.0, 0.0, 100.0]
+    assert bars.close.iloc[-1] == 11.0
+
+def test_gaps_are_filled_around_the_clock_without_a_session():
+    aggregator = TickBarAggregator(bar_seconds=60, session=None)
+    trade(aggregator, datetime(2024, 1, 5, 23, 58, 10), 10.0)
+    aggregator.on_timer(datetime(2024, 1, 6, 0, 1, 5))
+    assert len(aggregator.to_frame()) == 3
+
+def test_late_trade_goes_to_the_open_bar():
+    closed = []
+    aggregator = TickBarAggregator(bar_seconds=60, on_bar=lambda aggregator, bar: closed.append(bar))
+    trade(aggregator, datetime(2024, 1, 8, 10, 0, 10), 10.0)
+    aggregator.on_timer(datetime(2024, 1, 8, 10, 2, 5))
+    trade(aggregator, datetime(2024, 1, 8, 10, 1, 59), 12.0) # its bar was already filled flat
+    aggregator.on_timer(datetime(2024, 1, 8, 10, 3, 5))
+    assert [bar[0].minute for bar in closed] == [0, 1, 2]
+    assert closed[2][4] == 12.0 and closed[2][5] == 100.0
+
+def test_volume_bars_close_at_the_threshold():
+    aggregator = TickBarAggregator(kind="volume", threshold=250)
+    for second in range(5):
+        trade(aggregator, datetime(2024, 1, 8, 10, 0, second), 10.0 + second)
+    bars = aggregator.to_frame()
+    assert len(bars) == 1 and bars.volume.iloc[0] == 300.0 and bars.high.iloc[0] == 12.0
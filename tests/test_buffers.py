@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Rolling bar windows and growable tick columns
+"""
+
+from datetime import datetime, timedelta
+
+from broker_matrix import BarBuffer, TickBuffer, HistoricalStreamRequest, stocks_contract, TICK_FIRST_CHUNK_SIZE
+
+START = datetime(2024, 1, 2, 10)
+
+def bar(minute, close):
+    return (START + timedelta(minutes=minute), close, close, close, close, 100.0)
+
+def test_bar_buffer_keeps_the_latest_bars_in_order():
+    bars = BarBuffer(3)
+    assert len(bars) == 0 and bars.last_bar() is None
+    for minute in range(5):
+        bars.append(*bar(minute, 100.0 + minute))
+    assert len(bars) == 3
+    assert [record[0] for record in bars.records()] == [START + timedelta(minutes=minute) for minute in (2, 3, 4)]
+    assert list(bars.to_frame()["close"]) == [102.0, 103.0, 104.0]
+    bars.update_last(104.0, 106.0, 103.0, 105.0, 250.0)
+    assert bars.last_bar() == (START + timedelta(minutes=4), 104.0, 106.0, 103.0, 105.0, 250.0)
+
+def test_stream_updates_the_open_bar_and_reports_closed_bars():
+    request = HistoricalStreamRequest(1, 1, "reqHistoricalData", {"contract": stocks_contract("AAPL")}, window=2)
+    closed = []
+    request.bar_listeners.append(lambda request, closed_bar: closed.append(closed_bar))
+    request.set_started()
+    request.add_data(bar(0, 100.0))
+    request.add_data(bar(1, 101.0), "update") # the history is not loaded yet, bar 0 is not reported
+    request.set_loaded()
+    request.add_data(bar(1, 102.0), "update")
+    assert closed == [] and request.bars.last_bar()[4] == 102.0
+    request.add_data(bar(2, 103.0), "update")
+    assert closed == [bar(1, 102.0)]
+    request.add_data(bar(0, 99.0), "update") # older than the open bar
+    assert [record[0] for record in request.get_data()] == [START + timedelta(minutes=1), START + timedelta(minutes=2)]
+
+def test_tick_buffer_grows_in_chunks_without_losing_ticks():
+    ticks = TickBuffer("Last", chunk_size=4096)
+    count = TICK_FIRST_CHUNK_SIZE * 6
+    ticks.extend((START + timedelta(seconds=second), 100.0 + second, 1.0, "NYSE" if second % 2 == 0 else "ARCA") for second in range(count))
+    assert len(ticks) == count
+    assert [len(chunk[0]) for chunk in ticks.chunks] == [1024, 2048, 4096] # doubling up to the chunk size
+    columns = ticks.columns()
+    assert columns["price"][0] == 100.0 and columns["price"][-1] == 100.0 + count - 1
+    assert list(columns["exchange"][:2]) == ["NYSE", "ARCA"] and ticks.columns(decode=False)["exchange"].dtype == "int16"
+    assert ticks.last("exchange") == "ARCA" and ticks.last("price") == 100.0 + count - 1
+    frame = ticks.to_frame()
+    assert frame.index.name == "time" and len(frame) == count and frame.index[-1] == START + timedelta(seconds=count - 1)
+
+def test_empty_tick_buffer_has_empty_typed_columns():
+    ticks = TickBuffer("BidAsk")
+    assert len(ticks) == 0 and ticks.last("bid") is None
+    assert ticks.records() == [] and ticks.columns()["bid"].dtype == "float64"
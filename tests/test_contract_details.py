@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+qualify_contracts statuses with the contract details answered by an offline connection
+"""
+
+from datetime import datetime
+
+from broker_matrix import stocks_contract
+from conftest import attach_offline_connector
+
+class Details():
+    def __init__(self, contract):
+        self.contract = contract
+
+def answer_contract_details(connector, answers):
+    # answers: symbol -> number of contract details, an error code or None for no answer
+    def reqContractDetails(request_id, contract):
+        request = connector.broker_api.requests[request_id]
+        answer = answers[contract.symbol]
+        if answer is None:
+            return
+        if answer >= 100:
+            request.errors[datetime.now()] = (answer, "No security definition has been found for the request")
+            request.on_error(request, answer)
+            return
+        for _ in range(answer):
+            request.on_get_data(Details(contract))
+        request.on_finished(request)
+    connector.broker_api.reqContractDetails = reqContractDetails
+
+def test_qualify_contracts_reports_a_status_per_contract(layer):
+    connector = attach_offline_connector(layer, ["reqContractDetails"])
+    answer_contract_details(connector, {"AAPL": 1, "BRK": 2, "NONE": 0, "GONE": 200, "SLOW": None})
+    contracts = [stocks_contract(symbol) for symbol in ("AAPL", "BRK", "SLOW", "NONE", "GONE")]
+    results = list(layer.qualify_contracts(contracts, max_in_flight=2, timeout=0.2))
+    statuses = {position: status for position, status, _ in results}
+    assert statuses == {0: "ok", 1: "ambiguous", 2: "timeout", 3: "not found", 4: "not found"}
+    assert [position for position, _, _ in results] == [0, 1, 3, 4, 2] # in the order of completion
+    details = {position: contract_details for position, _, contract_details in results}
+    assert details[0][0].contract is contracts[0] and len(details[1]) == 2
+
+def test_qualify_contracts_keeps_the_in_flight_limit(layer):
+    connector = attach_offline_connector(layer, ["reqContractDetails"])
+    sent = []
+    def reqContractDetails(request_id, contract):
+        sent.append(contract.symbol)
+    connector.broker_api.reqContractDetails = reqContractDetails
+    results = layer.qualify_contracts([stocks_contract(symbol) for symbol in ("AAPL", "MSFT", "IBM")], max_in_flight=2, timeout=0.05)
+    position, status, _ = next(results)
+    assert (position, status) == (0, "timeout")
+    assert sent == ["AAPL", "MSFT"] # IBM waits for a free slot
+    assert [status for _, status, _ in results] == ["timeout", "timeout"]
+    assert sent == ["AAPL", "MSFT", "IBM"]
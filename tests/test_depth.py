@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Level-2 order book kept by position and conflated book notifications
+"""
+
+import math
+
+from broker_matrix import OrderBook, stocks_contract, DEPTH_INSERT, DEPTH_UPDATE, DEPTH_DELETE, DEPTH_ASK, DEPTH_BID
+from conftest import attach_offline_connector
+
+def test_book_inserts_updates_and_deletes_by_position():
+    book = OrderBook(3)
+    book.apply(0, DEPTH_INSERT, DEPTH_BID, 100.0, 5)
+    book.apply(0, DEPTH_INSERT, DEPTH_BID, 100.5, 2) # the better bid shifts the others down
+    book.apply(1, DEPTH_INSERT, DEPTH_BID, 100.2, 1)
+    book.apply(0, DEPTH_INSERT, DEPTH_BID, 100.7, 9) # 100.0 falls out of the 3 rows
+    assert book.top()[0].tolist() == [100.7, 100.5, 100.2]
+    book.apply(1, DEPTH_UPDATE, DEPTH_BID, 100.5, 4)
+    book.apply(0, DEPTH_DELETE, DEPTH_BID, 0, 0)
+    bid_prices, bid_sizes, _, _ = book.top()
+    assert bid_prices.tolist() == [100.5, 100.2] and bid_sizes.tolist() == [4.0, 1.0]
+    assert book.best_bid() == (100.5, 4.0) and book.best_ask() == (None, None)
+    book.apply(5, DEPTH_INSERT, DEPTH_BID, 99.0, 1) # outside the book
+    book.apply(2, DEPTH_DELETE, DEPTH_BID, 0, 0) # not inserted
+    assert book.bids.count == 2
+
+def test_book_frame_pads_the_shorter_side():
+    book = OrderBook(5)
+    book.apply(0, DEPTH_UPDATE, DEPTH_ASK, 101.0, 3, "NSDQ")
+    book.apply(0, DEPTH_INSERT, DEPTH_BID, 100.0, 2)
+    book.apply(1, DEPTH_INSERT, DEPTH_BID, 99.5, 7)
+    frame = book.to_frame()
+    assert list(frame.columns) == ["bid_size", "bid", "ask", "ask_size"] and frame.index.name == "level"
+    assert frame["bid"].tolist() == [100.0, 99.5]
+    assert frame.loc[0, "ask"] == 101.0 and math.isnan(frame.loc[1, "ask"])
+    assert book.asks.market_makers[0] == "NSDQ"
+    book.clear()
+    assert len(book.to_frame()) == 0
+
+def test_book_changes_are_conflated_and_flushed(layer):
+    connector = attach_offline_connector(layer, ["reqMktDepth"])
+    changes = []
+    request = layer.req_market_depth(stocks_contract("AAPL"), num_rows=5, on_book_change=changes.append, conflation=60)
+    layer._req_market_depth(request)
+    assert connector.broker_api.calls[0][0] == "reqMktDepth"
+    request.add_data((0, DEPTH_INSERT, DEPTH_BID, 100.0, 2, ""), "depth")
+    request.add_data((0, DEPTH_INSERT, DEPTH_ASK, 100.5, 1, ""), "depth")
+    assert changes == [request.book] # the second change waits for the flush
+    assert request.book.flush in layer.periodic_handlers
+    request.book.flush()
+    request.book.flush()
+    assert len(changes) == 2
+    assert request.get_data()["ask"].tolist() == [100.5]
+
+    layer.cancel_market_depth(request, "Unsubscribed")
+    assert connector.broker_api.calls[-1][0] == "cancelMktDepth"
+    assert not request.book.flush in layer.periodic_handlers
+    request.add_data((1, DEPTH_INSERT, DEPTH_BID, 99.0, 2, ""), "depth") # after the cancel
+    assert request.book.bids.count == 1
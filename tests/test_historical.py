@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Historical chunk planning, stitching and chunked retrieval
+"""
+
+from datetime import datetime, timedelta
+import pandas as pd
+import pytest
+
+from broker_matrix import Request, plan_historical_chunks, stitch_bars, remaining_duration, resample_bars, finest_bar_size, historical_panel, stocks_contract, UTC, EASTERN
+from broker_matrix.ib_layer import LOCAL_TIMEZONE
+from conftest import attach_offline_connector
+
+END_TIME = UTC.localize(datetime(2024, 1, 3))
+
+def local_time(utc_time):
+    return utc_time.astimezone(LOCAL_TIMEZONE).replace(tzinfo=None)
+
+def bars(*times):
+    return pd.DataFrame.from_records([(bar_time, 1.0, 1.0, 1.0, 1.0, 100.0) for bar_time in times], columns=['date', 'open', 'high', 'low', 'close', 'volume'], index='date')
+
+class FakeHistoricalServer():
+    # answers req_historical_data at once, chunk end or (chunk end, duration) -> (bars, finished)
+    def __init__(self, layer, answers):
+        self.layer = layer
+        self.answers = answers
+        self.request_id = 0
+        self.requested = []
+
+    def req_historical_data(self, contract, duration_str, bar_size_setting, what_to_show='TRADES', end_date_time='', fixed_timeout=None, **kwargs):
+        self.request_id += 1
+        self.requested.append((end_date_time, duration_str))
+        request = Request(self.request_id, 1, "reqHistoricalData", {"contract": contract})
+        self.layer.global_requests[(1, self.request_id)] = request
+        request.set_started()
+        answer = self.answer(contract, end_date_time, duration_str)
+        if answer is None: # never answered
+            return request
+        bar_times, finished = answer
+        for bar_time in bar_times:
+            request.add_data((local_time(bar_time), 1.0, 1.0, 1.0, 1.0, 100.0))
+        if finished:
+            request.set_finished()
+        else:
+            request.errors[1] = (366, "connection lost")
+            request.set_cancelled("Error")
+        return request
+
+    def answer(self, contract, end_date_time, duration_str):
+        return self.answers.get((end_date_time, duration_str), self.answers.get(end_date_time))
+
+class SymbolHistoricalServer(FakeHistoricalServer):
+    # symbol -> (bars, finished) or None
+    def answer(self, contract, end_date_time, duration_str):
+        return self.answers[contract.symbol]
+
+def test_plan_chunks_cover_the_duration_latest_first():
+    assert plan_historical_chunks("3 D", "1 min", END_TIME) == [("20240103-00:00:00", "1 D"), ("20240102-00:00:00", "1 D"), ("20240101-00:00:00", "1 D")]
+    assert plan_historical_chunks("1 D", "1 min", END_TIME) == [("20240103-00:00:00", "1 D")]
+    assert plan_historical_chunks("1 D", "1 min") == [('', "1 D")]
+
+def test_stitch_bars_orders_and_drops_duplicates():
+    first, second = datetime(2024, 1, 2, 10), datetime(2024, 1, 2, 11)
+    stitched = stitch_bars([bars(second), None, bars(first, second)])
+    assert list(stitched.index) == [first, second] and len(stitched) == 2
+    assert stitch_bars([None, bars()]) is None
+
+def test_remaining_duration_starts_after_the_last_bar():
+    partial = bars(local_time(END_TIME - timedelta(hours=2)))
+    assert remaining_duration(partial, "20240103-00:00:00", "1 D", "1 min", LOCAL_TIMEZONE) == "7200 S"
+    assert remaining_duration(None, "20240103-00:00:00", "1 D", "1 min", LOCAL_TIMEZONE) == "1 D"
+    assert remaining_duration(bars(local_time(END_TIME)), "20240103-00:00:00", "1 D", "1 min", LOCAL_TIMEZONE) is None
+
+def test_chunk_out_of_retries_keeps_its_bars_and_flags_the_gap(layer, monkeypatch):
+    older_bars = [END_TIME - timedelta(hours=47), END_TIME - timedelta(hours=46)]
+    server = FakeHistoricalServer(layer, {"20240103-00:00:00": ([END_TIME - timedelta(hours=1)], True),
+                                          "20240102-00:00:00": (older_bars, False)})
+    monkeypatch.setattr(layer, "req_historical_data", server.req_historical_data)
+    data = layer.retrieve_ib_historical_data_chunked(["AAPL"], "2 D", "1 min", end_date_time=END_TIME, localize=False, retries=0)["AAPL"]
+    assert len(data) == 3
+    assert data.attrs["complete"] is False
+    assert data.attrs["incomplete_from"] == older_bars[-1]
+
+def test_complete_chunks_are_flagged_complete(layer, monkeypatch):
+    server = FakeHistoricalServer(layer, {"20240103-00:00:00": ([END_TIME - timedelta(hours=1)], True),
+                                          "20240102-00:00:00": ([END_TIME - timedelta(hours=30)], True)})
+    monkeypatch.setattr(layer, "req_historical_data", server.req_historical_data)
+    data = layer.retrieve_ib_historical_data_chunked(["AAPL"], "2 D", "1 min", end_date_time=END_TIME, localize=False)["AAPL"]
+    assert len(data) == 2 and data.attrs["complete"] is True and data.attrs["incomplete_from"] is None
+
+def test_failed_request_resumes_after_its_last_bar(layer, monkeypatch):
+    partial_bars = [END_TIME - timedelta(hours=20), END_TIME - timedelta(hours=19)]
+    server = FakeHistoricalServer(layer, {("20240103-00:00:00", "1 D"): (partial_bars, False),
+                                          ("20240103-00:00:00", "68400 S"): ([END_TIME - timedelta(hours=19), END_TIME - timedelta(hours=1)], True)})
+    monkeypatch.setattr(layer, "req_historical_data", server.req_historical_data)
+    symbol_requests = {"AAPL": (1, stocks_contract("AAPL"))}
+    data = layer.retrieve_ib_historical_data_general(symbol_requests, " D", "1 min", localize=False, end_date_time="20240103-00:00:00", resume_attempts=1)["AAPL"]
+    assert server.requested == [("20240103-00:00:00", "1 D"), ("20240103-00:00:00", "68400 S")]
+    assert list(data.index) == [local_time(bar_time) for bar_time in partial_bars + [END_TIME - timedelta(hours=1)]]
+    assert len(layer.historical_partials) == 0
+
+def test_salvaged_bars_are_resumed_by_the_next_call(layer, monkeypatch):
+    server = FakeHistoricalServer(layer, {("20240103-00:00:00", "1 D"): ([END_TIME - timedelta(hours=20)], False),
+                                          ("20240103-00:00:00", "72000 S"): ([END_TIME - timedelta(hours=2)], True)})
+    monkeypatch.setattr(layer, "req_historical_data", server.req_historical_data)
+    symbol_requests = {"AAPL": (1, stocks_contract("AAPL"))}
+    assert layer.retrieve_ib_historical_data_general(symbol_requests, " D", "1 min", localize=False, end_date_time="20240103-00:00:00")["AAPL"] is None
+    assert len(layer.historical_partials) == 1
+    data = layer.retrieve_ib_historical_data_general(symbol_requests, " D", "1 min", localize=False, end_date_time="20240103-00:00:00")["AAPL"]
+    assert server.requested[-1] == ("20240103-00:00:00", "72000 S")
+    assert len(data) == 2 and len(layer.historical_partials) == 0
+
+def test_historical_frames_are_yielded_as_completed_until_the_deadline(layer, monkeypatch):
+    connector = attach_offline_connector(layer, ["reqHistoricalData"])
+    server = SymbolHistoricalServer(layer, {"AAPL": ([END_TIME], True), "SLOW": None, "MSFT": ([END_TIME, END_TIME + timedelta(minutes=1)], True),
+                                            "IBM": ([END_TIME], True)})
+    monkeypatch.setattr(layer, "req_historical_data", server.req_historical_data)
+    results = list(layer.iter_ib_historical_data(["AAPL", "SLOW", "MSFT", "IBM"], "1 D", "1 min", localize=False, deadline=0.3, max_in_memory=2))
+    assert [symbol for symbol, _ in results] == ["AAPL", "MSFT", "IBM", "SLOW"] # SLOW keeps one slot, the others share the second
+    frames = dict(results)
+    assert len(frames["AAPL"]) == 1 and len(frames["MSFT"]) == 2 and len(frames["IBM"]) == 1
+    assert frames["SLOW"] is None
+    assert [call[0] for call in connector.broker_api.calls] == ["cancelHistoricalData"]
+    assert not layer.global_requests[(1, 2)].is_unfinished()
+
+def minute_bars(start, count, minutes=30):
+    times = [start + timedelta(minutes=minutes * position) for position in range(count)]
+    return pd.DataFrame({"open": [100.0 + position for position in range(count)], "high": [101.0 + position for position in range(count)],
+                         "low": [99.0 + position for position in range(count)], "close": [100.5 + position for position in range(count)],
+                         "volume": [10.0] * count}, index=pd.DatetimeIndex(times, name="date"))
+
+def test_resampled_hour_bars_are_cut_at_the_session_open():
+    half_hours = minute_bars(datetime(2024, 1, 2, 9), 4) # 9:00, 9:30, 10:00, 10:30
+    hours = resample_bars(half_hours, "1 hour")
+    assert list(hours.index) == [datetime(2024, 1, 2, 9), datetime(2024, 1, 2, 9, 30), datetime(2024, 1, 2, 10)]
+    assert hours.loc[datetime(2024, 1, 2, 10)].tolist() == [102.0, 104.0, 101.0, 103.5, 20.0]
+    assert list(resample_bars(half_hours, "1 hour", rth_only=True).index) == [datetime(2024, 1, 2, 9, 30), datetime(2024, 1, 2, 10)]
+    assert finest_bar_size(["1 day", "30 mins", "1 hour"]) == "30 mins"
+
+def test_resampled_daily_bars_keep_the_eastern_days():
+    bars = minute_bars(EASTERN.localize(datetime(2024, 1, 2, 15)), 4, minutes=60) # 15:00 to 18:00 Eastern
+    daily = resample_bars(bars.tz_convert(UTC), "1 day")
+    assert len(daily) == 1 and daily.index[0] == EASTERN.localize(datetime(2024, 1, 2))
+    assert daily.iloc[0].tolist() == [100.0, 104.0, 99.0, 103.5, 40.0]
+    assert resample_bars(None, "1 day") is None
+
+def test_panel_aligns_symbols_on_the_union_calendar():
+    first, second, third = datetime(2024, 1, 2, 10), datetime(2024, 1, 2, 10, 1), datetime(2024, 1, 2, 10, 2)
+    collected_data = {"AAPL": bars(first, second, third), "MSFT": bars(first, third), "NONE": None}
+    collected_data["MSFT"]["close"] = [2.0, 3.0]
+    panel = historical_panel(collected_data)
+    assert list(panel.index) == [first, second, third]
+    assert list(panel.columns.get_level_values(0).unique()) == ["AAPL", "MSFT"]
+    assert pd.isna(panel.loc[second, ("MSFT", "close")])
+    assert historical_panel(collected_data, fill="ffill").loc[second, ("MSFT", "volume")] == 100.0
+    flat = historical_panel(collected_data, fill="flat")
+    assert flat.loc[second, ("MSFT", "open")] == 2.0 and flat.loc[second, ("MSFT", "volume")] == 0
+    assert historical_panel(collected_data, fill="zero").loc[second, ("MSFT", "close")] == 0
+
+def test_panel_array_is_symbol_by_time_by_field():
+    first, second = datetime(2024, 1, 2, 10), datetime(2024, 1, 2, 10, 1)
+    symbols, calendar, array = historical_panel({"AAPL": bars(first, second), "MSFT": bars(second)}, fields=("close", "volume"), fill="zero", as_array=True)
+    assert symbols == ["AAPL", "MSFT"] and list(calendar) == [first, second]
+    assert array.shape == (2, 2, 2)
+    assert array[1].tolist() == [[0.0, 0.0], [1.0, 100.0]]
+    with pytest.raises(ValueError):
+        historical_panel({"AAPL": bars(first)}, fill="backfill")
+    assert historical_panel({"AAPL": None}) is None
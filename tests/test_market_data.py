@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Market data requests keep their ticks in tick buffers behind the collected lists
+"""
+
+from datetime import datetime
+
+from broker_matrix import MarketDataStreamRequest, stocks_contract
+from conftest import attach_offline_connector
+
+def stream_request():
+    request = MarketDataStreamRequest(1, 1, "reqMktData", {"contract": stocks_contract("AAPL")})
+    request.set_handlers(on_get_data_postprocess=lambda request, data_piece, data_type: None)
+    request.set_started()
+    return request
+
+def test_collected_lists_are_built_from_the_buffers():
+    request = stream_request()
+    request.add_data((datetime(2024, 1, 2, 10, 0, 0), "BID", 100.5), "price")
+    request.add_data((datetime(2024, 1, 2, 10, 0, 1), "LAST", 100.75), "price")
+    request.add_data((datetime(2024, 1, 2, 10, 0, 1), "LAST_SIZE", 300.0), "size")
+    assert request.collected_data == [(datetime(2024, 1, 2, 10, 0, 0), "BID", 100.5), (datetime(2024, 1, 2, 10, 0, 1), "LAST", 100.75)]
+    assert request.collected_tick_sizes == [(datetime(2024, 1, 2, 10, 0, 1), "LAST_SIZE", 300.0)]
+    assert request.get_data() == request.collected_data
+
+def test_current_price_has_plain_tick_types(layer):
+    attach_offline_connector(layer, ["reqMktData"])
+    request = layer.req_market_data(lambda request, data_piece, data_type: None, stocks_contract("AAPL"))
+    request.set_started()
+    request.add_data((datetime(2024, 1, 2, 10, 0, 0), "LAST", 100.5), "price")
+    prices = layer.get_current_price("AAPL")
+    assert prices.index.name == "datetime" and list(prices.columns) == ["type", "price"]
+    assert prices["type"].dtype == object and prices["type"].iloc[0] == "LAST"
+    assert layer.retrieve_underlying_price("AAPL") == 100.5
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Known failing requests fail locally
+"""
+
+from datetime import datetime
+
+from broker_matrix import stocks_contract
+from conftest import attach_offline_connector
+
+def fail(layer, request, error_code, error_string):
+    request.errors[datetime.now()] = (error_code, error_string)
+    layer.request_set_cancelled_error(request, error_code)
+
+def test_cached_rejection_takes_no_connector_and_no_request_id(layer):
+    connector = attach_offline_connector(layer, ["reqContractDetails", "reqMktData"])
+    fail(layer, layer.req_contract_details(stocks_contract("NOPE")), 200, "No security definition has been found for the request")
+    req_id, calls = connector.req_id, len(connector.broker_api.calls)
+    selected = []
+    selector = layer.broker_api_selector
+    layer.broker_api_selector = lambda request_type: selected.append(request_type) or selector(request_type)
+
+    request = layer.req_contract_details(stocks_contract("NOPE"))
+    market_request = layer.req_market_data(lambda *args: None, stocks_contract("NOPE"))
+    assert connector.req_id == req_id and len(connector.broker_api.calls) == calls and selected == []
+    assert request.properties["NegativeCache"] and not request.is_unfinished()
+    assert list(request.errors.values())[-1][0] == 200
+    assert layer.global_requests[(None, request.request_id)] is request and request.request_id < 0
+    assert market_request.properties["NegativeCache"] and market_request.request_id != request.request_id
+
+    layer.negative_cache.invalidate(stocks_contract("NOPE"))
+    assert layer.req_contract_details(stocks_contract("NOPE")).request_id == req_id + 1
+    assert selected == ["reqContractDetails"]
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+build_option_lattice output feeds request_options
+"""
+
+from datetime import datetime, timedelta
+
+from broker_matrix import option_contract, contract_key
+from conftest import attach_offline_connector
+
+class Details():
+    def __init__(self, contract):
+        self.contract = contract
+
+def test_lattice_contracts_are_requested_by_request_options(layer, monkeypatch):
+    attach_offline_connector(layer, ["reqMktData"])
+    def qualify_contracts(contracts):
+        for position, contract in enumerate(contracts):
+            contract.conId = 1000 + position
+            yield position, "ok", [Details(contract)]
+    monkeypatch.setattr(layer, "qualify_contracts", qualify_contracts)
+    option_symbol = {"expirations": ["29990101"], "all_strikes": [90.0, 100.0, 110.0, 200.0], "multiplier": 100}
+    lattice = layer.build_option_lattice("AAPL", option_symbol=option_symbol, max_days=1000000, strike_band=0.2, underlying_price=100.0)
+    assert set(lattice["contracts"]) == {(strike, right, "29990101") for strike in (90.0, 100.0, 110.0) for right in ("C", "P")}
+
+    key = ("AAPL", 100.0, "P", "29990101")
+    layer.request_options([key], {"AAPL": lattice}, lambda *args: None, is_busy=None)
+    subscription = layer.market_subscriptions[contract_key(lattice["contracts"][key[1:]])]
+    assert subscription.contract is lattice["contracts"][key[1:]]
+    assert subscription.contract.right == "P" and subscription.contract.strike == 100.0
+    assert not contract_key(option_contract("AAPL", 100.0, "29990101", "100", "C")) in layer.market_subscriptions
+
+def test_lattice_drops_far_expirations_and_unqualified_contracts(layer, monkeypatch):
+    requested = []
+    def qualify_contracts(contracts):
+        requested.extend(contracts)
+        for position, contract in enumerate(contracts):
+            if contract.strike == 105.0 and contract.right == "C": # no such contract
+                yield position, "not found", []
+            else:
+                yield position, "ok", [Details(contract)]
+    monkeypatch.setattr(layer, "qualify_contracts", qualify_contracts)
+    near = (datetime.now() + timedelta(days=10)).strftime("%Y%m%d")
+    far = (datetime.now() + timedelta(days=400)).strftime("%Y%m%d")
+    option_symbol = {"expirations": [near, far], "all_strikes": [95.0, 105.0, 150.0], "multiplier": 100}
+    lattice = layer.build_option_lattice("AAPL", option_symbol=option_symbol, max_days=60, strike_band=0.1, underlying_price=100.0)
+    assert len(requested) == 4 and {contract.lastTradeDateOrContractMonth for contract in requested} == {near}
+    assert set(lattice["contracts"]) == {(95.0, "C", near), (95.0, "P", near), (105.0, "P", near)}
+    assert lattice["strikes"] == [95.0, 105.0] and lattice["lattice_expirations"] == [near]
+    assert lattice["underlying_price"] == 100.0
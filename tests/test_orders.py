@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Order lifecycle, amendments, templates and order callbacks
+"""
+
+from datetime import datetime
+import pytest
+from ibapi.tag_value import TagValue
+
+from broker_matrix import IBapi, OrderTemplate, limit_order, stocks_contract, ORDER_AMEND_INTERVAL
+from conftest import attach_offline_connector
+
+class Execution():
+    def __init__(self, exec_id, shares, price):
+        self.execId = exec_id
+        self.shares = shares
+        self.price = price
+
+def order_status(request, status, filled, remaining):
+    request.on_get_data((datetime.now(), status, filled, remaining, 0.0, 0, 0, 0.0, 1, "", 0.0), "order_status")
+
+def test_template_orders_do_not_share_list_fields():
+    order = limit_order("BUY", "U1", 100.0, 10)
+    order.algoStrategy = "Adaptive"
+    order.algoParams = [TagValue("adaptivePriority", "Normal")]
+    template = OrderTemplate(order)
+    first, second = template.make(total_quantity=5), template.make(lmt_price=101.0)
+    first.algoParams.append(TagValue("extra", "1"))
+    first.conditions.append("condition")
+    assert len(second.algoParams) == 1 and len(order.algoParams) == 1
+    assert second.conditions == [] and order.conditions == []
+    assert (first.totalQuantity, first.lmtPrice, second.totalQuantity, second.lmtPrice) == (5, 100.0, 10, 101.0)
+
+def test_order_callbacks_are_quiet_unless_verbose(capsys):
+    quiet, verbose = IBapi(), IBapi(verbose=True)
+    for api in (quiet, verbose):
+        api.orderStatus(1, "Submitted", 0, 10, 0.0, 0, 0, 0.0, 1, "", 0.0)
+        api.throttle.stop()
+    output = capsys.readouterr().out
+    assert output.count("orderStatus") == 1
+
+def test_order_runs_through_partial_fills_to_filled(layer):
+    attach_offline_connector(layer, ["placeOrder"])
+    request = layer.req_place_order(None, stocks_contract("AAPL"), limit_order("BUY", "U1", 100.0, 10))
+    assert request.order_status == "Submitted" and layer.open_orders("AAPL") == [request]
+    request.on_get_data(Execution("e1", 4, 100.0), "execution_details")
+    request.on_get_data(Execution("e1", 4, 100.0), "execution_details") # replayed
+    order_status(request, "Submitted", 4, 6)
+    assert request.order_status == "PartiallyFilled" and request.filled_quantity == 4 and request.remaining_quantity == 6
+    assert layer.orders_in_state("PartiallyFilled") == [request]
+
+    request.on_get_data(Execution("e2", 6, 101.0), "execution_details")
+    assert request.order_status == "Filled" and request.is_finished()
+    assert request.average_fill_price == 100.6
+    assert layer.open_orders() == [] and layer.orders_in_state("Filled") == [request]
+    assert len(layer.buy_orders_by_symbol["AAPL"]) == 0
+    order_status(request, "Cancelled", 10, 0) # terminal states are final
+    assert request.order_status == "Filled"
+
+def test_cancel_is_confirmed_by_ib_and_a_racing_fill_wins(layer):
+    connector = attach_offline_connector(layer, ["placeOrder"])
+    cancelled = layer.req_place_order(None, stocks_contract("AAPL"), limit_order("BUY", "U1", 100.0, 10))
+    layer.req_cancel_order(cancelled, "Exit")
+    assert connector.broker_api.calls[-1][0] == "cancelOrder" and cancelled.is_active()
+    cancelled.on_error(cancelled, 202)
+    assert cancelled.order_status == "Cancelled" and not cancelled.is_unfinished() and cancelled.properties["Reason"] == "Exit"
+
+    filled = layer.req_place_order(None, stocks_contract("MSFT"), limit_order("SELL", "U1", 200.0, 5))
+    layer.req_cancel_order(filled)
+    filled.on_error(filled, 161) # too late, the order is being filled
+    assert filled.too_late_to_cancel and filled.is_active()
+    order_status(filled, "Filled", 5, 0)
+    assert filled.order_status == "Filled" and filled.is_finished()
+    assert layer.open_orders() == [] and len(layer.sell_orders_by_symbol["MSFT"]) == 0
+
+def placed_orders(connector):
+    return [call[1] for call in connector.broker_api.calls if call[0] == "placeOrder"]
+
+def test_amendments_of_a_partially_filled_order_are_coalesced(layer):
+    connector = attach_offline_connector(layer, ["placeOrder"])
+    request = layer.req_place_order(None, stocks_contract("AAPL"), limit_order("BUY", "U1", 100.0, 10))
+    request.on_get_data(Execution("e1", 4, 100.0), "execution_details")
+    assert layer.modify_order(request, lmtPrice=100.5) is request
+    order_id, _, order = placed_orders(connector)[-1]
+    assert order_id == request.request_id and order.lmtPrice == 100.5 and order.totalQuantity == 10 and order.transmit
+    assert request.order_status == "PartiallyFilled" and request.filled_quantity == 4
+
+    layer.modify_order(request, lmtPrice=100.7) # inside the amend interval
+    layer.modify_order(request, totalQuantity=12)
+    assert len(placed_orders(connector)) == 2 and layer.flush_order_amendments in layer.periodic_handlers
+    request.last_amend_time -= ORDER_AMEND_INTERVAL
+    layer.flush_order_amendments()
+    _, _, order = placed_orders(connector)[-1]
+    assert len(placed_orders(connector)) == 3 and (order.lmtPrice, order.totalQuantity) == (100.7, 12)
+    assert not layer.flush_order_amendments in layer.periodic_handlers
+    with pytest.raises(ValueError):
+        layer.modify_order(request, limitPrice=101.0)
+
+def test_amendments_are_answered_in_order(layer):
+    attach_offline_connector(layer, ["placeOrder"])
+    request = layer.req_place_order(None, stocks_contract("AAPL"), limit_order("BUY", "U1", 100.0, 10))
+    layer.modify_order(request, lmtPrice=100.5)
+    request.last_amend_time = None
+    layer.modify_order(request, lmtPrice=100.6)
+    request.on_get_data("Submitted", "open_order") # echo of the first amendment
+    request.on_error(request, 201) # the second one is rejected, the order lives on
+    assert [amendment["status"] for amendment in request.amendments] == ["Acknowledged", "Rejected"]
+    assert request.amendments[1]["error"] == 201 and request.is_active() and request.is_open()
+
+    request.on_get_data(Execution("e1", 10, 100.5), "execution_details")
+    assert layer.modify_order(request, lmtPrice=101.0) is None # filled
+
+def test_bracket_batch_sends_each_parent_right_before_its_child(layer):
+    connector = attach_offline_connector(layer, ["placeOrder"])
+    batch = layer.place_bracket_batch(None, [(stocks_contract("AAPL"), 10, {"price": 100.0, "limit_price": 100.0, "stop_loss": 0.05}),
+                                             (stocks_contract("MSFT"), 5, {"price": 200.0, "stop_loss": 0.02, "stop_loss_initial": 0.04})])
+    placed = placed_orders(connector)
+    assert [(contract.symbol, order.transmit) for _, contract, order in placed] == [("AAPL", False), ("AAPL", True), ("MSFT", False), ("MSFT", True)]
+    order_ids = [order_id for order_id, _, _ in placed]
+    assert order_ids == sorted(order_ids) and len(set(order_ids)) == 4
+    assert placed[1][2].parentId == order_ids[0] and placed[3][2].parentId == order_ids[2]
+    assert (placed[1][2].orderType, placed[1][2].auxPrice) == ("STP", 95.0) and placed[3][2].orderType == "TRAIL"
+    assert [request.child_order_id for request in batch.parents()] == [order_ids[1], order_ids[3]]
+
+    batch.parents()[0].on_get_data(Execution("e1", 10, 100.0), "execution_details")
+    assert batch.filled_quantity() == 10 and batch.total_quantity() == 15
+    assert batch.order_statuses() == {"Filled": 1, "Submitted": 1} and not batch.is_done()
+    batch.parents()[1].on_error(batch.parents()[1], 201) # the rejected parent cancels its child
+    assert batch.is_done() and not batch.is_filled()
+    assert connector.broker_api.calls[-1][:2] == ("cancelOrder", (order_ids[3], ""))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Position book updates from the position stream and the fills, account cache subscriptions
+"""
+
+from datetime import datetime, timedelta
+import math
+import pytz
+from ibapi.execution import Execution
+
+from broker_matrix import PositionBook, execution_time, stocks_contract, UNSET_DOUBLE
+from conftest import attach_offline_connector
+
+def contract():
+    aapl = stocks_contract("AAPL")
+    aapl.conId = 265598
+    return aapl
+
+def execution(exec_id, side, shares, price, fill_time):
+    fill = Execution()
+    fill.execId = exec_id
+    fill.acctNumber = "U1"
+    fill.side = side
+    fill.shares = shares
+    fill.price = price
+    fill.time = fill_time.astimezone(pytz.UTC).strftime("%Y%m%d-%H:%M:%S")
+    return fill
+
+def test_execution_time_formats():
+    assert execution_time("20240102-15:15:30") == pytz.UTC.localize(datetime(2024, 1, 2, 15, 15, 30))
+    assert execution_time("20240102 10:15:30 US/Eastern") == pytz.UTC.localize(datetime(2024, 1, 2, 15, 15, 30))
+    assert execution_time("") is None
+
+def test_fills_update_the_book_until_the_position_arrives():
+    book = PositionBook()
+    book.on_position("U1", contract(), 100, 50.0)
+    later = datetime.now(tz=pytz.UTC) + timedelta(seconds=5)
+    book.on_execution(contract(), execution("1", "BOT", 100, 60.0, later))
+    assert book.get("U1", contract().conId) == (200.0, 55.0)
+    book.on_execution(contract(), execution("1", "BOT", 100, 60.0, later)) # replayed
+    assert book.position("U1", contract()) == 200.0
+    book.on_execution(contract(), execution("2", "SLD", 200, 61.0, later))
+    assert book.get("U1", contract().conId) == (0.0, 0.0)
+
+def test_execution_older_than_the_position_is_not_counted_twice():
+    book = PositionBook()
+    fill_time = datetime.now(tz=pytz.UTC) - timedelta(seconds=2)
+    book.on_position("U1", contract(), 200, 55.0) # already includes the fill
+    book.on_execution(contract(), execution("1", "BOT", 100, 60.0, fill_time))
+    assert book.position("U1", contract()) == 200.0
+
+def test_account_cache_is_seeded_by_the_summary_and_kept_up_to_date(layer):
+    connector = attach_offline_connector(layer, ["reqAccountSummary", "reqPnL"])
+    changes = []
+    layer.account_cache.add_listener(lambda key, value: changes.append((key, value)))
+    request = layer.start_account_cache()
+    assert layer.start_account_cache() is request # one subscription
+    request.on_get_data(("U1", "NetLiquidation", "100000.5", "USD"))
+    request.on_get_data(("U1", "AccountType", "INDIVIDUAL", ""))
+    assert not layer.account_cache.is_seeded()
+    request.on_finished(request) # accountSummaryEnd
+    assert layer.account_cache.wait_seeded(0) and request.is_active()
+    request.on_get_data(("U1", "NetLiquidation", "100000.5", "USD")) # unchanged values are not reported
+    request.on_get_data(("U1", "NetLiquidation", "99000", "USD"))
+    assert layer.account_cache.get("U1", "NetLiquidation", "USD") == 99000.0
+    assert layer.account_cache.get("U1", "AccountType") == "INDIVIDUAL"
+    assert [value for _, value in changes] == [100000.5, "INDIVIDUAL", 99000.0]
+
+    pnl = layer.req_pnl("U1")
+    pnl.on_get_data((12.5, UNSET_DOUBLE, 3.0))
+    assert layer.account_cache.get("U1", "DailyPnL") == 12.5 and math.isnan(layer.account_cache.get("U1", "UnrealizedPnL"))
+    assert len(layer.account_cache.to_frame()) == 5
+
+    layer.stop_account_cache()
+    assert [call[0] for call in connector.broker_api.calls] == ["reqAccountSummary", "reqPnL", "cancelAccountSummary", "cancelPnL"]
+    assert not layer.account_cache.is_seeded() and not pnl.is_active()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Rotating snapshot quotes
+"""
+
+from datetime import datetime
+from itertools import cycle
+
+from broker_matrix import SnapshotQuoteEngine, SNAPSHOT_LINES_SHARE, stocks_contract
+from conftest import attach_offline_connector
+
+def test_snapshots_of_two_connectors_with_the_same_request_id(layer, monkeypatch):
+    attach_offline_connector(layer, ["reqMktData"], client_id=1)
+    attach_offline_connector(layer, ["reqMktData"], client_id=2)
+    connectors = cycle([(1, layer.connectors[1]), (2, layer.connectors[2])])
+    monkeypatch.setattr(layer, "broker_api_selector", lambda request_type: next(connectors))
+    engine = SnapshotQuoteEngine(layer, [stocks_contract("AAPL"), stocks_contract("MSFT")], budget=2)
+    engine.start()
+    requests = [request for request, _ in engine.in_flight.values()]
+    assert len(requests) == 2 and requests[0].request_id == requests[1].request_id
+
+    for request, price in zip(requests, (190.0, 410.0)):
+        request.set_started()
+        request.add_data((datetime.now(), "LAST", price), "price")
+        engine.on_snapshot_end(request)
+    engine.stop()
+    assert list(engine.quote_table()["last"]) == [190.0, 410.0]
+    assert engine.statistics()["completed"] == 2 and len(engine.in_flight) == 0
+
+def test_default_budget_leaves_lines_for_streaming(layer):
+    engine = SnapshotQuoteEngine(layer, [stocks_contract("AAPL")])
+    assert engine.budget == int(layer.max_requests["reqMktData"] * SNAPSHOT_LINES_SHARE)
+    assert engine.budget < layer.max_requests["reqMktData"]
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Request registry indexes
+"""
+
+from broker_matrix import Request, RequestRegistry, stocks_contract
+
+def market_request(request_id, symbol, connector_id=1, request_type="reqMktData"):
+    return Request(request_id, connector_id, request_type, {"contract": stocks_contract(symbol)})
+
+def test_registry_indexes_follow_the_request_state():
+    registry = RequestRegistry()
+    aapl = market_request(1, "AAPL")
+    msft = market_request(2, "MSFT")
+    details = market_request(3, "AAPL", request_type="reqContractDetails")
+    for request in (aapl, msft, details):
+        registry[(request.connector_id, request.request_id)] = request
+    assert registry.requests_by_type("reqMktData") == [aapl, msft]
+    assert registry.requests_by_symbol("reqMktData", "AAPL") == [aapl]
+    assert len(registry.requests_by_state("queued")) == 3
+
+    aapl.set_started()
+    details.set_started()
+    details.set_finished()
+    assert registry.requests_by_type("reqMktData", "active") == [aapl]
+    assert registry.requests_by_type("reqMktData", "queued") == [msft]
+    assert registry.requests_by_state("finished") == [details]
+    msft.set_cancelled("Unsubscribed") # cancelled while queued
+    assert registry.requests_by_symbol("reqMktData", "MSFT", "finished") == [msft]
+    assert registry.requests_by_state("queued") == []
+
+def test_registry_unindexes_removed_and_replaced_requests():
+    registry = RequestRegistry()
+    request = market_request(1, "AAPL")
+    registry[(1, 1)] = request
+    replacement = market_request(1, "MSFT")
+    registry[(1, 1)] = replacement
+    assert registry.requests_by_symbol("reqMktData", "AAPL") == []
+    assert registry.requests_by_type("reqMktData") == [replacement]
+    request.set_started() # the replaced request no longer moves in the indexes
+    assert registry.requests_by_state("active") == []
+
+    del registry[(1, 1)]
+    assert len(registry) == 0
+    assert registry.requests_by_type("reqMktData") == [] and registry.requests_by_state("queued") == []
+    replacement.set_started()
+    assert registry.requests_by_state("active") == []
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Risk engine exposure through partial fills and amendments
+"""
+
+from broker_matrix import stocks_contract, limit_order, AccountCache, RiskEngine
+from conftest import attach_offline_connector
+
+def resolved_contract(symbol, con_id):
+    contract = stocks_contract(symbol)
+    contract.conId = con_id
+    return contract
+
+def placed_calls(connector):
+    return [call for call in connector.broker_api.calls if call[0] == "placeOrder"]
+
+def test_amendment_keeps_only_the_open_part_and_is_checked(layer):
+    connector = attach_offline_connector(layer, ["placeOrder"])
+    risk_engine = layer.set_risk_limits(currency="USD", max_symbol_exposure=1500)
+    request = layer.req_place_order(None, stocks_contract("AAPL"), limit_order("BUY", "U1", 100.0, 10))
+    request.add_fill(4, 100.0)
+    assert risk_engine.exposure_of("symbol", "AAPL") == 1000.0
+
+    layer.modify_order(request, lmtPrice=101.0)
+    assert risk_engine.exposure_of("symbol", "AAPL") == 400.0 + 6 * 101.0
+    assert len(placed_calls(connector)) == 2
+
+    request.last_amend_time = None
+    layer.modify_order(request, totalQuantity=20)
+    assert risk_engine.exposure_of("symbol", "AAPL") == 400.0 + 6 * 101.0
+    assert len(placed_calls(connector)) == 2
+    assert request.amendments[-1]["status"] == "Rejected" and request.amendments[-1]["error"] == "MaxSymbolExposure"
+    assert request.request_parameters["order"].totalQuantity == 10
+    assert risk_engine.rejected == 1
+
+def test_filled_buys_reduce_the_cash_until_the_account_cache_updates(layer):
+    attach_offline_connector(layer, ["placeOrder"])
+    layer.account_cache.set_value(("U1", "TotalCashValue", "USD"), 2000.0)
+    risk_engine = layer.set_risk_limits(currency="USD", min_cash=500)
+    request = layer.req_place_order(None, stocks_contract("AAPL"), limit_order("BUY", "U1", 100.0, 10))
+    request.add_fill(10, 100.0)
+    assert risk_engine.check(stocks_contract("MSFT"), limit_order("BUY", "U1", 100.0, 6)) == "Cash"
+
+    layer.account_cache.set_value(("U1", "TotalCashValue", "USD"), 1000.0)
+    assert risk_engine.check(stocks_contract("MSFT"), limit_order("BUY", "U1", 100.0, 5)) is None
+    assert risk_engine.check(stocks_contract("MSFT"), limit_order("BUY", "U1", 100.0, 6)) == "Cash"
+
+def test_cash_is_read_in_the_reported_currency_without_one():
+    account_cache = AccountCache()
+    risk_engine = RiskEngine(account_cache=account_cache, min_cash=500)
+    account_cache.set_value(("U1", "TotalCashValue", "EUR"), 1000.0)
+    assert risk_engine.check(stocks_contract("AAPL"), limit_order("BUY", "U1", 100.0, 5)) is None
+    assert risk_engine.check(stocks_contract("AAPL"), limit_order("BUY", "U1", 100.0, 6)) == "Cash"
+
+def test_layer_risk_limits_use_the_layer_currency(layer):
+    layer.account_cache.set_value(("U1", "TotalCashValue", "USD"), 1000.0)
+    risk_engine = layer.set_risk_limits(min_cash=500)
+    assert risk_engine.currency == "USD"
+    assert risk_engine.check(stocks_contract("AAPL"), limit_order("BUY", "U1", 100.0, 5)) is None
+
+def test_engine_follows_the_position_book(layer):
+    layer.position_book.on_position("U1", resolved_contract("AAPL", 1), 10, 100.0)
+    risk_engine = layer.set_risk_limits(max_position=100)
+    assert risk_engine.exposure_of("symbol", "AAPL") == 1000.0
+    layer.position_book.on_position("U1", resolved_contract("AAPL", 1), 20, 110.0)
+    layer.position_book.on_position("U1", resolved_contract("MSFT", 2), -5, 200.0)
+    assert risk_engine.exposure_of("symbol", "AAPL") == 2200.0
+    assert risk_engine.exposure_of("account", "U1") == 2200.0 - 1000.0
+    assert risk_engine.check(stocks_contract("AAPL"), limit_order("BUY", "U1", 100.0, 81)) == "MaxPosition"
+
+def test_untracked_fill_is_replaced_by_the_position_stream(layer):
+    attach_offline_connector(layer, ["placeOrder"])
+    risk_engine = layer.set_risk_limits()
+    request = layer.req_place_order(None, resolved_contract("AAPL", 1), limit_order("BUY", "U1", 100.0, 10))
+    request.add_fill(10, 100.0)
+    assert risk_engine.exposure_of("symbol", "AAPL") == 1000.0
+    layer.position_book.on_position("U1", resolved_contract("AAPL", 1), 10, 100.5)
+    assert risk_engine.exposure_of("symbol", "AAPL") == 1005.0
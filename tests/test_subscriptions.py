@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Shared market data lines and subscription sets
+"""
+
+from broker_matrix import stocks_contract, contract_key, LineAllocator
+from conftest import attach_offline_connector
+
+def listener(request, data_piece, data_type):
+    pass
+
+def line_request(layer, symbol):
+    return layer.market_subscriptions[contract_key(stocks_contract(symbol))].request
+
+def test_desired_subscriptions_drop_lost_unselected_lines(layer):
+    attach_offline_connector(layer, ["reqMktData"])
+    added, removed = layer.set_desired_subscriptions("STK", {"AAPL", "MSFT"}, listener)
+    assert added == {"AAPL", "MSFT"} and removed == set()
+    line_request(layer, "AAPL").set_cancelled("Error")
+
+    added, removed = layer.set_desired_subscriptions("STK", {"MSFT"}, listener)
+    assert added == set() and removed == {"AAPL"}
+    assert not contract_key(stocks_contract("AAPL")) in layer.market_subscriptions
+    assert set(layer.desired_subscriptions["STK"]["contracts"]) == {"MSFT"}
+
+def test_desired_subscriptions_request_lost_lines_again(layer):
+    attach_offline_connector(layer, ["reqMktData"])
+    layer.set_desired_subscriptions("STK", {"AAPL", "MSFT"}, listener)
+    lost_request = line_request(layer, "AAPL")
+    lost_request.set_cancelled("Error")
+
+    added, removed = layer.set_desired_subscriptions("STK", {"AAPL", "MSFT"}, listener)
+    assert added == {"AAPL"} and removed == set()
+    assert not line_request(layer, "AAPL") is lost_request
+    assert line_request(layer, "AAPL").is_unfinished()
+    assert layer.market_subscription_listeners(stocks_contract("AAPL")) == 1
+
+def test_one_line_is_shared_and_cancelled_with_the_last_listener(layer):
+    connector = attach_offline_connector(layer, ["reqMktData"])
+    received = []
+    first_listener = lambda request, data_piece, data_type: received.append(("first", data_piece))
+    second_listener = lambda request, data_piece, data_type: received.append(("second", data_piece))
+    request = layer.subscribe_market_data(first_listener, stocks_contract("AAPL"))
+    assert layer.subscribe_market_data(second_listener, stocks_contract("AAPL")) is request
+    assert layer.subscribe_market_data(second_listener, stocks_contract("AAPL")) is request # second reference
+    assert layer.market_subscription_listeners(stocks_contract("AAPL")) == 2
+
+    request.set_started()
+    layer.market_subscriptions[contract_key(stocks_contract("AAPL"))].dispatch(request, "tick", "price")
+    assert sorted(received) == [("first", "tick"), ("second", "tick")]
+
+    layer.unsubscribe_market_data(first_listener, stocks_contract("AAPL"))
+    layer.unsubscribe_market_data(second_listener, stocks_contract("AAPL"))
+    assert request.is_active()
+    layer.unsubscribe_market_data(second_listener, stocks_contract("AAPL"))
+    assert not request.is_unfinished() and request.properties["Reason"] == "Unsubscribed"
+    assert [call[0] for call in connector.broker_api.calls] == ["cancelMktData"]
+    assert layer.market_subscription_listeners(stocks_contract("AAPL")) == 0
+
+def test_queued_line_is_cancelled_without_a_broker_call(layer):
+    connector = attach_offline_connector(layer, ["reqMktData"])
+    request = layer.subscribe_market_data(listener, stocks_contract("AAPL"))
+    layer.unsubscribe_market_data(listener, stocks_contract("AAPL"))
+    assert not request.is_unfinished() and connector.broker_api.calls == []
+
+def test_allocator_preempts_lower_priority_lines_within_the_budget(layer):
+    connector = attach_offline_connector(layer, ["reqMktData"])
+    allocator = LineAllocator(layer, budget=2)
+    allocator.want(stocks_contract("AAPL"), listener, priority=1, min_dwell=0)
+    allocator.want(stocks_contract("MSFT"), listener, priority=3, min_dwell=0)
+    allocator.want(stocks_contract("IBM"), listener, priority=1, min_dwell=0) # waits, same priority as AAPL
+    assert allocator.is_allocated(stocks_contract("AAPL")) and not allocator.is_allocated(stocks_contract("IBM"))
+
+    allocator.want(stocks_contract("IBM"), listener, priority=5, min_dwell=0)
+    assert allocator.is_allocated(stocks_contract("IBM")) and allocator.is_allocated(stocks_contract("MSFT"))
+    assert not allocator.is_allocated(stocks_contract("AAPL"))
+    assert allocator.counters["preemptions"] == 1
+    assert layer.market_subscription_listeners(stocks_contract("AAPL")) == 0
+
+    allocator.drop(stocks_contract("MSFT"))
+    assert allocator.is_allocated(stocks_contract("AAPL")) # the free line goes to the waiting one
+    assert allocator.statistics()["waiting"] == 0
+    assert len([call for call in connector.broker_api.calls if call[0] == "cancelMktData"]) == 0 # the lines were still queued
+
+def test_allocator_keeps_dwelling_lines_and_reallocates_lost_ones(layer):
+    attach_offline_connector(layer, ["reqMktData"])
+    allocator = LineAllocator(layer, budget=1)
+    allocator.want(stocks_contract("AAPL"), listener, priority=1)
+    allocator.want(stocks_contract("MSFT"), listener, priority=5)
+    assert allocator.is_allocated(stocks_contract("AAPL")) # inside its minimum dwell time
+    assert allocator.is_line_held(line_request(layer, "AAPL"))
+
+    line_request(layer, "AAPL").set_cancelled("Timeout")
+    allocator.rebalance()
+    assert allocator.counters["lost"] == 1
+    assert allocator.is_allocated(stocks_contract("MSFT")) and not allocator.is_allocated(stocks_contract("AAPL"))
+    allocator.drop(stocks_contract("MSFT"))
+    assert allocator.is_allocated(stocks_contract("AAPL"))
+    assert line_request(layer, "AAPL").is_unfinished()
+    assert layer.market_subscription_listeners(stocks_contract("AAPL")) == 1
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long, multiple-statements, missing-function-docstring, missing-class-docstring, fixme.
+"""
+Outbound message throttle across reconnects and cancels of queued requests
+"""
+
+import time
+from ibapi.comm import make_field
+from ibapi.message import OUT
+
+from broker_matrix import IBapi, MessageThrottle, THROTTLE_BURST, THROTTLE_RATE
+
+def wait_for(condition, timeout=3):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+def contract_data_request(req_id):
+    return make_field(OUT.REQ_CONTRACT_DATA) + make_field(8) + make_field(req_id)
+
+def test_throttle_sends_after_stop_and_reconnect(monkeypatch):
+    sent = []
+    monkeypatch.setattr(IBapi, "send_message", lambda self, *args: sent.append(args))
+    api = IBapi()
+    api.throttle.stop() # Connector.stop
+    api = IBapi(throttle=api.throttle) # Connector.start
+    count = THROTTLE_BURST + 20
+    for req_id in range(count):
+        api.sendMsg(contract_data_request(req_id))
+    assert wait_for(lambda: len(sent) == count)
+    assert api.throttle.thread_running
+    assert api.throttle.queue_length() == 0
+    api.throttle.stop()
+
+def test_cancel_drops_queued_request():
+    sent = []
+    throttle = MessageThrottle(lambda *args: sent.append(args), rate=1, burst=1)
+    throttle.submit((contract_data_request(1),))
+    throttle.submit((make_field(OUT.REQ_MKT_DATA) + make_field(11) + make_field(7) + make_field(0),))
+    throttle.submit((make_field(OUT.CANCEL_MKT_DATA) + make_field(2) + make_field(7),))
+    assert len(sent) == 1
+    assert throttle.queue_length() == 0
+    assert throttle.statistics()["coalesced"] == 1
+    throttle.stop()
+
+def test_cancel_of_sent_request_is_sent():
+    sent = []
+    throttle = MessageThrottle(lambda *args: sent.append(args))
+    throttle.submit((make_field(OUT.REQ_MKT_DATA) + make_field(11) + make_field(7) + make_field(0),))
+    throttle.submit((make_field(OUT.CANCEL_MKT_DATA) + make_field(2) + make_field(7),))
+    assert len(sent) == 2
+    assert throttle.statistics()["coalesced"] == 0
+    throttle.stop()
+
+def test_cancels_without_request_id_and_of_positions_multi_drop_queued_requests():
+    sent = []
+    throttle = MessageThrottle(lambda *args: sent.append(args), rate=1, burst=1)
+    throttle.submit((contract_data_request(1),))
+    throttle.submit((make_field(OUT.REQ_POSITIONS) + make_field(1),))
+    throttle.submit((make_field(OUT.REQ_POSITIONS_MULTI) + make_field(1) + make_field(9) + make_field("U1") + make_field(""),))
+    throttle.submit((make_field(OUT.CANCEL_POSITIONS_MULTI) + make_field(1) + make_field(8),))
+    throttle.submit((make_field(OUT.CANCEL_POSITIONS) + make_field(1),))
+    throttle.submit((make_field(OUT.CANCEL_POSITIONS_MULTI) + make_field(1) + make_field(9),))
+    assert throttle.queue_length() == 1 # the cancel of the request id 8 waits
+    assert throttle.statistics()["coalesced"] == 2
+    throttle.stop()
+
+def test_burst_stays_below_the_message_limit():
+    assert THROTTLE_RATE + THROTTLE_BURST < 50